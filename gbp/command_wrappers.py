@@ -24,10 +24,12 @@ import os
 import os.path
 import signal
 import sys
+import time
 from contextlib import contextmanager
 from tempfile import TemporaryFile
 
 import gbp.log as log
+import gbp.tracing as tracing
 
 class CommandExecFailed(Exception):
     """Exception raised by the Command class"""
@@ -107,6 +109,7 @@ class Command(object):
         with proxy_stdf():
             stdout_arg = subprocess.PIPE if self.capture_stdout else sys.stdout
             stderr_arg = subprocess.PIPE if self.capture_stderr else sys.stderr
+            start = time.time()
             try:
                 popen = subprocess.Popen(cmd,
                                          cwd=self.cwd,
@@ -122,6 +125,9 @@ class Command(object):
                 raise
 
         self.retcode = popen.returncode
+        tracing.record(cmd, start,
+                       bytes_out=len(self.stdout or '') + len(self.stderr or ''),
+                       returncode=self.retcode)
         if self.retcode < 0:
             self.err_reason = "it was terminated by signal %d" % -self.retcode
         elif self.retcode > 0:
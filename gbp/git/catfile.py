@@ -0,0 +1,143 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2016 Intel Corporation <markus.lehtonen@linux.intel.com>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, please see
+#    <http://www.gnu.org/licenses/>
+"""Read git objects through long running git cat-file processes"""
+
+import subprocess
+import time
+
+import gbp.log as log
+import gbp.tracing as tracing
+from gbp.git.errors import GitError
+
+
+class GitCatFileError(GitError):
+    """Exception thrown by L{GitCatFile}"""
+    pass
+
+
+class GitCatFile(object):
+    """
+    Look up objects of a repository via I{git cat-file --batch} and
+    I{git cat-file --batch-check} coprocesses. The processes are started on
+    first use and kept running so that each lookup is a pipe round-trip
+    instead of a fork and exec of a new git process.
+    """
+    obj_types = ('blob', 'tree', 'commit', 'tag')
+
+    def __init__(self, path):
+        """
+        @param path: path of the repository (working tree) to act on
+        @type path: C{str}
+        """
+        self._path = path
+        self._procs = {}
+
+    def _process(self, mode):
+        """Get a running cat-file process, (re-)spawning it if needed"""
+        popen = self._procs.get(mode)
+        if popen is None or popen.poll() is not None:
+            cmd = ['git', 'cat-file', '--%s' % mode]
+            log.debug(cmd)
+            try:
+                popen = subprocess.Popen(cmd,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         close_fds=True,
+                                         cwd=self._path)
+            except OSError as err:
+                raise GitCatFileError("Error spawning git cat-file: %s" % err)
+            self._procs[mode] = popen
+        return popen
+
+    def _request(self, mode, name):
+        """Send one object name to cat-file and parse the response header"""
+        if not name or '\n' in name:
+            raise GitCatFileError("Invalid object name '%s'" % name)
+        popen = self._process(mode)
+        try:
+            popen.stdin.write(name + '\n')
+            popen.stdin.flush()
+            header = popen.stdout.readline()
+        except (IOError, OSError) as err:
+            self._close_process(mode)
+            raise GitCatFileError("git cat-file failed: %s" % err)
+        if not header.endswith('\n'):
+            self._close_process(mode)
+            raise GitCatFileError("git cat-file died unexpectedly")
+        fields = header.split()
+        if len(fields) != 3 or fields[1] not in self.obj_types:
+            # "<name> missing" or "<name> ambiguous"
+            raise GitCatFileError("Object '%s' not found" % name)
+        return fields[0], fields[1], int(fields[2])
+
+    def info(self, name):
+        """
+        Get information about an object
+
+        @param name: object name, anything git rev-parse understands
+        @type name: C{str}
+        @return: sha1, type and size of the object
+        @rtype: C{tuple} of C{str}, C{str} and C{int}
+        """
+        start = time.time()
+        ret = self._request('batch-check', name)
+        tracing.record(['git', 'cat-file', '--batch-check'], start,
+                       len(name) + 1, ret[2])
+        return ret
+
+    def read(self, name):
+        """
+        Get an object with its raw content
+
+        @param name: object name, anything git rev-parse understands
+        @type name: C{str}
+        @return: sha1, type and raw content of the object
+        @rtype: C{tuple} of C{str}, C{str} and C{str}
+        """
+        start = time.time()
+        sha1, obj_type, size = self._request('batch', name)
+        stdout = self._procs['batch'].stdout
+        data = stdout.read(size)
+        # Content is always followed by a newline
+        if len(data) != size or stdout.read(1) != '\n':
+            self._close_process('batch')
+            raise GitCatFileError("Short read from git cat-file for '%s'" %
+                                  name)
+        tracing.record(['git', 'cat-file', '--batch'], start, len(name) + 1,
+                       size)
+        return sha1, obj_type, data
+
+    def _close_process(self, mode):
+        """Terminate one cat-file process"""
+        popen = self._procs.pop(mode, None)
+        if popen:
+            try:
+                popen.stdin.close()
+            except (IOError, OSError):
+                pass
+            popen.stdout.close()
+            popen.wait()
+
+    def close(self):
+        """Terminate all running cat-file processes"""
+        for mode in list(self._procs.keys()):
+            self._close_process(mode)
+
+    def __del__(self):
+        self.close()
+
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
@@ -17,13 +17,24 @@
 #    <http://www.gnu.org/licenses/>
 """Git fast import class"""
 
+import os
+import stat
 import subprocess
+import tempfile
 import time
+
+import gbp.tracing as tracing
 from gbp.errors import GbpError
 
 class FastImport(object):
-    """Add data to a git repository using I{git fast-import}"""
-    _bufsize = 1024
+    """
+    Add data to a git repository using I{git fast-import}
+
+    Several commits can be made in one session. Each commit gets a mark,
+    which can be used to refer to it as a parent of later commits and which
+    is mapped to the commit's SHA1 in L{marks} once the session is closed.
+    """
+    _bufsize = 128 * 1024
 
     m_regular = 644
     m_exec    = 755
@@ -35,28 +46,58 @@ class FastImport(object):
         @type repo: L{GitRepository}
         """
         self._repo = repo
+        self._fi = self._out = None
+        self._branches = set()
+        self._last_mark = 0
+        self.marks = {}
+        fd, self._marks_file = tempfile.mkstemp(prefix='gbp_marks_',
+                                                dir=repo.git_dir)
+        os.close(fd)
+        self._cmd = ['git', 'fast-import', '--quiet',
+                     '--export-marks=%s' % self._marks_file]
+        self._start = time.time()
+        self._bytes_in = 0
         try:
-            self._fi = subprocess.Popen([ 'git', 'fast-import', '--quiet'],
-                                        stdin=subprocess.PIPE, cwd=repo.path)
+            self._fi = subprocess.Popen(self._cmd,
+                                        stdin=subprocess.PIPE, cwd=repo.path,
+                                        bufsize=self._bufsize)
             self._out = self._fi.stdin
         except OSError as err:
+            os.unlink(self._marks_file)
             raise GbpError("Error spawning git fast-import: %s" % err)
         except ValueError as err:
+            os.unlink(self._marks_file)
             raise GbpError(
                 "Invalid argument when spawning git fast-import: %s" % err)
 
+    def _write(self, data):
+        """Feed data to fast-import"""
+        self._out.write(data)
+        self._bytes_in += len(data)
+
     def _do_data(self, fd, size):
-        self._out.write("data %s\n" % size)
-        while True:
-            data = fd.read(self._bufsize)
-            self._out.write(data)
-            if len(data) != self._bufsize:
-                break
-        self._out.write("\n")
-
-    def _do_file(self, filename, mode, fd, size):
-        name = "/".join(filename.split('/')[1:])
-        self._out.write("M %d inline %s\n" % (mode, name))
+        self._write(b"data %d\n" % size)
+        left = size
+        while left:
+            data = fd.read(min(left, self._bufsize))
+            if not data:
+                raise GbpError("Unexpected end of data, %d bytes missing" %
+                               left)
+            self._write(data)
+            left -= len(data)
+        self._write(b"\n")
+
+    @staticmethod
+    def _quote_path(path):
+        """Quote a path name if fast-import can't take it as is"""
+        if path.startswith('"') or '\n' in path:
+            for char, quoted in (('\\', '\\\\'), ('"', '\\"'), ('\n', '\\n')):
+                path = path.replace(char, quoted)
+            return '"%s"' % path
+        return path
+
+    def _do_file(self, name, mode, fd, size):
+        self._write("M %d inline %s\n" % (mode, self._quote_path(name)))
         self._do_data(fd, size)
 
     def add_file(self, filename, fd, size, mode=m_regular):
@@ -72,7 +113,8 @@ class FastImport(object):
         @param mode: file mode, default is L{FastImport.m_regular}.
         @type mode: C{int}
         """
-        self._do_file(filename, mode, fd, size)
+        name = "/".join(filename.split('/')[1:])
+        self._do_file(name, mode, fd, size)
 
     def add_symlink(self, linkname, linktarget):
         """
@@ -83,11 +125,39 @@ class FastImport(object):
         @param linktarget: the target the symlink points to
         @type linktarget: C{str}
         """
-        self._out.write("M %d inline %s\n" % (self.m_symlink, linkname))
-        self._out.write("data %s\n" % len(linktarget))
-        self._out.write("%s\n" % linktarget)
+        self._write("M %d inline %s\n" % (self.m_symlink,
+                                          self._quote_path(linkname)))
+        self._write("data %s\n" % len(linktarget))
+        self._write("%s\n" % linktarget)
 
-    def start_commit(self, branch, committer, msg):
+    def add_dir(self, path):
+        """
+        Add the contents of a directory, recursively. Like I{git add}, empty
+        directories and anything named I{.git} are skipped.
+
+        @param path: the directory to add
+        @type path: C{str}
+        """
+        for root, dirs, files in os.walk(path):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            reldir = os.path.relpath(root, path)
+            for name in dirs + files:
+                if name == '.git':
+                    continue
+                filepath = os.path.join(root, name)
+                relpath = name if reldir == '.' else os.path.join(reldir, name)
+                st_mode = os.lstat(filepath).st_mode
+                if stat.S_ISLNK(st_mode):
+                    self.add_symlink(relpath, os.readlink(filepath))
+                elif stat.S_ISREG(st_mode):
+                    mode = self.m_exec if st_mode & stat.S_IXUSR else \
+                           self.m_regular
+                    with open(filepath, 'rb') as fd:
+                        self._do_file(relpath, mode, fd,
+                                      os.fstat(fd.fileno()).st_size)
+
+    def start_commit(self, branch, committer, msg, author=None, parents=None):
         """
         Start a fast import commit
 
@@ -97,22 +167,47 @@ class FastImport(object):
         @type committer: L{GitModifier}
         @param msg: the commit message
         @type msg: C{str}
+        @param author: the author information, defaults to the committer
+        @type author: L{GitModifier}
+        @param parents: parents of the commit, either commit-ishs or marks
+            of commits made earlier in this session. By default the commit
+            is made on top of I{branch}
+        @type parents: C{list} of C{str}
+        @return: mark of the new commit
+        @rtype: C{str}
         """
         length = len(msg)
         if not committer.date:
             committer.date = "%d %s" % (time.time(),
                                         time.strftime("%z"))
 
-        if self._repo.has_branch(branch):
-            from_ = "from refs/heads/%(branch)s^0\n"
+        self._last_mark += 1
+        mark = ':%d' % self._last_mark
+        if parents is None:
+            # fast-import itself continues branches used in this session
+            if (branch not in self._branches and
+                    self._repo.has_branch(branch)):
+                from_ = "from refs/heads/%s^0\n" % branch
+            else:
+                from_ = ''
+        else:
+            from_ = "".join(["from %s\n" % parent for parent in parents[:1]] +
+                            ["merge %s\n" % parent for parent in parents[1:]])
+
+        if author:
+            author_ = "author %s <%s> %s\n" % (author.name, author.email,
+                                               author.date or committer.date)
         else:
-            from_ = ''
+            author_ = ''
 
-        self._out.write("""commit refs/heads/%(branch)s
-committer %(name)s <%(email)s> %(time)s
+        self._write("""commit refs/heads/%(branch)s
+mark %(mark)s
+%(author)scommitter %(name)s <%(email)s> %(time)s
 data %(length)s
 %(msg)s%(from)s""" %
             { 'branch': branch,
+              'mark': mark,
+              'author': author_,
               'name':   committer.name,
               'email':  committer.email,
               'time':   committer.date,
@@ -120,12 +215,50 @@ data %(length)s
               'msg': msg,
               'from': from_,
               })
+        self._branches.add(branch)
+        return mark
+
+    def commit_dir(self, path, branch, committer, msg, author=None,
+                   parents=None):
+        """
+        Commit the contents of a directory, replacing the whole tree
+
+        @param path: the directory to commit
+        @type path: C{str}
+        @return: mark of the new commit
+        @rtype: C{str}
+
+        See L{start_commit} for the other parameters.
+        """
+        mark = self.start_commit(branch, committer, msg, author=author,
+                                 parents=parents)
+        self.deleteall()
+        self.add_dir(path)
+        return mark
+
+    def checkpoint(self):
+        """
+        Make fast-import finish the current pack and update refs and marks
+        so that the data imported so far is accessible to other git
+        commands
+        """
+        self._write(b"checkpoint\n\n")
+
+    def progress(self, msg):
+        """
+        Make fast-import print a progress message once it has processed
+        all the preceding commands
+
+        @param msg: the message
+        @type msg: C{str}
+        """
+        self._write(b"progress %s\n\n" % msg)
 
     def deleteall(self):
         """
         Issue I{deleteall} to fastimport so we start from a empty tree
         """
-        self._out.write("deleteall\n")
+        self._write("deleteall\n")
 
     def close(self):
         """
@@ -133,8 +266,21 @@ data %(length)s
         """
         if self._out:
             self._out.close()
+            self._out = None
         if self._fi:
-            self._fi.wait()
+            ret = self._fi.wait()
+            self._fi = None
+            tracing.record(self._cmd, self._start, self._bytes_in, 0, ret)
+            try:
+                if ret:
+                    raise GbpError("git fast-import failed with exit code %d"
+                                   % ret)
+                with open(self._marks_file) as marks:
+                    for line in marks:
+                        mark, sha1 = line.split()
+                        self.marks[mark] = sha1
+            finally:
+                os.unlink(self._marks_file)
 
     def __del__(self):
         self.close()
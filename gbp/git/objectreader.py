@@ -0,0 +1,635 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2016 Intel Corporation <markus.lehtonen@linux.intel.com>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, please see
+#    <http://www.gnu.org/licenses/>
+"""Read git objects and refs directly from the repository files"""
+
+import binascii
+import mmap
+import os
+import re
+import struct
+import zlib
+
+from gbp.git.catfile import GitCatFileError
+
+
+class GitObjectReaderError(GitCatFileError):
+    """
+    Exception thrown by L{GitObjectReader} for objects it can't find and
+    for names and repository features it doesn't support
+    """
+    pass
+
+
+def parse_tree(data):
+    """
+    Parse the raw content of a tree object
+
+    >>> parse_tree(b'100644 a b\\x00' + b'\\x01' * 20 + b'40000 c\\x00' + b'\\xff' * 20)
+    [('100644', 'a b', '0101010101010101010101010101010101010101'), ('40000', 'c', 'ffffffffffffffffffffffffffffffffffffffff')]
+
+    @param data: raw tree object
+    @type data: C{str}
+    @return: mode, name and sha1 of each entry
+    @rtype: C{list} of C{tuple}
+    """
+    entries = []
+    pos = 0
+    while pos < len(data):
+        space = data.index(b' ', pos)
+        nul = data.index(b'\0', space)
+        entries.append((data[pos:space], data[space+1:nul],
+                        binascii.hexlify(data[nul+1:nul+21])))
+        pos = nul + 21
+    return entries
+
+
+class _Pack(object):
+    """A pack file and its (version 2) index, both accessed via mmap"""
+    # Pack object types
+    obj_types = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+    ofs_delta = 6
+    ref_delta = 7
+    _chunk_size = 65536
+
+    def __init__(self, idx_path):
+        self.path = idx_path[:-4] + '.pack'
+        with open(idx_path, 'rb') as idx_file:
+            self._idx = mmap.mmap(idx_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        if self._idx[:8] != b'\377tOc\0\0\0\2':
+            raise GitObjectReaderError("Unsupported pack index %s" % idx_path)
+        self._fanout = struct.unpack('>256I', self._idx[8:1032])
+        self._num = self._fanout[255]
+        self._pack = None
+
+    @property
+    def pack(self):
+        """mmap of the pack file, opened on first use"""
+        if self._pack is None:
+            with open(self.path, 'rb') as pack_file:
+                self._pack = mmap.mmap(pack_file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+        return self._pack
+
+    def find(self, sha1):
+        """
+        Get the offset of an object in the pack
+
+        @param sha1: binary sha1 of the object
+        @return: offset or C{None} if the object is not in this pack
+        """
+        first = ord(sha1[0:1])
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = 1032 + 20 * mid
+            mid_sha1 = self._idx[pos:pos+20]
+            if mid_sha1 < sha1:
+                lo = mid + 1
+            elif mid_sha1 > sha1:
+                hi = mid
+            else:
+                pos = 1032 + 24 * self._num + 4 * mid
+                offset = struct.unpack('>I', self._idx[pos:pos+4])[0]
+                if offset & 0x80000000:
+                    pos = 1032 + 28 * self._num + 8 * (offset & 0x7fffffff)
+                    offset = struct.unpack('>Q', self._idx[pos:pos+8])[0]
+                return offset
+        return None
+
+    def header(self, offset):
+        """
+        Parse the header of a pack entry
+
+        @return: type, size, base (offset or binary sha1) of a delta and
+            the offset of the compressed data
+        """
+        pack = self.pack
+        byte = ord(pack[offset:offset+1])
+        obj_type = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        offset += 1
+        while byte & 0x80:
+            byte = ord(pack[offset:offset+1])
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            offset += 1
+        base = None
+        if obj_type == self.ofs_delta:
+            byte = ord(pack[offset:offset+1])
+            distance = byte & 0x7f
+            offset += 1
+            while byte & 0x80:
+                byte = ord(pack[offset:offset+1])
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+                offset += 1
+            base = distance
+        elif obj_type == self.ref_delta:
+            base = pack[offset:offset+20]
+            offset += 20
+        return obj_type, size, base, offset
+
+    def inflate(self, offset, size, max_length=0):
+        """Decompress data of a pack entry"""
+        pack = self.pack
+        decomp = zlib.decompressobj()
+        want = min(max_length, size) if max_length else size
+        out = []
+        got = 0
+        while got < want:
+            chunk = pack[offset:offset+self._chunk_size]
+            offset += self._chunk_size
+            data = decomp.decompress(chunk, want - got)
+            out.append(data)
+            got += len(data)
+            if not chunk or decomp.unconsumed_tail or decomp.unused_data:
+                # Output limit or end of the compressed data reached
+                break
+        if got < want:
+            raise GitObjectReaderError("Corrupt object in pack %s" %
+                                       self.path)
+        return b''.join(out)
+
+    def close(self):
+        """Unmap the pack and its index"""
+        for mapping in (self._idx, self._pack):
+            if mapping is not None:
+                mapping.close()
+        self._idx = self._pack = None
+
+
+def _delta_sizes(delta):
+    """Parse the base and result sizes from the start of a delta"""
+    sizes = []
+    pos = 0
+    for _ in range(2):
+        size = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        sizes.append(size)
+    return sizes[0], sizes[1], pos
+
+
+def apply_delta(base, delta):
+    """
+    Construct an object from its base object and a delta
+
+    >>> apply_delta(b'hello world', b'\\x0b\\x0c\\x91\\x06\\x05\\x05 moon\\x02!!')
+    'world moon!!'
+
+    @param base: content of the base object
+    @type base: C{str}
+    @param delta: the delta
+    @type delta: C{str}
+    @return: the resulting object content
+    @rtype: C{str}
+    """
+    delta = bytearray(delta)
+    base_size, result_size, pos = _delta_sizes(delta)
+    if base_size != len(base):
+        raise GitObjectReaderError("Delta base size mismatch")
+    out = []
+    while pos < len(delta):
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            copy_offset = copy_size = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    copy_offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    copy_size |= delta[pos] << (8 * i)
+                    pos += 1
+            copy_size = copy_size or 0x10000
+            out.append(base[copy_offset:copy_offset+copy_size])
+        elif cmd:
+            out.append(bytes(delta[pos:pos+cmd]))
+            pos += cmd
+        else:
+            raise GitObjectReaderError("Invalid delta instruction")
+    result = b''.join(out)
+    if len(result) != result_size:
+        raise GitObjectReaderError("Delta result size mismatch")
+    return result
+
+
+class GitObjectReader(object):
+    """
+    Look up objects and refs by reading the loose objects, packs and refs
+    of a repository directly, without running git.
+
+    Supported are full SHA1s, ref names (resolved like git does),
+    the C{^}, C{~N}, C{^N}, C{^0} and C{^{type}} suffixes and C{:path}.
+    Anything else, like abbreviated SHA1s, reflog or range syntax and
+    repositories using reftables, replace refs, grafts or SHA-256, is
+    handed over to the I{fallback} reader, typically a L{GitCatFile}.
+    """
+    obj_types = ('blob', 'tree', 'commit', 'tag')
+    _rev_re = re.compile(r'^(?P<base>[^~^:{}]+)'
+                         r'(?P<suffixes>(?:\^\{[a-z]*\}|\^[0-9]*|~[0-9]*)*)$')
+    _suffix_re = re.compile(r'\^\{[a-z]*\}|\^[0-9]*|~[0-9]*')
+    _sha1_re = re.compile(r'^[0-9a-f]{40}$')
+    _cache_size = 64
+    _cache_max_obj = 4 * 1024 * 1024
+    _errors = (GitObjectReaderError, EnvironmentError, ValueError, IndexError,
+               KeyError, struct.error, zlib.error)
+
+    def __init__(self, git_dir, fallback=None):
+        """
+        @param git_dir: path to the git metadata directory
+        @type git_dir: C{str}
+        @param fallback: reader to use for unsupported names
+        @type fallback: L{GitCatFile}
+        """
+        self._git_dir = git_dir
+        self._common_dir = git_dir
+        commondir_file = os.path.join(git_dir, 'commondir')
+        if os.path.exists(commondir_file):
+            with open(commondir_file) as fobj:
+                self._common_dir = os.path.normpath(
+                        os.path.join(git_dir, fobj.read().strip()))
+        self._fallback = fallback
+        self._obj_dirs = None
+        self._packs = {}
+        self._packed_refs = (None, {})
+        self._cache = {}
+        self._trees = {}
+        self._supported = self._check_supported()
+
+    def _check_supported(self):
+        """Check that the repository doesn't use unsupported features"""
+        common = self._common_dir
+        try:
+            with open(os.path.join(common, 'config')) as fobj:
+                if re.search(r'objectformat\s*=\s*sha256', fobj.read(),
+                             re.IGNORECASE):
+                    return False
+        except IOError:
+            pass
+        if (os.path.exists(os.path.join(common, 'reftable')) or
+                os.path.exists(os.path.join(common, 'info', 'grafts')) or
+                os.path.exists(os.path.join(common, 'refs', 'replace'))):
+            return False
+        # Replace refs may also exist only in packed-refs
+        try:
+            with open(os.path.join(common, 'packed-refs')) as fobj:
+                for line in fobj:
+                    if ' refs/replace/' in line:
+                        return False
+        except IOError:
+            pass
+        return True
+
+#{ Objects
+    def _object_dirs(self):
+        """The object directory and its alternates"""
+        if self._obj_dirs is None:
+            obj_dir = os.path.join(self._common_dir, 'objects')
+            self._obj_dirs = [obj_dir]
+            try:
+                with open(os.path.join(obj_dir, 'info', 'alternates')) as fobj:
+                    for line in fobj:
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            self._obj_dirs.append(
+                                os.path.normpath(os.path.join(obj_dir, line)))
+            except IOError:
+                pass
+        return self._obj_dirs
+
+    def _scan_packs(self):
+        """Open new packs, forget packs that have been removed"""
+        found = set()
+        for obj_dir in self._object_dirs():
+            pack_dir = os.path.join(obj_dir, 'pack')
+            try:
+                names = os.listdir(pack_dir)
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith('.idx'):
+                    path = os.path.join(pack_dir, name)
+                    found.add(path)
+                    if path not in self._packs and \
+                            os.path.exists(path[:-4] + '.pack'):
+                        self._packs[path] = _Pack(path)
+        for path in list(self._packs.keys()):
+            if path not in found:
+                self._packs.pop(path).close()
+
+    def _find_in_packs(self, sha1):
+        """Find the pack containing an object"""
+        for pack in self._packs.values():
+            offset = pack.find(sha1)
+            if offset is not None:
+                return pack, offset
+        return None, None
+
+    def _locate(self, sha1):
+        """
+        Find an object
+
+        @param sha1: hex sha1 of the object
+        @return: path of a loose object or pack and offset
+        """
+        bin_sha1 = binascii.unhexlify(sha1)
+        pack, offset = self._find_in_packs(bin_sha1)
+        if pack is not None:
+            return pack, offset
+        for obj_dir in self._object_dirs():
+            path = os.path.join(obj_dir, sha1[:2], sha1[2:])
+            if os.path.exists(path):
+                return path, None
+        # Packs may have changed, e.g. because of git gc
+        self._scan_packs()
+        pack, offset = self._find_in_packs(bin_sha1)
+        if pack is None:
+            raise GitObjectReaderError("Object '%s' not found" % sha1)
+        return pack, offset
+
+    @staticmethod
+    def _loose_object(path, header_only=False):
+        """Read a loose object"""
+        with open(path, 'rb') as fobj:
+            data = fobj.read()
+        decomp = zlib.decompressobj()
+        if header_only:
+            data = decomp.decompress(data, 64)
+        else:
+            data = decomp.decompress(data) + decomp.flush()
+        nul = data.index(b'\0')
+        obj_type, size = data[:nul].split()
+        return obj_type, int(size), data[nul+1:]
+
+    def _cache_object(self, key, obj_type, data):
+        """Remember a (small) object, e.g. for use as a delta base"""
+        if len(data) <= self._cache_max_obj:
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[key] = (obj_type, data)
+
+    def _pack_object(self, pack, offset):
+        """Read and undeltify an object from a pack"""
+        # Walk down the delta chain to a full object, then apply the deltas
+        chain = []
+        while True:
+            key = (pack.path, offset)
+            if key in self._cache:
+                obj_type, data = self._cache[key]
+                break
+            obj_type, size, base, data_offset = pack.header(offset)
+            if obj_type == pack.ofs_delta:
+                chain.append((key, data_offset, size))
+                offset -= base
+            elif obj_type == pack.ref_delta:
+                chain.append((key, data_offset, size))
+                obj_type, data = self._read_sha1(binascii.hexlify(base))
+                break
+            else:
+                obj_type = pack.obj_types[obj_type]
+                data = pack.inflate(data_offset, size)
+                self._cache_object(key, obj_type, data)
+                break
+        for key, data_offset, size in reversed(chain):
+            data = apply_delta(data, pack.inflate(data_offset, size))
+            self._cache_object(key, obj_type, data)
+        return obj_type, data
+
+    def _pack_info(self, pack, offset):
+        """Get type and size of an object in a pack"""
+        obj_type, size, base, data_offset = pack.header(offset)
+        if obj_type in pack.obj_types:
+            return pack.obj_types[obj_type], size
+        # Size from the delta, type from the end of the delta chain
+        delta = bytearray(pack.inflate(data_offset, size, max_length=32))
+        size = _delta_sizes(delta)[1]
+        while obj_type not in pack.obj_types:
+            if obj_type == pack.ofs_delta:
+                offset -= base
+            else:
+                return self._info_sha1(binascii.hexlify(base))[0], size
+            obj_type, _size, base, _offset = pack.header(offset)
+        return pack.obj_types[obj_type], size
+
+    def _read_sha1(self, sha1):
+        """Get type and content of an object"""
+        where, offset = self._locate(sha1)
+        if offset is None:
+            obj_type, _size, data = self._loose_object(where)
+            return obj_type, data
+        return self._pack_object(where, offset)
+
+    def _info_sha1(self, sha1):
+        """Get type and size of an object"""
+        where, offset = self._locate(sha1)
+        if offset is None:
+            return self._loose_object(where, header_only=True)[:2]
+        return self._pack_info(where, offset)
+
+#{ Refs
+    def _packed_ref(self, ref):
+        """Look up a ref in packed-refs, re-reading the file if it changed"""
+        path = os.path.join(self._common_dir, 'packed-refs')
+        try:
+            stat_res = os.stat(path)
+            key = (stat_res.st_ino, stat_res.st_size, stat_res.st_mtime)
+        except OSError:
+            return None
+        if key != self._packed_refs[0]:
+            refs = {}
+            with open(path) as fobj:
+                for line in fobj:
+                    if line[0] in '#^':
+                        continue
+                    sha1, name = line.split()
+                    refs[name] = sha1
+            self._packed_refs = (key, refs)
+        return self._packed_refs[1].get(ref)
+
+    def _read_ref(self, ref, depth=0):
+        """Get the sha1 a ref points to, following symbolic refs"""
+        if depth > 5:
+            raise GitObjectReaderError("Too deeply nested symbolic ref")
+        if ref.startswith('refs/') and \
+                not ref.startswith(('refs/bisect/', 'refs/worktree/')):
+            ref_dir = self._common_dir
+        else:
+            ref_dir = self._git_dir
+        try:
+            with open(os.path.join(ref_dir, ref)) as fobj:
+                value = fobj.read().strip()
+        except IOError:
+            value = None
+        if value is None:
+            return self._packed_ref(ref) if ref_dir == self._common_dir \
+                    else None
+        if value.startswith('ref: '):
+            return self._read_ref(value[5:], depth + 1)
+        if not self._sha1_re.match(value):
+            raise GitObjectReaderError("Unsupported ref '%s'" % ref)
+        return value
+
+    def _resolve_name(self, name):
+        """Get the sha1 of a full sha1 or ref name, like rev-parse does"""
+        if self._sha1_re.match(name):
+            return name
+        if '@' in name or '..' in name or name.endswith(('/', '.lock')):
+            raise GitObjectReaderError("Unsupported name '%s'" % name)
+        candidates = ['refs/%s' % name, 'refs/tags/%s' % name,
+                      'refs/heads/%s' % name, 'refs/remotes/%s' % name,
+                      'refs/remotes/%s/HEAD' % name]
+        if name.startswith('refs/') or re.match(r'^[A-Z_]+$', name):
+            candidates.insert(0, name)
+        for ref in candidates:
+            sha1 = self._read_ref(ref)
+            if sha1:
+                return sha1
+        raise GitObjectReaderError("Name '%s' not found" % name)
+
+#{ Revisions
+    def _peel(self, sha1, obj_type, want=None):
+        """Dereference tags (and commits for trees) until want is found"""
+        while obj_type != want:
+            if obj_type == 'tag':
+                data = self._read_sha1(sha1)[1]
+                sha1 = data[7:47]
+            elif obj_type == 'commit' and want == 'tree':
+                data = self._read_sha1(sha1)[1]
+                sha1 = data[5:45]
+            elif want is None:
+                break
+            else:
+                raise GitObjectReaderError("Can't peel %s to %s" %
+                                           (obj_type, want))
+            obj_type = self._info_sha1(sha1)[0]
+        return sha1, obj_type
+
+    def _parent(self, sha1, num):
+        """Get the num:th parent of a commit"""
+        sha1 = self._peel(sha1, self._info_sha1(sha1)[0], 'commit')[0]
+        if num == 0:
+            return sha1
+        parents = [line[7:47] for line in
+                   self._read_sha1(sha1)[1].split(b'\n\n', 1)[0].split(b'\n')
+                   if line.startswith(b'parent ')]
+        if len(parents) < num:
+            raise GitObjectReaderError("Commit %s has no parent %d" %
+                                       (sha1, num))
+        return parents[num - 1]
+
+    def _resolve(self, name):
+        """Get the sha1 and type of the object a revision refers to"""
+        if not self._supported:
+            raise GitObjectReaderError("Repository not supported")
+        rev, path = name, None
+        if ':' in name:
+            rev, path = name.split(':', 1)
+        match = self._rev_re.match(rev)
+        if not match:
+            raise GitObjectReaderError("Unsupported revision '%s'" % name)
+        sha1 = self._resolve_name(match.group('base'))
+        for suffix in self._suffix_re.findall(match.group('suffixes')):
+            if suffix.startswith('^{'):
+                want = suffix[2:-1] or None
+                if want and want not in self.obj_types:
+                    raise GitObjectReaderError("Unsupported revision '%s'" %
+                                               name)
+                sha1 = self._peel(sha1, self._info_sha1(sha1)[0], want)[0]
+            elif suffix.startswith('^'):
+                sha1 = self._parent(sha1, int(suffix[1:] or 1))
+            else:
+                for _ in range(int(suffix[1:] or 1)):
+                    sha1 = self._parent(sha1, 1)
+        obj_type = self._info_sha1(sha1)[0]
+        if path is not None:
+            sha1, obj_type = self._peel(sha1, obj_type, 'tree')
+            for component in [comp for comp in path.split('/') if comp]:
+                if component in ('.', '..') or obj_type != 'tree':
+                    raise GitObjectReaderError("Unsupported path '%s'" % name)
+                try:
+                    mode, sha1 = self._tree_entries(sha1)[component]
+                except KeyError:
+                    raise GitObjectReaderError("Path '%s' not found" % name)
+                obj_type = 'commit' if mode == b'160000' else \
+                           self._info_sha1(sha1)[0]
+        return sha1, obj_type
+
+    def _tree_entries(self, sha1):
+        """Get the entries of a tree object as a name to mode, sha1 dict"""
+        if sha1 not in self._trees:
+            if len(self._trees) >= self._cache_size:
+                self._trees.clear()
+            self._trees[sha1] = dict((name, (mode, entry_sha1)) for
+                                     mode, name, entry_sha1 in
+                                     parse_tree(self._read_sha1(sha1)[1]))
+        return self._trees[sha1]
+
+    def info(self, name):
+        """
+        Get information about an object
+
+        @param name: object name
+        @type name: C{str}
+        @return: sha1, type and size of the object
+        @rtype: C{tuple} of C{str}, C{str} and C{int}
+        """
+        try:
+            sha1, obj_type = self._resolve(name)
+            return sha1, obj_type, self._info_sha1(sha1)[1]
+        except self._errors as err:
+            if self._fallback:
+                return self._fallback.info(name)
+            raise GitObjectReaderError(str(err))
+
+    def read(self, name):
+        """
+        Get an object with its raw content
+
+        @param name: object name
+        @type name: C{str}
+        @return: sha1, type and raw content of the object
+        @rtype: C{tuple} of C{str}, C{str} and C{str}
+        """
+        try:
+            sha1 = self._resolve(name)[0]
+            obj_type, data = self._read_sha1(sha1)
+            return sha1, obj_type, data
+        except self._errors as err:
+            if self._fallback:
+                return self._fallback.read(name)
+            raise GitObjectReaderError(str(err))
+
+    def close(self):
+        """Release the packs and the fallback reader"""
+        for pack in self._packs.values():
+            pack.close()
+        self._packs = {}
+        self._cache = {}
+        self._trees = {}
+        if self._fallback:
+            self._fallback.close()
+
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
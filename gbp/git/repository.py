@@ -20,14 +20,25 @@ import six
 import subprocess
 import os.path
 import re
+import time
 from collections import defaultdict
+from fnmatch import fnmatchcase
 import select
+import errno
+import fcntl
+import shutil
+import tempfile
 
 import gbp.log as log
+import gbp.tracing as tracing
 from gbp.git.modifier import GitModifier
 from gbp.git.commit import GitCommit
 from gbp.git.errors import GitError
 from gbp.git.args import GitArgs
+from gbp.git.catfile import GitCatFile, GitCatFileError
+from gbp.git.objectreader import GitObjectReader, parse_tree
+from gbp.git.fastimport import FastImport
+from gbp.errors import GbpError
 
 
 class GitRepositoryError(GitError):
@@ -103,6 +114,8 @@ class GitRepository(object):
 
     def __init__(self, path):
         self._path = os.path.abspath(path)
+        self._cat_file_reader = None
+        self._refs = None
         try:
             # Check for bare repository
             out, dummy, ret = self._git_inout('rev-parse', ['--is-bare-repository'],
@@ -153,10 +166,13 @@ class GitRepository(object):
         env = self.__build_env(extra_env)
         cmd = ['git', command] + args
         log.debug(cmd)
+        start = time.time()
         popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=env, cwd=cwd)
         while popen.poll() == None:
             output += popen.stdout.readlines()
         output += popen.stdout.readlines()
+        tracing.record(cmd, start, bytes_out=sum(len(line) for line in output),
+                       returncode=popen.returncode)
         return output, popen.returncode
 
     def _git_inout(self, command, args, input=None, extra_env=None, cwd=None,
@@ -180,17 +196,17 @@ class GitRepository(object):
         if not cwd:
             cwd = self.path
         ret = 0
-        stdout = ''
-        stderr = ''
+        stdout = []
+        stderr = []
         try:
             for outdata in self.__git_inout(command, args, input, extra_env,
                                             cwd, capture_stderr,
                                             capture_stdout):
-                stdout += outdata[0]
-                stderr += outdata[1]
+                stdout.append(outdata[0])
+                stderr.append(outdata[1])
         except GitRepositoryError as err:
             ret = err.returncode
-        return stdout, stderr, ret
+        return b''.join(stdout), b''.join(stderr), ret
 
     def _git_inout2(self, command, args, stdin=None, extra_env=None, cwd=None,
                     capture_stderr=False):
@@ -204,16 +220,19 @@ class GitRepository(object):
         """
         if not cwd:
             cwd = self.path
-        stderr = ''
+        stderr = []
         try:
             for outdata in self.__git_inout(command, args, stdin, extra_env,
                                             cwd, capture_stderr, True):
-                stderr += outdata[1]
-                yield outdata[0]
+                stderr.append(outdata[1])
+                if outdata[0]:
+                    yield outdata[0]
         except GitRepositoryError as err:
-            err.stderr = stderr
+            err.stderr = b''.join(stderr)
             raise err
 
+    _io_bufsize = 65536
+
     @classmethod
     def __git_inout(cls, command, args, stdin, extra_env, cwd, capture_stderr,
                     capture_stdout):
@@ -226,10 +245,6 @@ class GitRepository(object):
         @note: The caller must consume the iterator that is returned, in order
         to make sure that the git command runs and terminates.
         """
-        def rm_polled_fd(file_obj, select_list):
-            file_obj.close()
-            select_list.remove(file_obj)
-
         cmd = ['git', command] + args
         env = cls.__build_env(extra_env)
         stdout_arg = subprocess.PIPE if capture_stdout else None
@@ -237,6 +252,8 @@ class GitRepository(object):
         stderr_arg = subprocess.PIPE if capture_stderr else None
 
         log.debug(cmd)
+        start = time.time()
+        bytes_out = 0
         popen = subprocess.Popen(cmd,
                                  stdin=stdin_arg,
                                  stdout=stdout_arg,
@@ -244,29 +261,65 @@ class GitRepository(object):
                                  env=env,
                                  close_fds=True,
                                  cwd=cwd)
-        out_fds = [popen.stdout] if capture_stdout else []
+        # Work on the raw file descriptors: reads return whatever is
+        # available (up to the buffer size) and data is never decoded
+        out_fds = [popen.stdout.fileno()] if capture_stdout else []
+        err_fd = popen.stderr.fileno() if capture_stderr else None
         if capture_stderr:
-            out_fds.append(popen.stderr)
-        in_fds = [popen.stdin] if stdin else []
+            out_fds.append(err_fd)
+        in_fds = []
+        if stdin:
+            in_fds.append(popen.stdin.fileno())
+            # Non-blocking so that big writes never stall reading the output
+            flags = fcntl.fcntl(in_fds[0], fcntl.F_GETFL)
+            fcntl.fcntl(in_fds[0], fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            stdin = memoryview(stdin)
         w_ind = 0
-        while out_fds or in_fds:
-            ready = select.select(out_fds, in_fds, [])
-            # Write in chunks of 512 bytes
-            if ready[1]:
-                popen.stdin.write(stdin[w_ind:w_ind+512])
-                w_ind += 512
-                if w_ind > len(stdin):
-                    rm_polled_fd(popen.stdin, in_fds)
-            # Read in chunks of 4k
-            stdout = popen.stdout.read(4096) if popen.stdout in ready[0] else ''
-            stderr = popen.stderr.read(4096) if popen.stderr in ready[0] else ''
-            if popen.stdout in ready[0] and not stdout:
-                rm_polled_fd(popen.stdout, out_fds)
-            if popen.stderr in ready[0] and not stderr:
-                rm_polled_fd(popen.stderr, out_fds)
-            yield stdout, stderr
-
-        if popen.wait():
+        ret = None
+        try:
+            while out_fds or in_fds:
+                ready = select.select(out_fds, in_fds, [])
+                if ready[1]:
+                    try:
+                        w_ind += os.write(in_fds[0],
+                                          stdin[w_ind:w_ind+cls._io_bufsize])
+                    except OSError as err:
+                        if err.errno == errno.EAGAIN:
+                            pass
+                        elif err.errno == errno.EPIPE:
+                            # Command exited without reading all its input
+                            w_ind = len(stdin)
+                        else:
+                            raise
+                    if w_ind >= len(stdin):
+                        popen.stdin.close()
+                        in_fds = []
+                stdout = stderr = b''
+                for fd in ready[0]:
+                    data = os.read(fd, cls._io_bufsize)
+                    if not data:
+                        out_fds.remove(fd)
+                    elif fd == err_fd:
+                        stderr = data
+                    else:
+                        stdout = data
+                        bytes_out += len(data)
+                yield stdout, stderr
+            ret = popen.wait()
+        finally:
+            for file_obj in (popen.stdin, popen.stdout, popen.stderr):
+                if file_obj and not file_obj.closed:
+                    try:
+                        file_obj.close()
+                    except (IOError, OSError):
+                        pass
+            if ret is None:
+                # The generator was closed early or failed, git exits when
+                # it can't write its output anymore
+                popen.wait()
+            tracing.record(cmd, start, len(stdin) if stdin else 0, bytes_out,
+                           popen.returncode)
+        if ret:
             err = GitRepositoryError('git-%s failed' % command)
             err.returncode = popen.returncode
             raise err
@@ -343,6 +396,140 @@ class GitRepository(object):
                 man_section = backspace_re.sub('', match.group('section'))
         return False
 
+    @staticmethod
+    def _refs_stat(paths):
+        """
+        Stat the places where git stores refs. Creating, updating or
+        deleting a ref always changes the mtime of at least one of these.
+        """
+        stats = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_ino, stat.st_size, stat.st_mtime))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def _common_dir(self):
+        """The git dir shared by all working trees of the repository"""
+        common_dir = self.git_dir
+        if os.path.exists(os.path.join(self.git_dir, 'commondir')):
+            # Refs of a linked working tree are stored in the main repository
+            with open(os.path.join(self.git_dir, 'commondir')) as fobj:
+                common_dir = os.path.join(self.git_dir, fobj.read().strip())
+        return common_dir
+
+    def _refs_paths(self, subdir='refs'):
+        """
+        The files and directories where git stores refs
+
+        @param subdir: only include the loose refs below this directory,
+            e.g. I{refs/tags}
+        @type subdir: C{str}
+        """
+        common_dir = self._common_dir()
+        paths = [os.path.join(common_dir, 'packed-refs'),
+                 os.path.join(common_dir, 'reftable')]
+        paths += [root for root, _dirs, _files in
+                    os.walk(os.path.join(common_dir, subdir))]
+        return paths
+
+    def _load_refs(self):
+        """Take a snapshot of all refs with one git-for-each-ref call"""
+        paths = self._refs_paths()
+        loaded = time.time()
+        stats = self._refs_stat(paths)
+
+        fmt = '%(refname) %(objectname) %(objecttype) %(*objectname) ' \
+              '%(*objecttype) %(refname:short)'
+        out, err, ret = self._git_inout('for-each-ref',
+                                        ['--format=%s' % fmt],
+                                        capture_stderr=True)
+        if ret:
+            raise GitRepositoryError("Failed to list refs: %s" % err.strip())
+
+        refs = {}
+        for line in out.splitlines():
+            name, sha1, obj_type, peeled, peeled_type, short = line.split(' ', 5)
+            # Dereference to a commit, the equivalent of <ref>^0
+            if obj_type == 'commit':
+                commit = sha1
+            elif peeled_type == 'commit':
+                commit = peeled
+            else:
+                commit = None
+            refs[name] = {'sha1': sha1, 'type': obj_type, 'commit': commit,
+                          'short': short}
+        self._refs = {'refs': refs, 'paths': paths, 'stats': stats,
+                      'loaded': loaded}
+
+    def _invalidate_refs(self):
+        """Drop the ref snapshot, called by all methods changing refs"""
+        self._refs = None
+
+    def _get_refs(self):
+        """
+        Get the ref snapshot, (re-)loading it if refs were changed behind
+        our back
+
+        @return: ref info (sha1, type, commit and short name) by refname
+        @rtype: C{dict} of C{dict}
+        """
+        if self._refs is not None:
+            stats = self._refs_stat(self._refs['paths'])
+            # Like git's racy index handling: changes within the mtime
+            # granularity of our load time might go unnoticed
+            racy = [stat for stat in stats
+                        if stat and stat[2] + 2 > self._refs['loaded']]
+            if stats != self._refs['stats'] or racy:
+                self._invalidate_refs()
+        if self._refs is None:
+            self._load_refs()
+        return self._refs['refs']
+
+    def _ref_commit(self, ref):
+        """
+        Get the commit a ref points to, dereferencing annotated tags
+
+        @param ref: full name of the ref, e.g. I{refs/tags/foo}
+        @type ref: C{str}
+        @return: sha1 of the commit or C{None} if there is no such ref or it
+            doesn't point to a commit
+        @rtype: C{str}
+        """
+        info = self._get_refs().get(ref)
+        return info['commit'] if info else None
+
+    @property
+    def _cat_file(self):
+        """
+        Object reader, see L{GitCatFile}. Setting the I{gbp.objectReader}
+        git config option of the repository to I{python} selects
+        L{GitObjectReader}, which reads the repository files directly and
+        uses git cat-file only for what it doesn't support.
+        """
+        if self._cat_file_reader is None:
+            reader = GitCatFile(self.path)
+            try:
+                backend = self.get_config('gbp.objectReader')
+            except KeyError:
+                backend = 'git'
+            if backend == 'python':
+                reader = GitObjectReader(self.git_dir, fallback=reader)
+            self._cat_file_reader = reader
+        return self._cat_file_reader
+
+    def close(self):
+        """
+        Terminate the object reader and the git cat-file processes it
+        keeps running. The repository can still be used, they are started
+        again when needed.
+        """
+        if self._cat_file_reader is not None:
+            self._cat_file_reader.close()
+            self._cat_file_reader = None
+
     @property
     def path(self):
         """The absolute path to the repository"""
@@ -385,6 +572,7 @@ class GitRepository(object):
         @param newbranch: new name of the branch
         """
         args = GitArgs("-m", branch, newbranch)
+        self._invalidate_refs()
         self._git_command("branch", args.args)
 
     def create_branch(self, branch, rev=None, force=False):
@@ -400,6 +588,7 @@ class GitRepository(object):
         args = GitArgs(branch)
         args.add_true(force, '--force')
         args.add_true(rev, rev)
+        self._invalidate_refs()
         self._git_command("branch", args.args)
 
     def delete_branch(self, branch, remote=False):
@@ -416,6 +605,7 @@ class GitRepository(object):
         args.add(branch)
 
         if self.branch != branch:
+            self._invalidate_refs()
             self._git_command("branch", args.args)
         else:
             raise GitRepositoryError("Can't delete the branch you're on")
@@ -438,10 +628,9 @@ class GitRepository(object):
         ref = out.split('\n')[0]
 
         # Check if ref really exists
-        try:
-            self._git_command('show-ref', [ ref ])
+        if ref in self._get_refs():
             branch = ref[11:] # strip /refs/heads
-        except GitRepositoryError:
+        else:
             branch = None  # empty repo
         return branch
 
@@ -460,11 +649,7 @@ class GitRepository(object):
             ref = 'refs/remotes/%s' % branch
         else:
             ref = 'refs/heads/%s' % branch
-        try:
-            self._git_command('show-ref', [ ref ])
-        except GitRepositoryError:
-            return False
-        return True
+        return ref in self._get_refs()
 
     def set_branch(self, branch):
         """
@@ -539,6 +724,7 @@ class GitRepository(object):
             log.debug("Your git suite doesn't support --edit/--no-edit "
                       "option for git-merge ")
         args.add(commit)
+        self._invalidate_refs()
         self._git_command("merge", args.args)
 
     def is_fast_forward(self, from_branch, to_branch):
@@ -580,10 +766,10 @@ class GitRepository(object):
         @return: local or remote branches
         @rtype: C{list}
         """
-        args = [ '--format=%(refname:short)' ]
-        args += [ 'refs/remotes/' ] if remote else [ 'refs/heads/' ]
-        out = self._git_getoutput('for-each-ref', args)[0]
-        return [ ref.strip() for ref in out ]
+        prefix = 'refs/remotes/' if remote else 'refs/heads/'
+        refs = self._get_refs()
+        return [ refs[ref]['short'] for ref in sorted(refs)
+                    if ref.startswith(prefix) ]
 
     def get_local_branches(self):
         """
@@ -623,6 +809,7 @@ class GitRepository(object):
             args += [ old ]
         if msg:
             args = [ '-m', msg ] + args
+        self._invalidate_refs()
         self._git_command("update-ref", args)
 
     def branch_contains(self, branch, commit, remote=False):
@@ -727,6 +914,7 @@ class GitRepository(object):
         args.add_true(annotate, '-a')
         args.add(name)
         args.add_true(commit, commit)
+        self._invalidate_refs()
         self._git_command("tag", args.args, interactive=True)
 
     def delete_tag(self, tag):
@@ -737,9 +925,11 @@ class GitRepository(object):
         @type tag: C{str}
         """
         if self.has_tag(tag):
+            self._invalidate_refs()
             self._git_command("tag", [ "-d", tag ])
 
     def move_tag(self, old, new):
+        self._invalidate_refs()
         self._git_command("tag", [ new, old ])
         self.delete_tag(old)
 
@@ -752,8 +942,9 @@ class GitRepository(object):
         @return: C{True} if the repository has that tag, C{False} otherwise
         @rtype: C{bool}
         """
-        out, ret = self._git_getoutput('tag', [ '-l', tag ])
-        return [ False, True ][len(out)]
+        if set('*?[') & set(tag):
+            return len(self.get_tags(tag)) > 0
+        return 'refs/tags/%s' % tag in self._get_refs()
 
     def describe(self, commitish, pattern=None, longfmt=False, always=False,
                  abbrev=None, tags=False, exact_match=False):
@@ -837,8 +1028,11 @@ class GitRepository(object):
         @return: tags
         @rtype: C{list} of C{str}
         """
-        args = [ '-l', pattern ] if pattern else []
-        return [ line.strip() for line in self._git_getoutput('tag', args)[0] ]
+        tags = [ ref[10:] for ref in sorted(self._get_refs())
+                    if ref.startswith('refs/tags/') ]
+        if pattern:
+            tags = [ tag for tag in tags if fnmatchcase(tag, pattern) ]
+        return tags
 
     def verify_tag(self, tag):
         """
@@ -869,6 +1063,7 @@ class GitRepository(object):
         if not GitCommit.is_sha1(commit):
             commit = self.rev_parse(commit)
 
+        self._invalidate_refs()
         if self.bare:
             ref = "refs/heads/%s" % self.get_branch()
             self._git_command("update-ref", [ ref, commit ])
@@ -991,6 +1186,13 @@ class GitRepository(object):
         @return: the name's sha1
         @rtype: C{str}
         """
+        if not short:
+            try:
+                return self.strip_sha1(self._cat_file.info(name)[0])
+            except GitCatFileError:
+                # Let rev-parse decide, it also accepts non-existent sha1s
+                pass
+
         args = GitArgs("--quiet", "--verify")
         args.add_cond(short, '--short=%d' % short)
         args.add(name)
@@ -1000,6 +1202,50 @@ class GitRepository(object):
             raise GitRepositoryError("revision '%s' not found" % name)
         return self.strip_sha1(sha.splitlines()[0], short)
 
+    def rev_parse_many(self, names, short=0):
+        """
+        Find the SHA1s of several names at once, without running git for
+        each of them
+
+        @param names: the names to look for
+        @type names: C{list} of C{str}
+        @param short:  try to abbreviate SHA1s to given length
+        @type short: C{int}
+        @return: the sha1 of each name
+        @rtype: C{dict} of C{str}
+        @raises GitRepositoryError: if any of the names is not found
+        """
+        shas = {}
+        unresolved = []
+        for name in names:
+            if name in shas or name in unresolved:
+                continue
+            try:
+                if short:
+                    raise GitCatFileError("Abbreviation needs rev-parse")
+                shas[name] = self.strip_sha1(self._cat_file.info(name)[0])
+            except GitCatFileError:
+                unresolved.append(name)
+
+        if unresolved:
+            # Resolve the rest in one go; names that are options or don't
+            # map to exactly one sha1 are handled by rev_parse() instead
+            args = GitArgs('--revs-only')
+            args.add_cond(short, '--short=%d' % short)
+            args.add([name for name in unresolved
+                        if not name.startswith('-')])
+            out, _err, ret = self._git_inout('rev-parse', args.args,
+                                             capture_stderr=True)
+            lines = out.splitlines()
+            if (not ret and len(lines) == len(unresolved) and
+                    not [line for line in lines if line.startswith('^')]):
+                for name, sha in zip(unresolved, lines):
+                    shas[name] = self.strip_sha1(sha, short)
+            else:
+                for name in unresolved:
+                    shas[name] = self.rev_parse(name, short)
+        return shas
+
     @staticmethod
     def strip_sha1(sha1, length=0):
         """
@@ -1117,6 +1363,10 @@ class GitRepository(object):
         @return: type of the repository object
         @rtype: C{str}
         """
+        try:
+            return self._cat_file.info(obj)[1]
+        except GitCatFileError:
+            pass
         out, ret = self._git_getoutput('cat-file', args=['-t', obj])
         if ret:
             raise GitRepositoryError("Not a Git repository object: '%s'" % obj)
@@ -1134,6 +1384,12 @@ class GitRepository(object):
         @return: the tree
         @rtype: C{list} of objects. See above.
         """
+        if not paths:
+            # Read the tree objects, no need for ls-tree
+            try:
+                return self._list_tree_objects(treeish, recurse)
+            except GitCatFileError:
+                pass
         args = GitArgs('-z')
         args.add_true(recurse, '-r')
         args.add(treeish)
@@ -1150,6 +1406,29 @@ class GitRepository(object):
                 tree.append(line.split(None, 3))
         return tree
 
+    def _list_tree_objects(self, treeish, recurse, prefix=''):
+        """List a tree like L{list_tree} does, using the object reader"""
+        # Everything after the colon of <commit>:<path> is a path
+        name = treeish if ':' in treeish else '%s^{tree}' % treeish
+        sha1, obj_type, data = self._cat_file.read(name)
+        if obj_type != 'tree':
+            raise GitCatFileError("'%s' is not a tree" % treeish)
+        tree = []
+        for mode, name, entry_sha1 in parse_tree(data):
+            path = prefix + name
+            if mode == '40000':
+                if recurse:
+                    tree.extend(self._list_tree_objects(entry_sha1, recurse,
+                                                        path + '/'))
+                    continue
+                entry_type = 'tree'
+            elif mode == '160000':
+                entry_type = 'commit'
+            else:
+                entry_type = 'blob'
+            tree.append([mode.zfill(6), entry_type, entry_sha1, path])
+        return tree
+
 #}
 
     def get_config(self, name):
@@ -1279,10 +1558,12 @@ class GitRepository(object):
         args.add_false(tags, '--no-tags')
         args.add_true(fetch, '--fetch')
         args.add(name, url)
+        self._invalidate_refs()
         self._git_command("remote", args.args)
 
     def remove_remote_repo(self, name):
         args = GitArgs('rm', name)
+        self._invalidate_refs()
         self._git_command("remote", args.args)
 
     def fetch(self, repo=None, tags=False, depth=0, refspec=None,
@@ -1310,6 +1591,7 @@ class GitRepository(object):
             args.add_cond(repo, repo)
             args.add_cond(refspec, refspec)
 
+        self._invalidate_refs()
         self._git_command("fetch", args.args)
 
     def pull(self, repo=None, ff_only=False, all_remotes=False):
@@ -1329,6 +1611,7 @@ class GitRepository(object):
             args.add_true(all_remotes, '--all')
         else:
             args.add_true(repo, repo)
+        self._invalidate_refs()
         self._git_command("pull", args.args)
 
     def push(self, repo=None, src=None, dst=None, ff_only=True, force=False,
@@ -1364,6 +1647,7 @@ class GitRepository(object):
                 refspec = '+%s' % refspec
             args.add(refspec)
 
+        self._invalidate_refs()
         self._git_command("push", args.args)
 
     def push_tag(self, repo, tag):
@@ -1483,6 +1767,7 @@ class GitRepository(object):
         if committer_info:
             extra_env.update(committer_info.get_committer_env())
         default_args = ['-q', '-m', msg] + (['--edit'] if edit else [])
+        self._invalidate_refs()
         self._git_command("commit", default_args + args, extra_env=extra_env,
                           interactive=edit)
 
@@ -1538,22 +1823,60 @@ class GitRepository(object):
         """
         Create a tree object out of a directory content
 
+        A scratch index is kept between calls so that git only needs to hash
+        the files whose stat data changed since the previous call, e.g. when
+        the same directory is updated and turned into a tree repeatedly.
+        The index is I{gbp-cache/tree-index} under the git dir of the
+        working tree, I{gbp-cache/tree-index.flock} is locked while it is in
+        use. Concurrent callers fall back to a temporary index. Both files
+        are kept, removing them only makes the next call slower.
+
         @param unpack_dir: content to add
         @type unpack_dir: C{str}
         @return: the tree object hash
         @rtype: C{str}
         """
-        git_index_file = os.path.join(self.path, self._git_dir, 'gbp_index')
+        cache_dir = os.path.join(self.git_dir, 'gbp-cache')
         try:
-            os.unlink(git_index_file)
-        except OSError:
-            pass
-        self.add_files('.', force=True, index_file=git_index_file,
-                       work_tree=unpack_dir)
-        return self.write_tree(git_index_file)
+            os.makedirs(cache_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise GitRepositoryError("Failed to create %s: %s" %
+                                         (cache_dir, err))
+        # Not tree-index.lock, git takes that lock itself
+        git_index_file = os.path.join(cache_dir, 'tree-index')
+        lock_fd = os.open(git_index_file + '.flock', os.O_RDWR | os.O_CREAT)
+        tmpdir = None
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                # Another process is using the scratch index, don't wait
+                # for it but start from an empty temporary index
+                log.debug("Scratch index locked, using a temporary one")
+                tmpdir = tempfile.mkdtemp(dir=cache_dir, prefix='tree-index.')
+                git_index_file = os.path.join(tmpdir, 'index')
+            try:
+                self.add_files('.', force=True, index_file=git_index_file,
+                               work_tree=unpack_dir)
+            except GitRepositoryError:
+                # Start over with an empty index if the old one is unusable
+                if not os.path.exists(git_index_file):
+                    raise
+                os.unlink(git_index_file)
+                self.add_files('.', force=True, index_file=git_index_file,
+                               work_tree=unpack_dir)
+            return self.write_tree(git_index_file)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+            os.close(lock_fd)
 
     def commit_dir(self, unpack_dir, msg, branch, other_parents=None,
-                   author={}, committer={}, create_missing_branch=False):
+                   author={}, committer={}, create_missing_branch=False,
+                   fast_import=False):
         """
         Replace the current tip of branch I{branch} with the contents from I{unpack_dir}
 
@@ -1573,9 +1896,11 @@ class GitRepository(object):
         @param create_missing_branch: create I{branch} as detached branch if it
             doesn't already exist.
         @type create_missing_branch: C{bool}
+        @param fast_import: stream the contents through I{git fast-import}
+            straight into a pack instead of adding them via an index. File
+            contents are stored as is, without applying gitattributes.
+        @type fast_import: C{bool}
         """
-        tree = self.create_tree(unpack_dir)
-
         if branch:
             try:
                 cur = self.rev_parse(branch)
@@ -1599,6 +1924,11 @@ class GitRepository(object):
                 if sha not in parents:
                     parents += [ sha ]
 
+        if fast_import:
+            return self._fast_import_dir(unpack_dir, msg, branch, parents,
+                                         author, committer)
+
+        tree = self.create_tree(unpack_dir)
         commit = self.commit_tree(tree=tree, msg=msg, parents=parents,
                                   author=author, committer=committer)
         if not commit:
@@ -1606,6 +1936,55 @@ class GitRepository(object):
         self.update_ref("refs/heads/%s" % branch, commit, cur)
         return commit
 
+    def _get_ident(self, who, info):
+        """
+        Get the complete author or committer identity git would use for a
+        commit, filling in whatever is missing from I{info}
+
+        @param who: I{author} or I{committer}
+        @type who: C{str}
+        @param info: identity information
+        @type info: C{dict} with keys I{name}, I{email}, I{date}
+            or L{GitModifier}
+        @rtype: L{GitModifier}
+        """
+        extra_env = {}
+        for key, val in info.items():
+            if val:
+                extra_env['GIT_%s_%s' % (who.upper(), key.upper())] = val
+        out, err, ret = self._git_inout('var', ['GIT_%s_IDENT' % who.upper()],
+                                        extra_env=extra_env,
+                                        capture_stderr=True)
+        match = re.match(r'^(.*) <(.*)> (\d+ [+-]\d{4})$', out.strip())
+        if ret or not match:
+            raise GitRepositoryError("Failed to get %s identity: %s" %
+                                     (who, err.strip()))
+        return GitModifier(*match.groups())
+
+    def _fast_import_dir(self, unpack_dir, msg, branch, parents, author,
+                         committer):
+        """
+        Commit the contents of I{unpack_dir} on top of I{parents} using
+        git fast-import and update I{branch} to point to the new commit
+        """
+        author = self._get_ident('author', author)
+        committer = self._get_ident('committer', committer)
+        self._invalidate_refs()
+        try:
+            fastimport = FastImport(self)
+            try:
+                mark = fastimport.commit_dir(unpack_dir, branch, committer,
+                                             msg, author=author,
+                                             parents=parents)
+            finally:
+                fastimport.close()
+        except (GbpError, IOError, OSError) as err:
+            raise GitRepositoryError("Failed to import %s: %s" %
+                                     (unpack_dir, err))
+        finally:
+            self._invalidate_refs()
+        return fastimport.marks[mark]
+
     def commit_tree(self, tree, msg, parents, author={}, committer={}):
         """
         Commit a tree with commit msg I{msg} and parents I{parents}
@@ -1682,6 +2061,13 @@ class GitRepository(object):
 
     def show(self, id):
         """git-show id"""
+        # Blobs are shown as-is so they can be read without spawning git
+        try:
+            sha1, obj_type, _size = self._cat_file.info(id)
+            if obj_type == 'blob':
+                return self._cat_file.read(sha1)[2]
+        except GitCatFileError:
+            pass
         obj, stderr, ret = self._git_inout('show', ["--pretty=medium", id],
                                               capture_stderr=True)
         if ret:
@@ -1735,7 +2121,7 @@ class GitRepository(object):
         @rtype: dict
         """
         commit_sha1 = self.rev_parse("%s^0" % commitish)
-        args = GitArgs('--pretty=format:%an%x00%ae%x00%ad%x00%cn%x00%ce%x00%cd%x00%s%x00%f%x00%b%x00',
+        args = GitArgs('--pretty=format:%s' % self._commit_info_format,
                        '-z', '--date=raw', '--no-renames', '--name-status',
                        commit_sha1)
         out, err, ret =  self._git_inout('show', args.args)
@@ -1745,6 +2131,23 @@ class GitRepository(object):
 
         fields = out.split('\x00')
 
+        file_fields = fields[9:]
+        # For some reason git returns one extra empty field for merge commits
+        if file_fields[0] == '': file_fields.pop(0)
+        if '' in file_fields:
+            file_fields = file_fields[:file_fields.index('')]
+        return self._parse_commit_info(commitish, fields[:9], file_fields)
+
+    _commit_info_format = ('%an%x00%ae%x00%ad%x00%cn%x00%ce%x00%cd%x00'
+                           '%s%x00%f%x00%b%x00')
+
+    @staticmethod
+    def _parse_commit_info(commitish, fields, file_fields):
+        """
+        Create a commit info dict from the fields output by git using
+        I{_commit_info_format} and the alternating status and path fields of
+        I{--name-status -z}
+        """
         author = GitModifier(fields[0].strip(),
                              fields[1].strip(),
                              fields[2].strip())
@@ -1753,13 +2156,8 @@ class GitRepository(object):
                                 fields[5].strip())
 
         files = defaultdict(list)
-        file_fields = fields[9:]
-        # For some reason git returns one extra empty field for merge commits
-        if file_fields[0] == '': file_fields.pop(0)
-        while len(file_fields) and file_fields[0] != '':
-            status = file_fields.pop(0).strip()
-            path = file_fields.pop(0)
-            files[status].append(path)
+        for i in range(0, len(file_fields) - 1, 2):
+            files[file_fields[i].strip()].append(file_fields[i + 1])
 
         return {'id' : commitish,
                 'author' : author,
@@ -1769,6 +2167,105 @@ class GitRepository(object):
                 'body' : fields[8],
                 'files' : files}
 
+    def iter_commit_info(self, since=None, until=None, paths=None, num=0,
+                         first_parent=False, options=None, reverse=False,
+                         commits=None, files=True):
+        """
+        Look up data of a range of commits, like L{get_commit_info} does for
+        one commit. All the data is read from one I{git log} process and
+        the commits are yielded as soon as they have been read.
+
+        @param since: commit to start from
+        @type since: C{str}
+        @param until: last commit to get
+        @type until: C{str}
+        @param paths: only list commits touching paths
+        @type paths: C{list} of C{str}
+        @param num: maximum number of commits to fetch
+        @type num: C{int}
+        @param first_parent: only follow first parent when seeing a
+                             merge commit
+        @type first_parent: C{bool}
+        @param options: list of additional options passed to git log
+        @type  options: C{list} of C{str}ings
+        @param reverse: output commits in reverse (oldest first) order
+        @type reverse: C{bool}
+        @param commits: look up exactly these commits, in the given order,
+                        instead of a range of commits
+        @type commits: C{list} of C{str}
+        @param files: list the files changed by the commits, I{files} is
+                      left empty otherwise which makes git log a lot faster
+        @type files: C{bool}
+        @return: info of each commit, with the commit sha1 as I{id}
+        @rtype: iterator of C{dict}
+        """
+        args = GitArgs('--pretty=format:%%H%%x00%%P%%x00%s' %
+                            self._commit_info_format,
+                       '-z', '--date=raw')
+        args.add_true(files, '--no-renames', '--name-status', '--cc')
+        args.add_true(num, '-%d' % num)
+        args.add_true(first_parent, '--first-parent')
+        args.add_true(reverse, '--reverse')
+        stdin = None
+        if commits is not None:
+            if not commits:
+                return
+            args.add('--no-walk=unsorted', '--stdin')
+            stdin = '\n'.join(commits) + '\n'
+        elif since:
+            args.add("%s..%s" % (since, until or 'HEAD'))
+        elif until:
+            args.add(until)
+        args.add_cond(options, options)
+        if isinstance(paths, six.string_types):
+            paths = [ paths ]
+        # Report all files of the commit, not only the ones matching paths
+        args.add_true(paths and files, '--full-diff')
+        args.add("--")
+        args.add_cond(paths, paths)
+
+        fields = []
+        file_fields = None
+        # Merge commits have an extra empty field before the files
+        merge_field = False
+        remainder = ''
+        try:
+            for chunk in self._git_inout2('log', args.args, stdin=stdin,
+                                          capture_stderr=True):
+                tokens = (remainder + chunk).split('\x00')
+                remainder = tokens.pop()
+                for token in tokens:
+                    if file_fields is None:
+                        # Skip commit separators, sha1 is never empty
+                        if token or fields:
+                            fields.append(token)
+                            if len(fields) == 11 and files:
+                                file_fields = []
+                                merge_field = len(fields[1].split()) > 1
+                            elif len(fields) == 11:
+                                yield self._parse_commit_info(fields[0],
+                                                              fields[2:], [])
+                                fields = []
+                    elif merge_field:
+                        merge_field = False
+                        if token:
+                            file_fields.append(token)
+                    elif token or len(file_fields) % 2:
+                        file_fields.append(token)
+                    else:
+                        yield self._parse_commit_info(fields[0], fields[2:],
+                                                      file_fields)
+                        fields = []
+                        file_fields = None
+        except GitRepositoryError as err:
+            where = " on %s" % paths if paths else ""
+            raise GitRepositoryError("Error getting commits %s..%s%s: %s" %
+                        (since, until, where, err.stderr.strip()))
+        if remainder and file_fields is not None:
+            file_fields.append(remainder)
+        if file_fields is not None:
+            yield self._parse_commit_info(fields[0], fields[2:], file_fields)
+
 #{ Patches
     def format_patches(self, start, end, output_dir,
                        signature=True,
@@ -0,0 +1,46 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2016 Intel Corporation <markus.lehtonen@linux.intel.com>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, please see
+#    <http://www.gnu.org/licenses/>
+"""Helpers for the JSON files gbp keeps on disk"""
+
+import six
+
+
+def to_native(data):
+    """
+    Convert unicode strings read by the json module back to C{str}, i.e.
+    UTF-8 encoded bytes in python 2
+
+    >>> to_native({u'a': [u'b', 1, None]}) == {'a': ['b', 1, None]}
+    True
+    >>> isinstance(list(to_native({u'a': u'b'}).keys())[0], str)
+    True
+    >>> to_native(u'\\xe4') == u'\\xe4'.encode('utf-8') if six.PY2 else True
+    True
+
+    @param data: data loaded by the json module
+    @return: I{data} with all strings converted to C{str}
+    """
+    if isinstance(data, six.text_type):
+        return data.encode('utf-8') if six.PY2 else data
+    elif isinstance(data, list):
+        return [to_native(item) for item in data]
+    elif isinstance(data, dict):
+        return dict((to_native(key), to_native(val)) for
+                    key, val in data.items())
+    return data
+
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
@@ -17,10 +17,12 @@
 #    <http://www.gnu.org/licenses/>
 """provides some rpm source package related helpers"""
 
+import difflib
+import hashlib
 import os
 import re
 import tempfile
-from optparse import OptionParser
+from contextlib import contextmanager
 from collections import defaultdict
 
 import six
@@ -33,16 +35,140 @@ import gbp.log
 from gbp.pkg import (UpstreamSource, parse_archive_filename)
 from gbp.rpm.policy import RpmPkgPolicy
 from gbp.rpm.linkedlist import LinkedList
+from gbp.rpm.macros import MacroTable, MacroExpandError
+from gbp.rpm.speccache import SpecCache
 from gbp.rpm.lib_rpm import librpm, get_librpm_log
+from gbp.tmpfile import replace_file
 
 
 class NoSpecError(Exception):
     """Spec file parsing error"""
     pass
 
-class MacroExpandError(Exception):
-    """Macro expansion in spec file failed"""
-    pass
+
+@contextmanager
+def _spec_tmpfile(data):
+    """
+    Temporary file for feeding spec file content to librpm which only takes
+    a file name. The file is kept in memory (a memfd or a file in
+    I{/dev/shm}) when possible.
+
+    @param data: content of the file
+    @type data: C{str}
+    @return: path of the file
+    @rtype: C{str}
+    """
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('gbp-spec')
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            yield '/proc/self/fd/%d' % fd
+        finally:
+            os.close(fd)
+    else:
+        shm = '/dev/shm'
+        tmpdir = shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else None
+        with tempfile.NamedTemporaryFile(prefix='gbp', dir=tmpdir) as tmp:
+            tmp.write(data)
+            tmp.flush()
+            yield tmp.name
+
+
+class MacroOpts(object):
+    """Options parsed from a macro line, see L{SpecFile._parse_macro_opts}"""
+    def __init__(self, dests):
+        for dest in dests:
+            setattr(self, dest, None)
+
+
+class SpecRecord(object):
+    """
+    Base class of the records SpecFile keeps about the lines of a spec
+    file. The fields are attributes but can also be accessed as items, like
+    in a dict.
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+
+class TagLine(SpecRecord):
+    """Tag line: the line node, tag number and the value on the line"""
+    __slots__ = ('line', 'num', 'linevalue')
+
+
+class DirectiveLine(SpecRecord):
+    """Directive or macro line: the line node, identifier and arguments"""
+    __slots__ = ('line', 'id', 'args')
+
+
+class GbpTagLine(SpecRecord):
+    """Gbp tag line: the line node and arguments"""
+    __slots__ = ('line', 'args')
+
+
+class Tag(SpecRecord):
+    """
+    All lines of one tag, with the value librpm gives for the tag and an
+    index of the lines by tag number
+    """
+    __slots__ = ('value', 'lines', 'bynum')
+
+    def __init__(self, value):
+        super(Tag, self).__init__(value, [], {})
+
+    def add(self, linerec):
+        """Add a line record"""
+        self.lines.append(linerec)
+        self.bynum[linerec.num] = linerec
+
+    def remove(self, num):
+        """
+        Remove the line records with the given tag number
+
+        >>> tag = Tag('foo')
+        >>> tag.add(TagLine(None, 1, 'a'))
+        >>> tag.add(TagLine(None, 2, 'b'))
+        >>> [rec.linevalue for rec in tag.remove(1)], list(tag.bynum)
+        (['a'], [2])
+
+        @return: the removed records
+        @rtype: C{list} of L{TagLine}
+        """
+        removed = [rec for rec in self.lines if rec.num == num]
+        if removed:
+            self.lines = [rec for rec in self.lines if rec.num != num]
+            del self.bynum[num]
+        return removed
+
+
+# Cache of librpm tag constants, tag name to constant or None if not known
+_rpmtags = {}
+
+
+def _rpmtag(tagname):
+    """Get the librpm constant of a tag, C{None} if rpm doesn't know it"""
+    if tagname not in _rpmtags:
+        _rpmtags[tagname] = getattr(librpm, 'RPMTAG_%s' % tagname.upper(),
+                                    None)
+    return _rpmtags[tagname]
 
 
 class RpmUpstreamSource(UpstreamSource):
@@ -111,16 +237,52 @@ class SpecFile(object):
                                '(\s+(?P<args>.*))?$', flags=re.I)
     gbptag_re = re.compile(r'^\s*#\s*gbp-(?P<name>[a-z-]+)'
                             '(\s*:\s*(?P<args>\S.*))?$', flags=re.I)
+    macro_def_re = re.compile(r'^\s*(%(define|global)\s+(?P<macro>\w+)|'
+                               '(?P<tag>[a-z]+)[0-9]*\s*:)', flags=re.I)
+    define_args_re = re.compile(r'(?P<name>\w+)(?P<params>\()?\S*\s+'
+                                 '(?P<body>.*)$')
+    macro_ref_re = re.compile(r'%{?[?!]*(?P<name>[a-z_][a-z0-9_]*)',
+                               flags=re.I)
+    inline_define_re = re.compile(r'%{?(define|global)\b')
     # Here "sections" stand for all scripts, scriptlets and other directives,
     # but not macros
     section_identifiers = ('package', 'description', 'prep', 'build', 'install',
             'clean', 'check', 'pre', 'preun', 'post', 'postun', 'verifyscript',
             'files', 'changelog', 'triggerin', 'triggerpostin', 'triggerun',
             'triggerpostun')
+    _recorded_directives = frozenset(section_identifiers +
+                                     ('setup', 'patch', 'define', 'global',
+                                      'undefine'))
+    # Options of the %patch and %setup macros: option letter to destination
+    # attribute and whether the option takes a value
+    patch_macro_opts = {'p': ('strip', True), 's': ('silence', True),
+                        'P': ('patchnum', True), 'b': ('backup', True),
+                        'E': ('removeempty', True)}
+    setup_macro_opts = {'n': ('name', True), 'c': ('create_dir', False),
+                        'D': ('no_delete_dir', False),
+                        'T': ('no_unpack_default', False),
+                        'b': ('unpack_before', True),
+                        'a': ('unpack_after', True), 'q': ('quiet', False)}
+    # Macros of the build environment that affect the parse results, in
+    # addition to the ones referenced in the spec file
+    env_macros = ('_arch', '_target_cpu', '_os', '_vendor', 'dist')
+    # Expansions whose results can't be cached
+    uncacheable_re = re.compile(r'%(\(|\[|{lua:)')
+
+    def __init__(self, filename=None, filedata=None, cache=None, light=False):
+        """
+        @param filename: spec file to parse
+        @type filename: C{str}
+        @param filedata: spec file content to parse
+        @type filedata: C{str}
+        @param cache: cache for the librpm parse results, see L{SpecCache}
+        @type cache: L{SpecCache}
+        @param light: try reading the preamble without librpm first, see
+            L{_read_rpminfo}
+        @type light: C{bool}
+        """
 
-    def __init__(self, filename=None, filedata=None):
-
-        self._content = LinkedList()
+        self._content = LinkedList(indexed=True)
 
         # Check args: only filename or filedata can be given, not both
         if filename is None and filedata is None:
@@ -134,15 +296,18 @@ class SpecFile(object):
             self.specdir = os.path.dirname(os.path.abspath(filename))
             try:
                 with open(filename) as spec_file:
-                    for line in spec_file.readlines():
-                        self._content.append(line)
+                    lines = spec_file.readlines()
             except IOError as err:
                 raise NoSpecError("Unable to read spec file: %s" % err)
         else:
             self.specfile = None
             self.specdir = None
-            for line in filedata.splitlines():
-                self._content.append(line + '\n')
+            lines = [line + '\n' for line in filedata.splitlines()]
+        for line in lines:
+            self._content.append(line)
+        # Original content, for detecting and showing modifications
+        self._orig_lines = lines
+        self._orig_path = os.path.abspath(filename) if filename else None
 
         # Use rpm-python to parse the spec file content
         self._filtertags = ("excludearch", "excludeos", "exclusivearch",
@@ -155,23 +320,26 @@ class SpecFile(object):
                                   'buildsuggests', 'buildsupplements',
                                   'buildenhances', 'collections',
                                   'nosource', 'nopatch')
-        self._specinfo = self._parse_filtered_spec(self._filtertags)
+        self._rpminfo = self._get_rpminfo(cache, light)
 
         # Other initializations
-        source_header = self._specinfo.packages[0].header
-        self.name = source_header[librpm.RPMTAG_NAME]
-        self.upstreamversion = source_header[librpm.RPMTAG_VERSION]
-        self.release = source_header[librpm.RPMTAG_RELEASE]
+        self.name = self._header_value('name')
+        self.upstreamversion = self._header_value('version')
+        self.release = self._header_value('release')
         # rpm-python returns epoch as 'long', convert that to string
-        self.epoch = str(source_header[librpm.RPMTAG_EPOCH]) \
-            if source_header[librpm.RPMTAG_EPOCH] != None else None
-        self.packager = source_header[librpm.RPMTAG_PACKAGER]
+        self.epoch = str(self._header_value('epoch')) \
+            if self._header_value('epoch') != None else None
+        self.packager = self._header_value('packager')
         self._tags = {}
         self._special_directives = defaultdict(list)
         self._gbp_tags = defaultdict(list)
+        self._macros = None
+        # Tags whose values librpm didn't give us
+        self._unexpanded_tags = set()
 
         # Parse extra info from spec file
         self._parse_content()
+        self._expand_tags()
 
         # Find 'Packager' tag. Needed to circumvent a bug in python-rpm where
         # spec.sourceHeader[librpm.RPMTAG_PACKAGER] is not reset when a new spec
@@ -180,19 +348,262 @@ class SpecFile(object):
             self.packager = None
 
         self.orig_src = self._guess_orig_file()
+        self._content.mark_clean()
+
+    @classmethod
+    def _has_forward_macro_refs(cls, lines):
+        """
+        Check if a macro is referenced before it is defined, either by
+        %define/%global or by a tag (e.g. %{version} before 'Version:').
+        Macros defined inside other macros (e.g. I{%{!?foo: %global foo 1}})
+        are not tracked so they are always considered forward references.
+
+        @param lines: spec file content
+        @type lines: C{list} of C{str}
+        @rtype: C{bool}
+        """
+        referenced = set()
+        for line in lines:
+            if cls.inline_define_re.search(line.lstrip(), 1):
+                return True
+            match = cls.macro_def_re.match(line)
+            if match:
+                name = match.group('macro') or match.group('tag').lower()
+                if name in referenced:
+                    return True
+            referenced.update(ref.group('name') for ref in
+                                cls.macro_ref_re.finditer(line))
+        return False
+
+    @classmethod
+    def _parse_define(cls, args):
+        """
+        Parse the arguments of a %define or %global macro
+
+        >>> SpecFile._parse_define('ver 1.0')
+        ('ver', '1.0')
+        >>> SpecFile._parse_define('foo(a) %{-a}')
+        ('foo', None)
+        >>> SpecFile._parse_define('foo') is None
+        True
+
+        @return: name and body of the macro, the body is C{None} for
+            parametric and multi-line macros. C{None} if the arguments are
+            invalid.
+        @rtype: C{tuple}
+        """
+        match = cls.define_args_re.match((args or '').strip())
+        if not match:
+            return None
+        body = match.group('body')
+        if match.group('params') or body.endswith('\\'):
+            body = None
+        return match.group('name'), body
+
+    def _env_macro_names(self, lines):
+        """
+        Names of the macros the spec file references but doesn't define
+        itself, i.e. the ones coming from the rpm build environment
+        """
+        names = set(self.env_macros)
+        defined = set(self.section_identifiers)
+        defined.update(('if', 'ifarch', 'ifnarch', 'ifos', 'ifnos', 'elif',
+                        'else', 'endif', 'define', 'global', 'undefine'))
+        for line in lines:
+            match = self.macro_def_re.match(line)
+            if match:
+                defined.add(match.group('macro') or match.group('tag').lower())
+            names.update(ref.group('name') for ref in
+                            self.macro_ref_re.finditer(line))
+        return sorted(names - defined)
+
+    def _get_rpminfo(self, cache, light):
+        """
+        Get the info librpm gives about the spec file, from the cache if
+        possible. The cache key is the git blob SHA-1 of the content plus
+        the values of the macros coming from the rpm build environment.
+        Spec files using shell or lua expansion are not cached as the
+        results can change at any time.
+        """
+        if light:
+            rpminfo = self._read_rpminfo()
+            if rpminfo:
+                return rpminfo
+        key = None
+        lines = [str(line) for line in self._content]
+        content = ''.join(lines)
+        if cache and self.uncacheable_re.search(content):
+            gbp.log.debug("Spec file uses shell or lua expansion, not using "
+                          "the cache")
+            cache = None
+        if cache:
+            if isinstance(content, six.text_type):
+                content = content.encode('utf-8')
+            blob = hashlib.sha1(('blob %d\0' % len(content)).encode('ascii'))
+            blob.update(content)
+            env = librpm.expandMacro('\n'.join('%%{?%s}' % macro for macro in
+                                         self._env_macro_names(lines)))
+            key = cache.key(blob.hexdigest(), librpm.__version__, env)
+            rpminfo = cache.get(key)
+            if rpminfo:
+                gbp.log.debug("Using cached spec file info %s" % key)
+                return rpminfo
+        rpminfo = self._extract_rpminfo(
+                        self._parse_filtered_spec(self._filtertags))
+        if cache:
+            cache.put(key, rpminfo)
+        return rpminfo
+
+    def _extract_rpminfo(self, specinfo):
+        """
+        Pick the data needed from a librpm spec object into plain python
+        types
+
+        @param specinfo: parsed spec
+        @type specinfo: C{librpm.spec}
+        @return: source package header values of the tags present in the
+            spec file and the list of sources and patches
+        @rtype: C{dict}
+        """
+        header = specinfo.packages[0].header
+        tagnames = set(['name', 'version', 'release', 'epoch', 'packager',
+                        'source', 'patch', 'vcs'])
+        for line in self._content:
+            matchobj = self.tag_re.match(str(line))
+            if matchobj:
+                tagname = matchobj.group('name').lower()
+                tagnames.add(tagname)
+        values = {}
+        for tagname in tagnames:
+            tag = _rpmtag(tagname)
+            if tag is None:
+                continue
+            value = header[tag]
+            values[tagname] = list(value) if isinstance(value, list) else value
+        return {'header': values,
+                'sources': [[str(name), num, typ] for
+                            name, num, typ in specinfo.sources]}
+
+    def _read_rpminfo(self):
+        """
+        Read the info otherwise got from librpm directly from the main
+        preamble of the spec file. Only %define, %global, %undefine and
+        %if/%elif/%else/%endif are understood, see L{MacroTable} for the
+        supported subset of macro expansion. Values of tags other than
+        Name, Version, Release, Epoch, Packager, Source and Patch are left
+        unexpanded if they can't be expanded.
+
+        @return: the same as L{_extract_rpminfo} or C{None} if the spec
+            file needs librpm
+        @rtype: C{dict}
+        """
+        lines = [str(line) for line in self._content]
+        if self._has_forward_macro_refs(lines):
+            return None
+        macros = MacroTable()
+        header = {'source': [], 'patch': []}
+        sources = []
+        # Enclosing conditionals, as (parent active, branch taken) pairs
+        conds = []
+        active = True
+        try:
+            for line in lines:
+                if line.startswith('%'):
+                    match = self.directive_re.match(line)
+                    name = match.group('name') if match else None
+                    args = (match.group('args') or '').strip() if match else ''
+                    if name == 'if':
+                        conds.append((active, active and macros.evaluate(args)))
+                        active = conds[-1][1]
+                    elif name in ('ifarch', 'ifnarch', 'ifos', 'ifnos'):
+                        if active:
+                            raise MacroExpandError("Unsupported %%%s" % name)
+                        conds.append((False, False))
+                    elif name in ('elif', 'elifarch', 'elifos'):
+                        parent, taken = conds[-1]
+                        active = False
+                        if parent and not taken:
+                            if name != 'elif':
+                                raise MacroExpandError("Unsupported %%%s" %
+                                                       name)
+                            active = macros.evaluate(args)
+                            conds[-1] = (parent, active)
+                    elif name == 'else':
+                        active = conds[-1][0] and not conds[-1][1]
+                    elif name == 'endif':
+                        active = conds.pop()[0]
+                    elif not active:
+                        continue
+                    elif name in ('define', 'global'):
+                        define = self._parse_define(args)
+                        if not define:
+                            raise MacroExpandError("Invalid %%%s" % name)
+                        macros.define(define[0], define[1],
+                                      expand=name == 'global')
+                    elif name == 'undefine':
+                        macros.undefine(args)
+                    elif name in self.section_identifiers:
+                        # End of the main preamble
+                        conds = []
+                        break
+                    else:
+                        raise MacroExpandError("Unsupported directive '%s'" %
+                                               line.strip())
+                    continue
+                match = self.tag_re.match(line) if active else None
+                if not match:
+                    continue
+                tagname = match.group('name').lower()
+                value = match.group('value')
+                if tagname in ('source', 'patch'):
+                    if match.group('num'):
+                        num = int(match.group('num'))
+                    else:
+                        num = 0 if tagname == 'source' else pow(2, 31) - 1
+                    header[tagname].append(value)
+                    sources.append([macros.expand(value), num,
+                                    1 if tagname == 'source' else 2])
+                elif tagname in ('nosource', 'nopatch'):
+                    raise MacroExpandError("Unsupported tag '%s'" % tagname)
+                elif tagname in self._listtags:
+                    header[tagname] = []
+                else:
+                    try:
+                        value = macros.expand(value)
+                    except MacroExpandError:
+                        if tagname in ('name', 'version', 'release', 'epoch',
+                                       'packager'):
+                            raise
+                        macros.define(tagname, None)
+                    else:
+                        macros.define(tagname, value)
+                    header[tagname] = int(value) if tagname == 'epoch' else value
+        except (MacroExpandError, AttributeError, IndexError,
+                ValueError) as err:
+            gbp.log.debug("Can't read spec file without librpm: %s" % err)
+            return None
+        if conds or 'name' not in header:
+            return None
+        return {'header': header, 'sources': sources}
+
+    def _header_value(self, tagname):
+        """Get the value of a tag from the source package header"""
+        return self._rpminfo['header'].get(tagname.lower())
 
     def _parse_filtered_spec(self, skip_tags):
         """Parse a filtered spec file in rpm-python"""
         skip_tags = [tag.lower() for tag in skip_tags]
-        with tempfile.NamedTemporaryFile(prefix='gbp') as filtered:
-            filtered.writelines(str(line) for line in self._content
-                    if str(line).split(":")[0].strip().lower() not in skip_tags)
-            filtered.flush()
+        lines = [str(line) for line in self._content
+                 if str(line).split(":")[0].strip().lower() not in skip_tags]
+        with _spec_tmpfile(''.join(lines)) as filtered:
             try:
                 # Parse two times to circumvent a rpm-python problem where
                 # macros are not expanded if used before their definition
-                librpm.spec(filtered.name)
-                return librpm.spec(filtered.name)
+                if self._has_forward_macro_refs(lines):
+                    gbp.log.debug("Forward macro references in spec, parsing "
+                                  "twice")
+                    librpm.spec(filtered)
+                return librpm.spec(filtered)
             except ValueError as err:
                 rpmlog = get_librpm_log()
                 gbp.log.debug("librpm log:\n        %s" %
@@ -218,43 +629,60 @@ class SpecFile(object):
     def ignorepatches(self):
         """Get numbers of ignored patches as a sorted list"""
         if 'ignore-patches' in self._gbp_tags:
-            data = self._gbp_tags['ignore-patches'][-1]['args'].split()
+            data = self._gbp_tags['ignore-patches'][-1].args.split()
             return sorted([int(num) for num in data])
         return []
 
     def _patches(self):
-        """Get all patch tags as a dict"""
-        patches = {}
-        if 'patch' not in self._tags:
-            return {}
-        for patch in self._tags['patch']['lines']:
-            patches[patch['num']] = patch
-        return patches
+        """Get all patch tags as a dict, which must not be modified"""
+        return self._tags['patch'].bynum if 'patch' in self._tags else {}
 
     def _sources(self):
-        """Get all source tags as a dict"""
-        sources = {}
-        if 'source' not in self._tags:
-            return {}
-        for src in self._tags['source']['lines']:
-            sources[src['num']] = src
-        return sources
+        """Get all source tags as a dict, which must not be modified"""
+        return self._tags['source'].bynum if 'source' in self._tags else {}
 
     def sources(self):
         """Get all source tags as a dict"""
-        sources = {}
-        for src in self._sources().values():
-            sources[src['num']] = src['linevalue']
-        return sources
+        return dict((num, src.linevalue) for
+                    num, src in self._sources().items())
+
+    def patches(self):
+        """Get all patch tags as a dict"""
+        return dict((num, patch.linevalue) for
+                    num, patch in self._patches().items())
 
-    def _macro_replace(self, matchobj):
-        macro_dict = {'name': self.name,
-                      'version': self.upstreamversion,
-                      'release': self.release}
+    @property
+    def macros(self):
+        """
+        Table of the macros defined in the spec file: name, version, release
+        and epoch of the package plus the %define and %global macros. As
+        conditionals are not evaluated, a macro defined more than once with
+        different values, or undefined anywhere, can't be expanded.
 
-        if matchobj.group(2) in macro_dict:
-            return macro_dict[matchobj.group(2)]
-        raise MacroExpandError("Unknown macro '%s'" % matchobj.group(0))
+        @rtype: L{MacroTable}
+        """
+        if self._macros is None:
+            definitions = {}
+            records = (self._special_directives['define'] +
+                       self._special_directives['global'])
+            for record in records:
+                define = self._parse_define(record.args)
+                if not define:
+                    continue
+                name, body = define
+                if definitions.get(name, body) != body:
+                    body = None
+                definitions[name] = body
+            for record in self._special_directives['undefine']:
+                definitions[(record.args or '').strip()] = None
+            definitions.update(name=self.name, version=self.upstreamversion,
+                               release=self.release)
+            if self.epoch is not None:
+                definitions['epoch'] = self.epoch
+            self._macros = MacroTable()
+            for name, body in definitions.items():
+                self._macros.define(name, body)
+        return self._macros
 
     def macro_expand(self, text):
         """
@@ -264,18 +692,65 @@ class SpecFile(object):
         @type text: C{str}
         @return: text with macros expanded
         @rtype: C{str}
+        @raises MacroExpandError: if some macro could not be expanded, see
+            L{macros}
+        """
+        return self.macros.expand(text)
+
+    def _expand_tags(self):
+        """Expand macros in the tag values librpm didn't give"""
+        for tagname in self._unexpanded_tags:
+            tag = self._tags[tagname]
+            if tag.value and '%' in tag.value:
+                try:
+                    tag.value = self.macro_expand(tag.value)
+                except MacroExpandError as err:
+                    gbp.log.debug("Leaving '%s:' unexpanded: %s" %
+                                  (tagname, err))
+
+    @property
+    def modified(self):
+        """Whether the spec has been changed since it was read or written"""
+        return self._content.modified
+
+    def diff(self, context=3):
         """
-        # regexp to match '%{macro}' and '%macro'
-        macro_re = re.compile(r'%({)?(?P<macro_name>[a-z_][a-z0-9_]*)(?(1)})', flags=re.I)
-        return macro_re.sub(self._macro_replace, text)
+        Get the changes made to the spec since it was read or written
+
+        @param context: number of context lines
+        @type context: C{int}
+        @return: the changes as a unified diff, empty if there are none
+        @rtype: C{list} of C{str}
+        """
+        if not self._content.modified:
+            return []
+        name = self.specfile or 'spec'
+        return list(difflib.unified_diff(self._orig_lines,
+                                         [str(line) for line in self._content],
+                                         'a/' + name, 'b/' + name, n=context))
 
     def write_spec_file(self):
         """
-        Write, possibly updated, spec to disk
+        Write, possibly updated, spec to disk. The file is replaced
+        atomically and not touched at all if it was not changed.
+
+        @return: whether the file was written
+        @rtype: C{bool}
         """
-        with open(os.path.join(self.specdir, self.specfile), 'w') as spec_file:
-            for line in self._content:
-                spec_file.write(str(line))
+        path = os.path.abspath(os.path.join(self.specdir, self.specfile))
+        unchanged = path == self._orig_path and os.path.exists(path)
+        if unchanged and not self._content.modified:
+            return False
+        lines = [str(line) for line in self._content]
+        if unchanged and lines == self._orig_lines:
+            self._content.mark_clean()
+            return False
+
+        replace_file(path, lambda spec_file: spec_file.write(''.join(lines)))
+        self._content.mark_clean()
+        self._orig_lines = lines
+        self._orig_path = path
+        return True
 
     def _parse_tag(self, lineobj):
         """Parse tag line"""
@@ -296,11 +771,7 @@ class SpecFile(object):
             tagnum = -1 if tagnum is None else tagnum
 
         # Record all tag locations
-        try:
-            header = self._specinfo.packages[0].header
-            tagvalue = header[getattr(librpm, 'RPMTAG_%s' % tagname.upper())]
-        except AttributeError:
-            tagvalue = None
+        tagvalue = self._header_value(tagname)
         # We don't support "multivalue" tags like "Provides:" or "SourceX:"
         # Rpm python doesn't support many of these, thus the explicit list
         if isinstance(tagvalue, six.integer_types):
@@ -313,45 +784,70 @@ class SpecFile(object):
                                'autoreqprov') + self._filtertags:
                 gbp.log.warn("BUG: '%s:' tag not found by rpm" % tagname)
             tagvalue = matchobj.group('value')
-        linerecord = {'line': lineobj,
-                      'num': tagnum,
-                      'linevalue': matchobj.group('value')}
+            self._unexpanded_tags.add(tagname)
         if tagname in self._tags:
-            self._tags[tagname]['value'] = tagvalue
-            self._tags[tagname]['lines'].append(linerecord)
+            self._tags[tagname].value = tagvalue
         else:
-            self._tags[tagname] = {'value': tagvalue, 'lines': [linerecord]}
+            self._tags[tagname] = Tag(tagvalue)
+        self._tags[tagname].add(TagLine(lineobj, tagnum,
+                                        matchobj.group('value')))
 
         return tagname
 
     @staticmethod
-    def _patch_macro_opts(args):
-        """Parse arguments of the '%patch' macro"""
+    def _parse_macro_opts(args, optspec):
+        """
+        Parse the short options of a macro line the way optparse does, but
+        without the cost of setting up an OptionParser for every line.
+        Unknown options and positional arguments are ignored.
+
+        >>> opts = SpecFile._parse_macro_opts('-qcn foo -a1 -T',
+        ...                                   SpecFile.setup_macro_opts)
+        >>> opts.quiet, opts.create_dir, opts.name, opts.unpack_after
+        (True, True, 'foo', '1')
+        >>> opts.no_unpack_default, opts.unpack_before
+        (True, None)
+
+        @param args: arguments of the macro
+        @type args: C{str}
+        @param optspec: option letter to destination attribute and whether
+            the option takes a value
+        @type optspec: C{dict}
+        @return: the options as attributes
+        @rtype: L{MacroOpts}
+        """
+        opts = MacroOpts(dest for dest, _value in optspec.values())
+        arglist = args.split() if args else []
+        ind = 0
+        while ind < len(arglist):
+            arg = arglist[ind]
+            ind += 1
+            if len(arg) < 2 or arg[0] != '-' or arg[1] == '-':
+                continue
+            for pos in range(1, len(arg)):
+                if arg[pos] not in optspec:
+                    break
+                dest, has_value = optspec[arg[pos]]
+                if not has_value:
+                    setattr(opts, dest, True)
+                    continue
+                value = arg[pos + 1:]
+                if not value and ind < len(arglist):
+                    value = arglist[ind]
+                    ind += 1
+                setattr(opts, dest, value or None)
+                break
+        return opts
 
-        patchparser = OptionParser()
-        patchparser.add_option("-p", dest="strip")
-        patchparser.add_option("-s", dest="silence")
-        patchparser.add_option("-P", dest="patchnum")
-        patchparser.add_option("-b", dest="backup")
-        patchparser.add_option("-E", dest="removeempty")
-        arglist = args.split()
-        return patchparser.parse_args(arglist)[0]
+    @classmethod
+    def _patch_macro_opts(cls, args):
+        """Parse arguments of the '%patch' macro"""
+        return cls._parse_macro_opts(args, cls.patch_macro_opts)
 
-    @staticmethod
-    def _setup_macro_opts(args):
+    @classmethod
+    def _setup_macro_opts(cls, args):
         """Parse arguments of the '%setup' macro"""
-
-        setupparser = OptionParser()
-        setupparser.add_option("-n", dest="name")
-        setupparser.add_option("-c", dest="create_dir", action="store_true")
-        setupparser.add_option("-D", dest="no_delete_dir", action="store_true")
-        setupparser.add_option("-T", dest="no_unpack_default",
-                               action="store_true")
-        setupparser.add_option("-b", dest="unpack_before")
-        setupparser.add_option("-a", dest="unpack_after")
-        setupparser.add_option("-q", dest="quiet", action="store_true")
-        arglist = args.split()
-        return setupparser.parse_args(arglist)[0]
+        return cls._parse_macro_opts(args, cls.setup_macro_opts)
 
     def _parse_directive(self, lineobj):
         """Parse special directive/scriptlet/macro lines"""
@@ -374,11 +870,9 @@ class SpecFile(object):
                 directiveid = -1
 
         # Record special directive/scriptlet/macro locations
-        if directivename in self.section_identifiers + ('setup', 'patch'):
-            linerecord = {'line': lineobj,
-                          'id': directiveid,
-                          'args': matchobj.group('args')}
-            self._special_directives[directivename].append(linerecord)
+        if directivename in self._recorded_directives:
+            self._special_directives[directivename].append(
+                    DirectiveLine(lineobj, directiveid, matchobj.group('args')))
         return directivename
 
     def _parse_gbp_tag(self, linenum, lineobj):
@@ -395,7 +889,7 @@ class SpecFile(object):
                 args = matchobj.group('args').strip()
             else:
                 args = None
-            record = {'line': lineobj, 'args': args}
+            record = GbpTagLine(lineobj, args)
             self._gbp_tags[gbptagname].append(record)
             return gbptagname
 
@@ -405,28 +899,29 @@ class SpecFile(object):
         """
         Go through spec file content line-by-line and (re-)parse info from it
         """
+        # Dispatch on the first character: tags start with a letter,
+        # directives with '%' and gbp tags (comments) with '#' or whitespace
         in_preamble = True
         for linenum, lineobj in enumerate(self._content):
-            matched = False
-            if in_preamble:
-                if self._parse_tag(lineobj):
-                    continue
-            matched = self._parse_directive(lineobj)
-            if matched:
+            first = str(lineobj)[:1]
+            if first == '%':
+                matched = self._parse_directive(lineobj)
                 if matched in self.section_identifiers:
                     in_preamble = False
-                continue
-            self._parse_gbp_tag(linenum, lineobj)
+            elif first == '#' or first.isspace():
+                self._parse_gbp_tag(linenum, lineobj)
+            elif in_preamble and first.isalpha():
+                self._parse_tag(lineobj)
 
         # Update sources info (basically possible macros expanded by rpm)
         # And, double-check that we parsed spec content correctly
         patches = self._patches()
         sources = self._sources()
-        for name, num, typ in self._specinfo.sources:
+        for name, num, typ in self._rpminfo['sources']:
             # workaround rpm parsing bug
             if typ == 1 or typ == 9:
                 if num in sources:
-                    sources[num]['linevalue'] = name
+                    sources[num].linevalue = name
                 else:
                     gbp.log.err("BUG: failed to parse all 'Source' tags!")
             elif typ == 2 or typ == 10:
@@ -435,7 +930,7 @@ class SpecFile(object):
                 if num >= pow(2,30):
                     num = -1
                 if num in patches:
-                    patches[num]['linevalue'] = name
+                    patches[num].linevalue = name
                 else:
                     gbp.log.err("BUG: failed to parse all 'Patch' tags!")
 
@@ -447,16 +942,11 @@ class SpecFile(object):
             gbp.log.warn("Trying to delete non-existent tag '%s:'" % tag)
             return None
 
-        sparedlines = []
         prev = None
-        for line in self._tags[key]['lines']:
-            if line['num'] == num:
-                gbp.log.debug("Removing '%s:' tag from spec" % tagname)
-                prev = self._content.delete(line['line'])
-            else:
-                sparedlines.append(line)
-        self._tags[key]['lines'] = sparedlines
-        if not self._tags[key]['lines']:
+        for line in self._tags[key].remove(num):
+            gbp.log.debug("Removing '%s:' tag from spec" % tagname)
+            prev = self._content.delete(line.line)
+        if not self._tags[key].lines:
             self._tags.pop(key)
         return prev
 
@@ -469,11 +959,7 @@ class SpecFile(object):
             raise GbpError("Cannot set empty value to '%s:' tag" % tag)
 
         # Check type of tag, we don't support values for 'multivalue' tags
-        try:
-            header = self._specinfo.packages[0].header
-            tagvalue = header[getattr(librpm, 'RPMTAG_%s' % tagname.upper())]
-        except AttributeError:
-            tagvalue = None
+        tagvalue = self._header_value(tagname)
         tagvalue = None if type(tagvalue) is list else value
 
         # Try to guess the correct indentation from the previous or next tag
@@ -484,22 +970,20 @@ class SpecFile(object):
         indent = 12 if not match else len(match.group(1))
         text = '%-*s%s\n' % (indent, '%s:' % tagname, value)
         if key in self._tags:
-            self._tags[key]['value'] = tagvalue
-            for line in reversed(self._tags[key]['lines']):
-                if line['num'] == num:
-                    gbp.log.debug("Updating '%s:' tag in spec" % tagname)
-                    line['line'].set_data(text)
-                    line['linevalue'] = value
-                    return line['line']
+            self._tags[key].value = tagvalue
+            line = self._tags[key].bynum.get(num)
+            if line:
+                gbp.log.debug("Updating '%s:' tag in spec" % tagname)
+                line.line.set_data(text)
+                line.linevalue = value
+                return line.line
 
         gbp.log.debug("Adding '%s:' tag after '%s...' line in spec" %
                       (tagname, str(insertafter)[0:20]))
         line = self._content.insert_after(insertafter, text)
-        linerec = {'line': line, 'num': num, 'linevalue': value}
-        if key in self._tags:
-            self._tags[key]['lines'].append(linerec)
-        else:
-            self._tags[key] = {'value': tagvalue, 'lines': [linerec]}
+        if key not in self._tags:
+            self._tags[key] = Tag(tagvalue)
+        self._tags[key].add(TagLine(line, num, value))
         return line
 
     def set_tag(self, tag, num, value, insertafter=None):
@@ -511,7 +995,7 @@ class SpecFile(object):
                 insertafter = key
             elif not insertafter in self._tags:
                 insertafter = 'name'
-            after_line = self._tags[insertafter]['lines'][-1]['line']
+            after_line = self._last_line(self._tags[insertafter].lines)
             if value:
                 self._set_tag(tag, num, value, after_line)
             elif key in self._tags:
@@ -529,9 +1013,9 @@ class SpecFile(object):
         sparedlines = []
         prev = None
         for line in self._special_directives[key]:
-            if line['id'] == identifier:
+            if line.id == identifier:
                 gbp.log.debug("Removing '%s' macro from spec" % fullname)
-                prev = self._content.delete(line['line'])
+                prev = self._content.delete(line.line)
             else:
                 sparedlines.append(line)
         self._special_directives[key] = sparedlines
@@ -549,20 +1033,43 @@ class SpecFile(object):
         updated = 0
         text = "%%%s%d %s\n" % (name, identifier, args)
         for line in self._special_directives[key]:
-            if line['id'] == identifier:
+            if line.id == identifier:
                 gbp.log.debug("Updating '%s' macro in spec" % fullname)
-                line['args'] = args
-                line['line'].set_data(text)
-                ret = line['line']
+                line.args = args
+                line.line.set_data(text)
+                ret = line.line
                 updated += 1
         if not updated:
             gbp.log.debug("Adding '%s' macro after '%s...' line in spec" %
                           (fullname, str(insertafter)[0:20]))
             ret = self._content.insert_after(insertafter, text)
-            linerec = {'line': ret, 'id': identifier, 'args': args}
-            self._special_directives[key].append(linerec)
+            self._special_directives[key].append(
+                    DirectiveLine(ret, identifier, args))
         return ret
 
+    def _last_line(self, records):
+        """Get the line of the record located last in the spec file"""
+        last = None
+        for record in records:
+            if last is None or self._content.is_before(last, record.line):
+                last = record.line
+        return last
+
+    def _next_section(self, line):
+        """
+        Get the line starting the section that follows the given line, or
+        C{None} if the line is in the last section
+        """
+        following = None
+        for name in self.section_identifiers:
+            for record in self._special_directives.get(name, ()):
+                node = record.line
+                if (self._content.is_before(line, node) and
+                        (following is None or
+                         self._content.is_before(node, following))):
+                    following = node
+        return following
+
     def _set_section(self, name, text):
         """Update/create a complete section in spec file."""
         if name not in self.section_identifiers:
@@ -572,18 +1079,15 @@ class SpecFile(object):
             if len(self._special_directives[name]) > 1:
                 raise GbpError("Multiple %%%s sections found, don't know "
                                "which to update" % name)
-            line = self._special_directives[name][0]['line']
+            line = self._special_directives[name][0].line
             gbp.log.debug("Removing content of %s section" % name)
-            while line.next:
-                match = self.directive_re.match(str(line.next))
-                if match and match.group('name') in self.section_identifiers:
-                    break
+            end = self._next_section(line)
+            while line.next is not end:
                 self._content.delete(line.next)
         else:
             gbp.log.debug("Adding %s section to the end of spec file" % name)
             line = self._content.append('%%%s\n' % name)
-            linerec = {'line': line, 'id': None, 'args': None}
-            self._special_directives[name] = [linerec]
+            self._special_directives[name] = [DirectiveLine(line, None, None)]
         # Add new lines
         gbp.log.debug("Updating content of %s section" % name)
         for linetext in text.splitlines():
@@ -595,16 +1099,14 @@ class SpecFile(object):
 
     def get_changelog(self):
         """Get the %changelog section"""
-        text = ''
+        lines = []
         if 'changelog' in self._special_directives:
-            line = self._special_directives['changelog'][0]['line']
-            while line.next:
+            line = self._special_directives['changelog'][0].line
+            end = self._next_section(line)
+            while line.next is not end:
                 line = line.next
-                match = self.directive_re.match(str(line))
-                if match and match.group('name') in self.section_identifiers:
-                    break
-                text += str(line)
-        return text
+                lines.append(str(line))
+        return ''.join(lines)
 
     def update_patches(self, patches, commands):
         """Update spec with new patch tags and patch macros"""
@@ -613,9 +1115,9 @@ class SpecFile(object):
         macro_prev = None
         ignored = self.ignorepatches
         # Remove 'Patch:̈́' tags
-        for tag in self._patches().values():
-            if not tag['num'] in ignored:
-                tag_prev = self._delete_tag('patch', tag['num'])
+        for num in list(self._patches()):
+            if not num in ignored:
+                tag_prev = self._delete_tag('patch', num)
                 # Remove a preceding comment if it seems to originate from GBP
                 if re.match("^\s*#.*patch.*auto-generated",
                             str(tag_prev), flags=re.I):
@@ -623,8 +1125,8 @@ class SpecFile(object):
 
         # Remove '%patch:' macros
         for macro in self._special_directives['patch']:
-            if not macro['id'] in ignored:
-                macro_prev = self._delete_special_macro('patch', macro['id'])
+            if not macro.id in ignored:
+                macro_prev = self._delete_special_macro('patch', macro.id)
                 # Remove surrounding if-else
                 macro_next = macro_prev.next
                 if (str(macro_prev).startswith('%if') and
@@ -647,20 +1149,20 @@ class SpecFile(object):
             tag_line = tag_prev
         elif 'patch' in self._tags:
             gbp.log.debug("Adding new 'Patch' tags after the last 'Patch' tag")
-            tag_line = self._tags['patch']['lines'][-1]['line']
+            tag_line = self._last_line(self._tags['patch'].lines)
         elif 'source' in self._tags:
             gbp.log.debug("Didn't find any old 'Patch' tags, adding new "
                           "patches after the last 'Source' tag.")
-            tag_line = self._tags['source']['lines'][-1]['line']
+            tag_line = self._last_line(self._tags['source'].lines)
         else:
             gbp.log.debug("Didn't find any old 'Patch' or 'Source' tags, "
                           "adding new patches after the last 'Name' tag.")
-            tag_line = self._tags['name']['lines'][-1]['line']
+            tag_line = self._last_line(self._tags['name'].lines)
 
         # Determine where to add %patch macro lines
         if 'patch-macros' in self._gbp_tags:
             gbp.log.debug("Adding '%patch' macros after the start marker")
-            macro_line = self._gbp_tags['patch-macros'][-1]['line']
+            macro_line = self._last_line(self._gbp_tags['patch-macros'])
         elif macro_prev:
             gbp.log.debug("Adding '%patch' macros in place of the removed "
                           "macros")
@@ -668,15 +1170,15 @@ class SpecFile(object):
         elif self._special_directives['patch']:
             gbp.log.debug("Adding new '%patch' macros after the last existing"
                           "'%patch' macro")
-            macro_line = self._special_directives['patch'][-1]['line']
+            macro_line = self._last_line(self._special_directives['patch'])
         elif self._special_directives['setup']:
             gbp.log.debug("Didn't find any old '%patch' macros, adding new "
                           "patches after the last '%setup' macro")
-            macro_line = self._special_directives['setup'][-1]['line']
+            macro_line = self._last_line(self._special_directives['setup'])
         elif self._special_directives['prep']:
             gbp.log.warn("Didn't find any old '%patch' or '%setup' macros, "
                          "adding new patches directly after '%prep' directive")
-            macro_line = self._special_directives['prep'][-1]['line']
+            macro_line = self._last_line(self._special_directives['prep'])
         else:
             raise GbpError("Couldn't determine where to add '%patch' macros")
 
@@ -710,8 +1212,8 @@ class SpecFile(object):
             tags = self._patches()
             applied = []
             for macro in self._special_directives['patch']:
-                if macro['id'] in tags:
-                    applied.append((macro['id'], macro['args']))
+                if macro.id in tags:
+                    applied.append((macro.id, macro.args))
             ignored = set() if ignored else set(self.ignorepatches)
 
             # Put all patches that are applied first in the series
@@ -719,7 +1221,7 @@ class SpecFile(object):
                 if num not in ignored:
                     opts = self._patch_macro_opts(args)
                     strip = int(opts.strip) if opts.strip else 0
-                    filename = os.path.basename(tags[num]['linevalue'])
+                    filename = os.path.basename(tags[num].linevalue)
                     series.append(Patch(os.path.join(self.specdir, filename),
                                         strip=strip))
             # Finally, append all unapplied patches to the series, if requested
@@ -728,7 +1230,7 @@ class SpecFile(object):
                 unapplied = set(tags.keys()).difference(applied_nums)
                 for num in sorted(unapplied):
                     if num not in ignored:
-                        filename = os.path.basename(tags[num]['linevalue'])
+                        filename = os.path.basename(tags[num].linevalue)
                         series.append(Patch(os.path.join(self.specdir,
                                                          filename), strip=0))
         return series
@@ -745,7 +1247,7 @@ class SpecFile(object):
 
         # Refine our guess about the prefix
         for macro in self._special_directives['setup']:
-            args = macro['args']
+            args = macro.args
             opts = self._setup_macro_opts(args)
             srcnum = None
             if opts.no_unpack_default:
@@ -832,7 +1334,7 @@ def guess_spec_fn(file_list, preferred_name=None):
     return specs[0]
 
 
-def guess_spec(topdir, recursive=True, preferred_name=None):
+def guess_spec(topdir, recursive=True, preferred_name=None, light=False):
     """Guess a spec file"""
     file_list = []
     if not topdir:
@@ -844,10 +1346,12 @@ def guess_spec(topdir, recursive=True, preferred_name=None):
         # Skip .git dir in any case
         if '.git' in dirs:
             dirs.remove('.git')
-    return SpecFile(os.path.abspath(guess_spec_fn(file_list, preferred_name)))
+    return SpecFile(os.path.abspath(guess_spec_fn(file_list, preferred_name)),
+                    light=light)
 
 
-def guess_spec_repo(repo, treeish, topdir='', recursive=True, preferred_name=None):
+def guess_spec_repo(repo, treeish, topdir='', recursive=True, preferred_name=None,
+                    light=False):
     """
     Try to find/parse the spec file from a given git treeish.
     """
@@ -859,13 +1363,14 @@ def guess_spec_repo(repo, treeish, topdir='', recursive=True, preferred_name=Non
         raise NoSpecError("Cannot find spec file from treeish %s, Git error: %s"
                             % (treeish, err))
     spec_path = guess_spec_fn(file_list, preferred_name)
-    return spec_from_repo(repo, treeish, spec_path)
+    return spec_from_repo(repo, treeish, spec_path, light)
 
 
-def spec_from_repo(repo, treeish, spec_path):
+def spec_from_repo(repo, treeish, spec_path, light=False):
     """Get and parse a spec file from a give Git treeish"""
     try:
-        spec = SpecFile(filedata=repo.show('%s:%s' % (treeish, spec_path)))
+        spec = SpecFile(filedata=repo.show('%s:%s' % (treeish, spec_path)),
+                        cache=SpecCache.for_repo(repo), light=light)
         spec.specdir = os.path.dirname(spec_path)
         spec.specfile = os.path.basename(spec_path)
         return spec
@@ -0,0 +1,155 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2016 Intel Corporation <markus.lehtonen@linux.intel.com>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, please see
+#    <http://www.gnu.org/licenses/>
+"""Parsing of a large number of spec files in worker processes"""
+
+import collections
+import multiprocessing
+import os
+
+from gbp.errors import GbpError
+from gbp.git import GitRepository
+from gbp.rpm import NoSpecError, SpecFile, guess_spec, guess_spec_repo
+from gbp.rpm.lib_rpm import librpm
+
+
+class SpecSummary(object):
+    """
+    Picklable summary of a parsed spec file, see L{parse_specs}
+
+    @ivar item: the item given to L{parse_specs}, with repositories
+        replaced by their path
+    @ivar error: error message if parsing failed, C{None} otherwise
+    """
+    def __init__(self, item, spec=None, error=None):
+        self.item = item
+        self.error = error
+        self.specfile = self.specdir = None
+        self.name = self.upstreamversion = self.release = self.epoch = None
+        self.version = {}
+        self.sources = {}
+        self.patches = {}
+        self.orig_src = None
+        if spec is not None:
+            self.specfile = spec.specfile
+            self.specdir = spec.specdir
+            self.name = spec.name
+            self.upstreamversion = spec.upstreamversion
+            self.release = spec.release
+            self.epoch = spec.epoch
+            self.version = spec.version
+            self.sources = spec.sources()
+            self.patches = spec.patches()
+            self.orig_src = dict(spec.orig_src) if spec.orig_src else None
+
+    def __repr__(self):
+        if self.error:
+            return "<SpecSummary %r: error %r>" % (self.item, self.error)
+        return "<SpecSummary %r: %s %s>" % (self.item, self.name,
+                                           self.upstreamversion)
+
+
+# Per-process state of the workers
+_worker_repos = {}
+
+
+def _init_worker():
+    """
+    Initialize a worker process. librpm is loaded on first use and then
+    reused for all the spec files the worker parses.
+    """
+    if librpm.loaded:
+        # Don't share the log with the parent process
+        librpm.new_log()
+
+
+def _reset_macros():
+    """
+    Forget the macros defined by previously parsed spec files, librpm
+    keeps them in its global state
+    """
+    if librpm.loaded and hasattr(librpm, 'reloadConfig'):
+        librpm.reloadConfig()
+
+
+def _parse_one(item, light):
+    """Parse one spec file, run in a worker process"""
+    _reset_macros()
+    repo = None
+    try:
+        if isinstance(item, tuple):
+            repo_path, treeish = item
+            if repo_path not in _worker_repos:
+                _worker_repos[repo_path] = GitRepository(repo_path)
+            repo = _worker_repos[repo_path]
+            spec = guess_spec_repo(repo, treeish, light=light)
+        elif os.path.isdir(item):
+            spec = guess_spec(item, light=light)
+        else:
+            spec = SpecFile(item, light=light)
+        return SpecSummary(item, spec)
+    except (GbpError, NoSpecError) as err:
+        return SpecSummary(item, error=str(err))
+    except Exception as err:
+        # One broken item must not abort the whole batch
+        return SpecSummary(item, error="%s: %s" % (err.__class__.__name__,
+                                                   err))
+    finally:
+        # Don't keep cat-file processes running for every repository the
+        # worker has seen
+        if repo is not None:
+            repo.close()
+
+
+def parse_specs(items, processes=None, max_pending=None, light=False):
+    """
+    Parse many spec files in a pool of worker processes. librpm keeps the
+    macros in global state so the parsing can't be done in threads.
+
+    @param items: the spec files to parse, each being a path to a spec file,
+        a directory to search for a spec file, or a (repository, treeish)
+        pair where the repository is a L{GitRepository} or its path
+    @type items: iterable
+    @param processes: number of worker processes, the number of CPUs by
+        default
+    @type processes: C{int}
+    @param max_pending: maximum number of items handed to the workers but
+        not yet returned, limits the memory used for large batches
+    @type max_pending: C{int}
+    @param light: parse only the preamble if possible, see L{SpecFile}
+    @type light: C{bool}
+    @return: summaries of the spec files, in the order of the items.
+        Failures are reported in L{SpecSummary.error} instead of raising.
+    @rtype: generator of L{SpecSummary}
+    """
+    processes = processes or multiprocessing.cpu_count()
+    max_pending = max_pending or 2 * processes
+    pool = multiprocessing.Pool(processes, initializer=_init_worker)
+    pending = collections.deque()
+    try:
+        for item in items:
+            if isinstance(item, tuple) and isinstance(item[0], GitRepository):
+                item = (item[0].path, item[1])
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(_parse_one, (item, light)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
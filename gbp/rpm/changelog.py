@@ -18,6 +18,7 @@
 
 import datetime
 import re
+import shutil
 
 import gbp.log
 
@@ -73,34 +74,64 @@ class _ChangelogEntry(object):
         else:
             self._text = text
         # Strip trailing empty lines
-        while text and not text[-1].strip():
-            text.pop()
+        while self._text and not self._text[-1].strip():
+            self._text.pop()
 
     def __str__(self):
         # Currently no (re-)formatting, just raw text
-        string = ""
-        for line in self._text:
-            string += line + '\n'
-        return string
+        return ''.join(line + '\n' for line in self._text)
 
 
 class _ChangelogSection(object):
-    """One section (set of changes) in an RPM changelog"""
+    """
+    One section (set of changes) in an RPM changelog. A section created by
+    the parser keeps its raw text and only parses the entries when they are
+    accessed. An untouched section is written back as is.
+    """
 
     def __init__(self, pkgpolicy, *args, **kwargs):
         self._pkgpolicy = pkgpolicy
-        self.header = _ChangelogHeader(pkgpolicy, *args, **kwargs)
-        self.entries = []
+        self._header = _ChangelogHeader(pkgpolicy, *args, **kwargs)
+        self._entries = []
         self._trailer = '\n'
-
+        # Original text of the section, if not modified
+        self._raw_text = None
+        # Function for parsing the entries on first access
+        self._parse_entries = None
 
     def __str__(self):
-        text = str(self.header)
-        for entry in self.entries:
-            text += str(entry)
+        if self._raw_text is not None:
+            return self._raw_text
         # Add "section separator"
-        text += self._trailer
-        return text
+        return ''.join([str(self.header)] +
+                       [str(entry) for entry in self.entries] +
+                       [self._trailer])
+
+    @property
+    def header(self):
+        """Header of the section"""
+        return self._header
+
+    @header.setter
+    def header(self, header):
+        self._header = header
+        self._raw_text = None
+
+    @property
+    def entries(self):
+        """Changelog entries of the section"""
+        if self._parse_entries is not None:
+            self._entries = self._parse_entries()
+            self._parse_entries = None
+        # The entries list may be modified by the caller
+        self._raw_text = None
+        return self._entries
+
+    @entries.setter
+    def entries(self, entries):
+        self._entries = entries
+        self._parse_entries = None
+        self._raw_text = None
 
     def set_header(self, *args, **kwargs):
         """Change the section header"""
@@ -112,18 +143,70 @@ class _ChangelogSection(object):
         return entry
 
 
+class _ChangelogTail(object):
+    """
+    The unparsed rest of a changelog file, following the sections that
+    were read. The text is only read from the file when needed.
+    """
+
+    def __init__(self, fobj, offset):
+        self._fobj = fobj
+        self._offset = offset
+
+    def __str__(self):
+        self._fobj.seek(self._offset)
+        return self._fobj.read()
+
+    def copy_to(self, fobj):
+        """Copy the text into another file object, in chunks"""
+        self._fobj.seek(self._offset)
+        shutil.copyfileobj(self._fobj, fobj)
+
+    def close(self):
+        """Close the file the text is read from"""
+        self._fobj.close()
+
+
 class Changelog(object):
-    """An RPM changelog"""
+    """
+    An RPM changelog
+
+    @ivar tail: the rest of the changelog that was not split into
+        sections, see L{ChangelogParser.raw_parse_file}
+    """
 
     def __init__(self, pkgpolicy):
         self._pkgpolicy = pkgpolicy
         self.sections = []
+        self.tail = None
 
     def __str__(self):
-        string = ""
+        text = ''.join(str(section) for section in self.sections)
+        if self.tail is not None:
+            text += str(self.tail)
+        return text
+
+    def write(self, fobj):
+        """
+        Write the changelog into a file object. The unparsed tail is copied
+        as is, without reading all of it into memory.
+
+        @param fobj: file object to write to, must not be the file the
+            changelog was read from
+        @type fobj: C{file}
+        """
         for section in self.sections:
-            string += str(section)
-        return string
+            fobj.write(str(section))
+        if self.tail is not None:
+            self.tail.copy_to(fobj)
+
+    def close(self):
+        """
+        Release the file the unparsed tail is read from, the changelog
+        can't be written or converted to text after this
+        """
+        if self.tail is not None:
+            self.tail.close()
 
     def create_entry(self, *args, **kwargs):
         """Create and return new entry object"""
@@ -136,6 +219,75 @@ class Changelog(object):
         return section
 
 
+# Compiled changelog regexps, per changelog policy class
+_policy_regexps = {}
+
+
+def _compile_policy_regexps(policy):
+    """
+    Compile the changelog regexps of a changelog policy, only once for
+    each policy class
+
+    @param policy: the changelog policy, e.g. C{RpmPkgPolicy.Changelog}
+    @return: the compiled regexps, by the name of the policy attribute
+    @rtype: C{dict}
+    """
+    if policy not in _policy_regexps:
+        _policy_regexps[policy] = {
+            'section_match_re': re.compile(policy.section_match_re,
+                                           re.M | re.S),
+            'section_split_re': re.compile(policy.section_split_re,
+                                           re.M | re.S),
+            'header_split_re': re.compile(policy.header_split_re, re.M),
+            'header_name_split_re': re.compile(policy.header_name_split_re),
+            'body_name_re': re.compile(policy.body_name_re)}
+    return _policy_regexps[policy]
+
+
+_header_time_re = re.compile(r'^(?P<wday>[A-Za-z]{3})\s+(?P<month>[A-Za-z]{3})'
+                             r'\s+(?P<day>[0-9]{1,2})\s+(?P<year>[0-9]{4})$')
+_weekdays = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+_months = dict((name, num + 1) for num, name in
+               enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul',
+                          'aug', 'sep', 'oct', 'nov', 'dec')))
+# Parsed timestamps, by their text
+_header_times = {}
+
+
+def _parse_header_time(text):
+    """
+    Parse the timestamp of a changelog header, i.e. a date in the
+    I{%a %b %d %Y} format. Dates with English day and month names are
+    parsed directly, others with strptime. Results are memoized.
+
+    >>> _parse_header_time('Wed Jan 29 2014')
+    datetime.datetime(2014, 1, 29, 0, 0)
+    >>> _parse_header_time('Wed Jan 32 2014')
+    Traceback (most recent call last):
+    ...
+    ValueError: day is out of range for month
+
+    @param text: the timestamp
+    @type text: C{str}
+    @rtype: C{datetime.datetime}
+    @raises ValueError: if the timestamp is invalid
+    """
+    if text in _header_times:
+        return _header_times[text]
+    match = _header_time_re.match(text)
+    if (match and match.group('wday').lower() in _weekdays and
+            match.group('month').lower() in _months):
+        time = datetime.datetime(int(match.group('year')),
+                                 _months[match.group('month').lower()],
+                                 int(match.group('day')))
+    else:
+        time = datetime.datetime.strptime(text, "%a %b %d %Y")
+    if len(_header_times) >= 4096:
+        _header_times.clear()
+    _header_times[text] = time
+    return time
+
+
 class ChangelogParser(object):
     """Parser for RPM changelogs"""
 
@@ -146,48 +298,103 @@ class ChangelogParser(object):
         self.header_split_re = pkgpolicy.Changelog.header_split_re
         self.header_name_split_re = pkgpolicy.Changelog.header_name_split_re
         self.body_name_re = pkgpolicy.Changelog.body_name_re
+        self._regexps = _compile_policy_regexps(pkgpolicy.Changelog)
 
-    def raw_parse_string(self, string):
-        """Parse changelog - only splits out raw changelog sections."""
-        changelog = Changelog(self._pkgpolicy)
-        ch_section = ""
-        for line in string.splitlines():
-            if re.match(self.section_match_re, line, re.M | re.S):
-                if ch_section:
-                    changelog.sections.append(ch_section)
-                ch_section = line + '\n'
-            elif ch_section:
-                ch_section += line + '\n'
+    def iter_sections(self, lines):
+        """
+        Split raw changelog sections from a stream of lines. Lines are only
+        consumed until the end of the section being yielded is found, so
+        the reading can be stopped after the first sections.
+
+        @param lines: the changelog, e.g. a file object or the output
+            stream of git cat-file
+        @type lines: iterable of C{str}
+        @return: raw text of the sections
+        @rtype: generator of C{str}
+        """
+        section_match = self._regexps['section_match_re'].match
+        section = []
+        for line in lines:
+            if section_match(line):
+                if section:
+                    yield ''.join(section)
+                section = [line]
+            elif section:
+                section.append(line)
             else:
                 raise ChangelogError("First line in changelog is invalid")
-        if ch_section:
-            changelog.sections.append(ch_section)
+        if section:
+            if not section[-1].endswith('\n'):
+                section[-1] += '\n'
+            yield ''.join(section)
+
+    def raw_parse_string(self, string):
+        """
+        Parse changelog - only splits out raw changelog sections. The
+        sections are slices of the original text.
+        """
+        changelog = Changelog(self._pkgpolicy)
+        changelog.sections = list(self.iter_sections(string.splitlines(True)))
         return changelog
 
-    def raw_parse_file(self, changelog):
-        """Parse changelog file - only splits out raw changelog sections."""
+    def raw_parse_file(self, changelog, max_sections=None):
+        """
+        Parse changelog file - only splits out raw changelog sections.
+
+        @param changelog: path to the changelog file
+        @type changelog: C{str}
+        @param max_sections: split out only this many sections from the
+            beginning of the file, the rest of the file is left unread in
+            L{Changelog.tail}
+        @type max_sections: C{int}
+        @rtype: L{Changelog}
+        """
+        try:
+            ch_file = open(changelog)
+        except IOError as err:
+            raise ChangelogError("Unable to read changelog file: %s" % err)
+        # Offset of the line last read
+        offset = [0]
+
+        def read_lines():
+            """Read lines, recording their offsets"""
+            while True:
+                offset[0] = ch_file.tell()
+                line = ch_file.readline()
+                if not line:
+                    break
+                yield line
+
+        result = Changelog(self._pkgpolicy)
         try:
-            with open(changelog) as ch_file:
-                return self.raw_parse_string(ch_file.read())
+            for section in self.iter_sections(read_lines()):
+                result.sections.append(section)
+                if len(result.sections) == max_sections:
+                    # The header line of the next section was already read
+                    result.tail = _ChangelogTail(ch_file, offset[0])
+                    break
         except IOError as err:
             raise ChangelogError("Unable to read changelog file: %s" % err)
+        finally:
+            if result.tail is None:
+                ch_file.close()
+        return result
 
     def _parse_section_header(self, text):
         """Parse one changelog section header"""
         # Try to split out time stamp and "changelog name"
-        match = re.match(self.header_split_re, text, re.M)
+        match = self._regexps['header_split_re'].match(text)
         if not match:
             raise ChangelogError("Unable to parse changelog header: %s" % text)
         try:
-            time = datetime.datetime.strptime(match.group('ch_time'),
-                                             "%a %b %d %Y")
+            time = _parse_header_time(match.group('ch_time'))
         except ValueError:
             raise ChangelogError("Unable to parse changelog header: invalid "
                                  "timestamp '%s'" % match.group('ch_time'))
         # Parse "name" part which consists of name and/or email and an optional
         # revision
         name_text = match.group('ch_name')
-        match = re.match(self.header_name_split_re, name_text)
+        match = self._regexps['header_name_split_re'].match(name_text)
         if not match:
             raise ChangelogError("Unable to parse changelog header: invalid "
                                  "name / revision '%s'" % name_text)
@@ -203,8 +410,9 @@ class ChangelogParser(object):
         entries = []
         entry_text = []
         author = default_author
+        body_name_match = self._regexps['body_name_re'].match
         for line in text.splitlines():
-            match = re.match(self.body_name_re, line)
+            match = body_name_match(line)
             if match:
                 if entry_text:
                     entries.append(self._create_entry(author, entry_text))
@@ -229,18 +437,19 @@ class ChangelogParser(object):
     def parse_section(self, text):
         """Parse one section"""
         # Check that the first line(s) look like a changelog header
-        match = re.match(self.section_split_re, text, re.M | re.S)
+        match = self._regexps['section_split_re'].match(text)
         if not match:
             raise ChangelogError("Doesn't look like changelog header: %s..." %
                                  text.splitlines()[0])
         # Parse header
         section = self._parse_section_header(match.group('ch_header'))
         header = section.header
-        # Parse entries
+        # Parse entries only when needed
         default_author = header['name'] if 'name' in header else header['email']
-        for entry in self._parse_section_entries(match.group('ch_body'),
-                                                 default_author):
-            section.append_entry(entry)
+        body = match.group('ch_body')
+        section._parse_entries = lambda: self._parse_section_entries(
+                                                body, default_author)
+        section._raw_text = text
 
         return section
 
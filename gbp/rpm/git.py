@@ -48,7 +48,8 @@ class RpmGitRepository(GitRepository):
             return None
         if self.has_tag(tag): # new tags are injective
             # dereference to a commit object
-            return self.rev_parse("%s^0" % tag)
+            commit = self._ref_commit('refs/tags/%s' % tag)
+            return commit if commit else self.rev_parse("%s^0" % tag)
         return None
 
     @staticmethod
@@ -16,32 +16,88 @@
 #    <http://www.gnu.org/licenses/>
 """Wrapper module for librpm"""
 
+import os
 import tempfile
 
 import gbp.log
 from gbp.rpm.policy import RpmPkgPolicy
 
-try:
-    # Try to load special RPM lib to be used for GBP (only)
-    librpm = __import__(RpmPkgPolicy.python_rpmlib_module_name)
-except ImportError:
-    gbp.log.warn("Failed to import '%s' as rpm python module, using host's "
-                    "default rpm library instead" %
-                    RpmPkgPolicy.python_rpmlib_module_name)
-    import rpm as librpm
 
-# Module initialization
-_rpmlog = tempfile.NamedTemporaryFile(prefix='gbp_rpmlog')
-_rpmlogfd = _rpmlog.file
-librpm.setVerbosity(librpm.RPMLOG_INFO)
-librpm.setLogFile(_rpmlogfd)
+def _memfile(name):
+    """
+    Create an anonymous read-write file that is kept in memory if possible,
+    i.e. a memfd or an unlinked file in I{/dev/shm}
+
+    @param name: name for the file, for debugging purposes
+    @type name: C{str}
+    @rtype: C{file}
+    """
+    if hasattr(os, 'memfd_create'):
+        return os.fdopen(os.memfd_create(name), 'w+')
+    shm = '/dev/shm'
+    tmpdir = shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else None
+    return tempfile.TemporaryFile(mode='w+', prefix=name, dir=tmpdir)
+
+
+class _LibRpm(object):
+    """
+    Proxy for the rpm python module. The module is imported, and the rpm log
+    set up, only when an attribute of it is first accessed so that commands
+    not needing librpm don't pay for it.
+    """
+    def __init__(self):
+        self._module = None
+        self._logfile = None
+
+    def _load(self):
+        """Import and initialize librpm"""
+        try:
+            # Try to load special RPM lib to be used for GBP (only)
+            module = __import__(RpmPkgPolicy.python_rpmlib_module_name)
+        except ImportError:
+            gbp.log.warn("Failed to import '%s' as rpm python module, using "
+                         "host's default rpm library instead" %
+                         RpmPkgPolicy.python_rpmlib_module_name)
+            import rpm as module
+        module.setVerbosity(module.RPMLOG_INFO)
+        self._module = module
+        self.new_log()
+        return module
+
+    def new_log(self):
+        """
+        Direct the rpm log to a new file, e.g. in a forked process that
+        should not share the log with its parent
+        """
+        self._logfile = _memfile('gbp_rpmlog')
+        self._module.setLogFile(self._logfile)
+
+    @property
+    def loaded(self):
+        """Whether librpm has been imported already"""
+        return self._module is not None
+
+    def get_log(self, truncate=True):
+        """Get rpmlib log output, see L{get_librpm_log}"""
+        if self._logfile is None:
+            return []
+        self._logfile.flush()
+        self._logfile.seek(0)
+        log = [line.strip() for line in self._logfile.readlines()]
+        if truncate:
+            self._logfile.seek(0)
+            self._logfile.truncate(0)
+        return log
+
+    def __getattr__(self, name):
+        module = self._module if self._module is not None else self._load()
+        return getattr(module, name)
+
+librpm = _LibRpm()
 
 
 def get_librpm_log(truncate=True):
     """Get rpmlib log output"""
-    _rpmlogfd.seek(0)
-    log = [line.strip() for line in _rpmlogfd.readlines()]
-    if truncate:
-        _rpmlogfd.truncate(0)
-    return log
+    return librpm.get_log(truncate)
 
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
@@ -23,11 +23,16 @@ import gbp.log
 
 class LinkedListNode(object):
     """Node of the linked list"""
+    __slots__ = ('prev', 'next', '_data', '_order', '_list')
 
     def __init__(self, data="", prev_node=None, next_node=None):
         self.prev = prev_node
         self.next = next_node
         self._data = data
+        # Order label, only maintained by indexed lists
+        self._order = None
+        # The list the node is linked into, notified of data changes
+        self._list = None
 
     def __str__(self):
         return str(self.data)
@@ -44,12 +49,17 @@ class LinkedListNode(object):
         """
         Set data stored into node
 
-        >>> node = LinkedListNode('foo')
+        >>> list = LinkedList()
+        >>> node = list.append('foo')
         >>> node.data
         'foo'
+        >>> list.mark_clean()
+        >>> node.set_data('foo')
+        >>> list.modified
+        False
         >>> node.set_data('bar')
-        >>> node.data
-        'bar'
+        >>> node.data, list.modified
+        ('bar', True)
         >>> node.set_data(None)
         >>> node.data
         ''
@@ -57,7 +67,10 @@ class LinkedListNode(object):
         if data is None:
             gbp.log.debug("BUG: trying to store 'None', not allowed")
             data = ""
-        self._data = data
+        if data != self._data:
+            self._data = data
+            if self._list is not None:
+                self._list._changes += 1
 
 
     def delete(self):
@@ -67,6 +80,7 @@ class LinkedListNode(object):
         if self.next:
             self.next.prev = self.prev
         self._data = None
+        self._list = None
 
 
 class LinkedListIterator(collections.Iterator):
@@ -88,19 +102,151 @@ class LinkedListIterator(collections.Iterator):
 
 
 class LinkedList(collections.Iterable):
-    """Doubly linked list"""
-
-    def __init__(self):
+    """
+    Doubly linked list
+
+    An indexed list keeps an order label in every node so that comparing
+    the order of two nodes is a constant time operation. The labels are
+    integers with gaps between them, a new node gets the midpoint of its
+    neighbours and the whole list is relabeled when a gap runs out.
+    """
+    # Gap between order labels when (re)labeling the list
+    _order_gap = 1 << 16
+
+    def __init__(self, indexed=False):
+        """
+        @param indexed: maintain an order index of the nodes
+        @type indexed: C{bool}
+        """
         self._first = None
         self._last = None
+        self._length = 0
+        self._indexed = indexed
+        # Are the order labels of the nodes equal to position * gap
+        self._positions_valid = True
+        # Number of nodes added, removed or changed since the list was
+        # last marked clean
+        self._changes = 0
 
     def __iter__(self):
         return LinkedListIterator(self)
 
     def __len__(self):
-        for num, data in enumerate(self):
-            pass
-        return num + 1
+        """
+        >>> len(LinkedList())
+        0
+        """
+        return self._length
+
+    def _relabel(self):
+        """(Re-)assign evenly spaced order labels to all nodes"""
+        node = self._first
+        order = 0
+        while node:
+            node._order = order
+            order += self._order_gap
+            node = node.next
+        self._positions_valid = True
+
+    @property
+    def modified(self):
+        """
+        Whether nodes have been added, removed or changed since the list
+        was last marked clean
+
+        >>> list = LinkedList()
+        >>> node = list.append('foo')
+        >>> list.modified
+        True
+        >>> list.mark_clean()
+        >>> list.modified
+        False
+        >>> node.set_data('bar')
+        >>> list.modified
+        True
+        >>> list.mark_clean()
+        >>> list.delete(node)
+        >>> list.modified
+        True
+        """
+        return self._changes != 0
+
+    def mark_clean(self):
+        """Clear the modification status of the list"""
+        self._changes = 0
+
+    def _link(self, new):
+        """Bookkeeping for a node that was just linked into the list"""
+        new._list = self
+        self._length += 1
+        self._changes += 1
+        if not self._indexed:
+            return
+        self._positions_valid = False
+        prev_order = new.prev._order if new.prev else None
+        next_order = new.next._order if new.next else None
+        if prev_order is None and next_order is None:
+            new._order = 0
+        elif next_order is None:
+            new._order = prev_order + self._order_gap
+        elif prev_order is None:
+            new._order = next_order - self._order_gap
+        elif next_order - prev_order > 1:
+            new._order = (prev_order + next_order) // 2
+        else:
+            self._relabel()
+
+    def position(self, node):
+        """
+        Get the position of a node in the list. Constant time for an
+        indexed list unless the list has been modified after the previous
+        call.
+
+        >>> list = LinkedList(indexed=True)
+        >>> node1 = list.append('foo')
+        >>> node2 = list.prepend('bar')
+        >>> list.position(node1), list.position(node2)
+        (1, 0)
+
+        @param node: node of this list
+        @type node: L{LinkedListNode}
+        @rtype: C{int}
+        """
+        if self._indexed:
+            if not self._positions_valid:
+                self._relabel()
+            return node._order // self._order_gap
+        for num, list_node in enumerate(self):
+            if list_node is node:
+                return num
+        raise ValueError("Node not in list")
+
+    def is_before(self, node1, node2):
+        """
+        Check if a node is located before another one in the list. Constant
+        time for an indexed list.
+
+        >>> list = LinkedList(indexed=True)
+        >>> node1 = list.append('foo')
+        >>> node2 = list.append('bar')
+        >>> node3 = list.insert_after(node1, 'baz')
+        >>> list.is_before(node1, node3), list.is_before(node2, node3)
+        (True, False)
+
+        @param node1: node of this list
+        @type node1: L{LinkedListNode}
+        @param node2: node of this list
+        @type node2: L{LinkedListNode}
+        @rtype: C{bool}
+        """
+        if self._indexed:
+            return node1._order < node2._order
+        node = node1.next
+        while node:
+            if node is node2:
+                return True
+            node = node.next
+        return False
 
     @property
     def first(self):
@@ -123,6 +269,7 @@ class LinkedList(collections.Iterable):
         """
         if self._first is None:
             new = self._first = self._last = LinkedListNode(data)
+            self._link(new)
         else:
             new = self.insert_before(self._first, data)
         return new
@@ -161,6 +308,7 @@ class LinkedList(collections.Iterable):
         else:
             self._first = new
         node.prev = new
+        self._link(new)
         return new
 
     def insert_after(self, node, data=""):
@@ -180,6 +328,7 @@ class LinkedList(collections.Iterable):
         else:
             self._last = new
         node.next = new
+        self._link(new)
         return new
 
     def delete(self, node):
@@ -212,6 +361,9 @@ class LinkedList(collections.Iterable):
         if node is self._last:
             self._last = self._last.prev
         node.delete()
+        self._length -= 1
+        self._changes += 1
+        self._positions_valid = False
         return ret
 
 # vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
@@ -0,0 +1,303 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2016 Intel Corporation <markus.lehtonen@linux.intel.com>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, please see
+#    <http://www.gnu.org/licenses/>
+"""Expansion of a subset of the rpm macro language in pure python"""
+
+import re
+
+
+class MacroExpandError(Exception):
+    """Macro expansion in spec file failed"""
+    pass
+
+
+class MacroTable(object):
+    """
+    Table of rpm macros, able to expand the plain forms of macro references
+    (I{%name}, I{%{name}}, I{%{?name}}, I{%{!?name:text}} etc.) and to
+    evaluate simple I{%if} expressions.
+
+    The table is a closed world: referencing (or testing the existence of)
+    a macro that has not been defined or explicitly undefined is an error,
+    as is anything needing the real rpm (shell and lua expansion, builtin
+    macros, parametric macros). Expansion results are memoized until the
+    table is changed.
+
+    >>> macros = MacroTable()
+    >>> macros.define('name', 'foo')
+    >>> macros.define('ver', '%{name}-1.0')
+    >>> macros.expand('%ver %{?name} %{!?name:none}%{?name:some} 100%%')
+    'foo-1.0 foo some 100%'
+    >>> macros.undefine('dist')
+    >>> macros.expand('1%{?dist}')
+    '1'
+    >>> macros.expand('%{_prefix}')
+    Traceback (most recent call last):
+    ...
+    MacroExpandError: Unknown macro '_prefix'
+    >>> macros.define('a', '%{b}')
+    >>> macros.define('b', '%{a}')
+    >>> macros.expand('%{a}')
+    Traceback (most recent call last):
+    ...
+    MacroExpandError: Recursive macro 'a'
+    """
+    name_re = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+    # Value of macros that are defined but can't be expanded by us
+    _unknown = object()
+
+    def __init__(self):
+        self._macros = {'nil': ''}
+        self._undefined = set()
+        # Memoized expansions of macros and of whole texts
+        self._values = {}
+        self._texts = {}
+
+    def define(self, name, body, expand=False):
+        """
+        Define a macro
+
+        @param name: name of the macro
+        @type name: C{str}
+        @param body: body of the macro, C{None} if it is defined but
+            can't be expanded
+        @type body: C{str}
+        @param expand: expand the body right away, like I{%global} does
+        @type expand: C{bool}
+        """
+        if body is not None and expand:
+            try:
+                body = self.expand(body)
+            except MacroExpandError:
+                body = None
+        self._macros[name] = self._unknown if body is None else body
+        self._undefined.discard(name)
+        self._values.clear()
+        self._texts.clear()
+
+    def undefine(self, name):
+        """
+        Mark a macro as not defined
+
+        @param name: name of the macro
+        @type name: C{str}
+        """
+        self._macros.pop(name, None)
+        self._undefined.add(name)
+        self._values.clear()
+        self._texts.clear()
+
+    def is_defined(self, name):
+        """
+        Check if a macro is defined
+
+        @param name: name of the macro
+        @type name: C{str}
+        @rtype: C{bool}
+        @raises MacroExpandError: if it is not known whether the macro is
+            defined
+        """
+        if name in self._macros:
+            return True
+        if name in self._undefined:
+            return False
+        raise MacroExpandError("Unknown macro '%s'" % name)
+
+    def _value(self, name, stack):
+        """Get the expanded value of a defined macro"""
+        if name in self._values:
+            return self._values[name]
+        if not self.is_defined(name):
+            raise MacroExpandError("Undefined macro '%s'" % name)
+        body = self._macros[name]
+        if body is self._unknown:
+            raise MacroExpandError("Can't expand macro '%s'" % name)
+        if name in stack:
+            raise MacroExpandError("Recursive macro '%s'" % name)
+        value = self._values[name] = self._expand(body, stack + (name,))
+        return value
+
+    def _expand_ref(self, ref, stack):
+        """Expand one macro reference, without the leading '%' and braces"""
+        flags = ''
+        while ref[len(flags):len(flags) + 1] in ('?', '!'):
+            flags += ref[len(flags)]
+        match = self.name_re.match(ref, len(flags))
+        if not match:
+            raise MacroExpandError("Unsupported macro '%%%s'" % ref)
+        name = match.group(0)
+        rest = ref[match.end():]
+        if '?' not in flags:
+            if flags or rest:
+                raise MacroExpandError("Unsupported macro '%%{%s}'" % ref)
+            return self._value(name, stack)
+        if rest and not rest.startswith(':'):
+            raise MacroExpandError("Unsupported macro '%%{%s}'" % ref)
+        if self.is_defined(name) != ('!' in flags):
+            if rest:
+                return self._expand(rest[1:], stack)
+            return '' if '!' in flags else self._value(name, stack)
+        return ''
+
+    def _expand(self, text, stack):
+        """Expand all macro references in a string"""
+        out = []
+        pos = 0
+        while True:
+            ind = text.find('%', pos)
+            if ind < 0:
+                out.append(text[pos:])
+                break
+            out.append(text[pos:ind])
+            char = text[ind + 1:ind + 2]
+            if char == '%':
+                out.append('%')
+                pos = ind + 2
+            elif char == '{':
+                depth = 0
+                for end in range(ind + 1, len(text)):
+                    if text[end] == '{':
+                        depth += 1
+                    elif text[end] == '}':
+                        depth -= 1
+                        if depth == 0:
+                            break
+                else:
+                    raise MacroExpandError("Unterminated macro in '%s'" % text)
+                out.append(self._expand_ref(text[ind + 2:end], stack))
+                pos = end + 1
+            elif char in ('(', '['):
+                raise MacroExpandError("Unsupported expansion in '%s'" % text)
+            else:
+                match = re.match(r'[?!]*[A-Za-z_][A-Za-z0-9_]*', text[ind + 1:])
+                if match:
+                    out.append(self._expand_ref(match.group(0), stack))
+                    pos = ind + 1 + match.end()
+                else:
+                    # A lone '%' is kept as is
+                    out.append('%')
+                    pos = ind + 1
+        return ''.join(out)
+
+    def expand(self, text):
+        """
+        Expand macros in a string
+
+        @param text: text to expand
+        @type text: C{str}
+        @return: the expanded text
+        @rtype: C{str}
+        @raises MacroExpandError: if something could not be expanded
+        """
+        if text not in self._texts:
+            self._texts[text] = self._expand(text, ())
+        return self._texts[text]
+
+    def evaluate(self, expr):
+        """
+        Evaluate the expression of an I{%if} directive
+
+        >>> macros = MacroTable()
+        >>> macros.define('with_foo', '1')
+        >>> macros.evaluate('%{with_foo} && !(2 < 1 || "a" == "b")')
+        True
+        >>> macros.evaluate('0%{?with_foo} > 0')
+        True
+
+        @param expr: the expression, macros are expanded first
+        @type expr: C{str}
+        @rtype: C{bool}
+        @raises MacroExpandError: if the expression could not be evaluated
+        """
+        tokens = _ExprTokens(self.expand(expr))
+        value = tokens.parse_or()
+        if tokens.peek() is not None:
+            raise MacroExpandError("Invalid expression '%s'" % expr)
+        return bool(value)
+
+
+class _ExprTokens(object):
+    """Recursive descent parser of rpm %if expressions"""
+    token_re = re.compile(r'\s*(?:(\d+)|"([^"]*)"|(==|!=|<=|>=|&&|\|\||[<>!()]))')
+    compare = {'==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+               '<': lambda a, b: a < b, '>': lambda a, b: a > b,
+               '<=': lambda a, b: a <= b, '>=': lambda a, b: a >= b}
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = []
+        pos = 0
+        while expr[pos:].strip():
+            match = self.token_re.match(expr, pos)
+            if not match:
+                raise MacroExpandError("Invalid expression '%s'" % expr)
+            if match.group(1) is not None:
+                self.tokens.append(('value', int(match.group(1))))
+            elif match.group(2) is not None:
+                self.tokens.append(('value', match.group(2)))
+            else:
+                self.tokens.append(('op', match.group(3)))
+            pos = match.end()
+
+    def peek(self):
+        return self.tokens[0] if self.tokens else None
+
+    def _take(self, op=None):
+        token = self.peek()
+        if token is None or (op and token != ('op', op)):
+            raise MacroExpandError("Invalid expression '%s'" % self.expr)
+        return self.tokens.pop(0)
+
+    def parse_or(self):
+        value = self.parse_and()
+        while self.peek() == ('op', '||'):
+            self._take()
+            right = self.parse_and()
+            value = value or right
+        return value
+
+    def parse_and(self):
+        value = self.parse_compare()
+        while self.peek() == ('op', '&&'):
+            self._take()
+            right = self.parse_compare()
+            value = value and right
+        return value
+
+    def parse_compare(self):
+        value = self.parse_unary()
+        token = self.peek()
+        if token and token[0] == 'op' and token[1] in self.compare:
+            self._take()
+            right = self.parse_unary()
+            if type(value) != type(right):
+                raise MacroExpandError("Invalid expression '%s'" % self.expr)
+            value = int(self.compare[token[1]](value, right))
+        return value
+
+    def parse_unary(self):
+        token = self._take()
+        if token == ('op', '!'):
+            return int(not self.parse_unary())
+        if token == ('op', '('):
+            value = self.parse_or()
+            self._take(')')
+            return value
+        if token[0] == 'value':
+            return token[1]
+        raise MacroExpandError("Invalid expression '%s'" % self.expr)
+
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
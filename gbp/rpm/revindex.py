@@ -0,0 +1,176 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2016 Intel Corporation <markus.lehtonen@linux.intel.com>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, please see
+#    <http://www.gnu.org/licenses/>
+"""On-disk index of the commits of packaging tags and changelog revisions"""
+
+import json
+import os
+import tempfile
+
+import gbp.log
+from gbp.jsonfile import to_native
+
+
+class RevisionIndex(object):
+    """
+    Index of the commits packaging tags point to, and of the changelog
+    revisions written for the tags. Stored in I{gbp-cache/revisions.json}
+    under the git directory.
+
+    Entries are trusted as is if no tags have been changed since the index
+    was saved, which is checked by looking at the files git stores tags
+    in. Otherwise they are validated against the ref snapshot of the
+    repository.
+    """
+    # Bump when the format of the file changes
+    format_version = 2
+
+    def __init__(self, repo, path=None):
+        """
+        @param repo: the repository
+        @type repo: L{GitRepository}
+        @param path: path of the index file
+        @type path: C{str}
+        """
+        self._repo = repo
+        self.path = path or os.path.join(repo.git_dir, 'gbp-cache',
+                                         'revisions.json')
+        # Commit sha1 by tag name, and tag name by changelog revision
+        self._tags = {}
+        self._revisions = {}
+        # Paths and stats of the tag files when the index was saved
+        self._refs_stats = None
+        self._load()
+
+    def _load(self):
+        """Read the index file, a missing or broken file is ignored"""
+        try:
+            with open(self.path) as index_file:
+                data = to_native(json.load(index_file))
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') != self.format_version:
+            return
+        self._tags = data['tags']
+        self._revisions = data['revisions']
+        self._refs_stats = data['refs']
+
+    def _refs_paths(self):
+        """
+        The files git stores the tags of the index in: I{packed-refs}, the
+        I{refs/tags} directories and the loose ref files of the tags.
+        Branches are not included, they change far more often.
+        """
+        tags_dir = os.path.join(self._repo._common_dir(), 'refs', 'tags')
+        return self._repo._refs_paths('refs/tags') + \
+            [os.path.join(tags_dir, tag) for tag in sorted(self._tags)]
+
+    def _get_refs_stats(self, paths):
+        """Stats of the given files, comparable with the saved ones"""
+        return [list(stat) if stat else None for stat in
+                self._repo._refs_stat(paths)]
+
+    def _refs_unchanged(self):
+        """Check if the tag files are as they were when the index was saved"""
+        if self._refs_stats is None:
+            return False
+        paths = [path for path, _stat in self._refs_stats]
+        return [stat for _path, stat in self._refs_stats] == \
+            self._get_refs_stats(paths)
+
+    def save(self):
+        """
+        Write the index to disk. Errors are not fatal, the index is just
+        not updated.
+        """
+        # Git replaces ref files and packed-refs by renaming a new file
+        # over them, so their inode changes even if the mtime doesn't. No
+        # need to distrust stats that are recent.
+        paths = self._refs_paths()
+        stats = [[path, stat] for path, stat in
+                 zip(paths, self._get_refs_stats(paths))]
+        data = {'version': self.format_version, 'tags': self._tags,
+                'revisions': self._revisions, 'refs': stats}
+        dirname = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(data, tmp_file)
+            os.rename(tmp, self.path)
+            self._refs_stats = stats
+        except (IOError, OSError) as err:
+            gbp.log.debug("Failed to update revision index: %s" % err)
+
+    def add(self, tag, revision=None):
+        """
+        Add a tag to the index, call L{save} to write the index to disk
+
+        @param tag: name of the tag
+        @type tag: C{str}
+        @param revision: the changelog revision written for the tag
+        @type revision: C{str}
+        """
+        commit = self._repo._ref_commit('refs/tags/%s' % tag)
+        if commit is None:
+            return
+        self._tags[tag] = commit
+        if revision:
+            self._revisions[revision] = tag
+
+    def lookup_tag(self, tag):
+        """
+        Get the commit a tag points to
+
+        @param tag: name of the tag
+        @type tag: C{str}
+        @return: sha1 of the commit or C{None} if the tag is not in the index
+        @rtype: C{str}
+        """
+        commit = self._tags.get(tag)
+        if commit is None:
+            return None
+        if self._refs_unchanged():
+            return commit
+        # Tags have changed, validate all entries and save the result so
+        # that the next lookup doesn't need to
+        for name, sha1 in list(self._tags.items()):
+            current = self._repo._ref_commit('refs/tags/%s' % name)
+            if current is None:
+                del self._tags[name]
+            elif current != sha1:
+                self._tags[name] = current
+        for revision, name in list(self._revisions.items()):
+            if name not in self._tags:
+                del self._revisions[revision]
+        self.save()
+        return self._tags.get(tag)
+
+    def lookup_revision(self, revision):
+        """
+        Get the commit of the tag a changelog revision was written for
+
+        @param revision: the changelog revision
+        @type revision: C{str}
+        @return: sha1 of the commit or C{None} if the revision is not in the
+            index
+        @rtype: C{str}
+        """
+        tag = self._revisions.get(revision)
+        return self.lookup_tag(tag) if tag else None
+
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
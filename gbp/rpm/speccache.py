@@ -0,0 +1,158 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2016 Intel Corporation <markus.lehtonen@linux.intel.com>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, please see
+#    <http://www.gnu.org/licenses/>
+"""On-disk cache for the results of parsing spec files with librpm"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import six
+
+import gbp.log
+from gbp.jsonfile import to_native
+
+
+class SpecCache(object):
+    """
+    Cache of the information librpm extracts from spec files, one JSON file
+    per entry. The least recently used entries are removed when the total
+    size of the cache exceeds the limit.
+    """
+    # Bump when the format of the cached data changes
+    format_version = 1
+    default_max_size = 4 * 1024 * 1024
+    suffix = '.json'
+
+    _repo_caches = {}
+
+    def __init__(self, path, max_size=None):
+        """
+        @param path: directory for the cache files
+        @type path: C{str}
+        @param max_size: maximum total size of the cache files, in bytes
+        @type max_size: C{int}
+        """
+        self.path = path
+        self.max_size = self.default_max_size if max_size is None else max_size
+
+    @classmethod
+    def for_repo(cls, repo):
+        """
+        Get the cache of a repository. It is in I{gbp-cache/spec} under
+        the git directory unless configured otherwise with the
+        I{gbp.specCacheDir} config option. The size limit can be set with
+        I{gbp.specCacheSize}, zero disables the cache.
+
+        @param repo: the repository
+        @type repo: L{GitRepository}
+        @return: the cache or C{None} if it is disabled
+        @rtype: L{SpecCache}
+        """
+        if repo.git_dir not in cls._repo_caches:
+            try:
+                path = repo.get_config('gbp.specCacheDir')
+            except KeyError:
+                path = os.path.join(repo.git_dir, 'gbp-cache', 'spec')
+            try:
+                max_size = int(repo.get_config('gbp.specCacheSize'))
+            except (KeyError, ValueError):
+                max_size = None
+            cache = cls(path, max_size) if max_size != 0 else None
+            cls._repo_caches[repo.git_dir] = cache
+        return cls._repo_caches[repo.git_dir]
+
+    @classmethod
+    def key(cls, *fields):
+        """
+        Compose a cache key
+
+        @param fields: everything that affects the cached data
+        @type fields: C{str}
+        @rtype: C{str}
+        """
+        data = '\0'.join((str(cls.format_version),) + fields)
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key):
+        """
+        Get a cache entry
+
+        @param key: key of the entry
+        @type key: C{str}
+        @return: the cached data or C{None} if not found
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename) as cache_file:
+                data = to_native(json.load(cache_file))
+            # Mark as recently used
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            # ValueError covers UnicodeError, too
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        Add an entry to the cache, evicting old entries if needed. Errors
+        are not fatal, the entry is just not cached.
+
+        @param key: key of the entry
+        @type key: C{str}
+        @param data: data to cache, must be serializable to JSON
+        """
+        tmp = None
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+            with os.fdopen(fd, 'w') as tmp_file:
+                # Strings that are not valid UTF-8 can't be stored
+                json.dump(data, tmp_file)
+            os.rename(tmp, self._filename(key))
+            tmp = None
+            self._evict()
+        except (IOError, OSError, ValueError) as err:
+            gbp.log.debug("Failed to update spec cache: %s" % err)
+        finally:
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _evict(self):
+        """Remove least recently used entries until under the size limit"""
+        entries = []
+        total = 0
+        for fname in os.listdir(self.path):
+            if not fname.endswith(self.suffix):
+                continue
+            path = os.path.join(self.path, fname)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        for _mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.unlink(path)
+            total -= size
+
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
@@ -35,6 +35,7 @@ from gbp.format import format_str
 from gbp.pkg import compressor_opts
 from gbp.rpm.git import GitRepositoryError, RpmGitRepository
 from gbp.rpm.policy import RpmPkgPolicy
+from gbp.rpm.revindex import RevisionIndex
 from gbp.tmpfile import init_tmpdir, del_tmpdir, tempfile
 from gbp.scripts.common.buildpackage import (index_name, wc_names,
                                              git_archive_submodules,
@@ -193,10 +194,11 @@ def get_vcs_info(repo, treeish):
     """Get the info for spec vcs tag"""
     info = {}
     try:
+        shas = repo.rev_parse_many(['%s^0' % treeish, treeish])
+        info['commit'] = shas['%s^0' % treeish]
+        info['commitish'] = shas[treeish]
         info['tagname'] = repo.describe(treeish, longfmt=True, always=True,
                                         abbrev=40)
-        info['commit'] = repo.rev_parse('%s^0' % treeish)
-        info['commitish'] = repo.rev_parse('%s' % treeish)
     except GitRepositoryError:
         # If tree is not commit-ish, expect it to be from current HEAD
         info['tagname'] = repo.describe('HEAD', longfmt=True, always=True,
@@ -400,6 +402,9 @@ def create_packaging_tag(repo, commit, name, version, options):
         repo.delete_tag(tag_name)
     repo.create_tag(name=tag_name, msg=tag_msg, sign=options.sign_tags,
                     keyid=options.keyid, commit=commit)
+    index = RevisionIndex(repo)
+    index.add(tag_name)
+    index.save()
     return tag_name
 
 
@@ -645,8 +650,9 @@ def main(argv):
         gbp.log.debug("Dumping packaging files to '%s'" % dump_dir)
         if not dump_tree(repo, dump_dir, packaging_tree, False, False):
             raise GbpError
-        # Re-parse spec from dump dir to get version etc.
-        spec = rpm.SpecFile(os.path.join(dump_dir, spec.specfile))
+        # The dumped spec is the very same blob that was parsed from the
+        # tree, just point the spec object to it instead of re-parsing
+        spec.specdir = os.path.abspath(dump_dir)
 
         if not options.tag_only:
             # Setup builder opts
@@ -170,7 +170,8 @@ def apply_debian_patch(repo, unpack_dir, src, options, tag):
                                  branch = options.packaging_branch,
                                  other_parents = parents,
                                  author=author,
-                                 committer=committer)
+                                 committer=committer,
+                                 fast_import=True)
         if not options.skip_packaging_tag:
             repo.create_tag(repo.version_to_tag(options.packaging_tag, src.version),
                             msg="Debian release %s" % src.version,
@@ -393,7 +394,8 @@ def main(argv):
                                          "Imported %s" % msg,
                                          branch,
                                          author=author,
-                                         committer=committer)
+                                         committer=committer,
+                                         fast_import=True)
 
                 if not (src.native and options.skip_packaging_tag):
                     repo.create_tag(name=tag,
@@ -296,7 +296,8 @@ def main(argv):
                         msg=msg,
                         branch=options.upstream_branch,
                         other_parents=parents,
-                        create_missing_branch=options.create_missing_branches)
+                        create_missing_branch=options.create_missing_branches,
+                        fast_import=True)
             if options.pristine_tar and pristine_orig:
                 gbp.log.info("Pristine-tar: commiting %s" % pristine_orig)
                 repo.pristine_tar.commit(pristine_orig, options.upstream_branch)
@@ -436,7 +436,8 @@ def main(argv):
                         other_parents=parents,
                         author=author,
                         committer=committer,
-                        create_missing_branch=options.create_missing_branches)
+                        create_missing_branch=options.create_missing_branches,
+                        fast_import=True)
                 if not (options.native and options.skip_packaging_tag):
                     repo.create_tag(name=src_tag,
                                     msg=msg,
@@ -480,7 +481,8 @@ def main(argv):
                         branch,
                         author=author,
                         committer=committer,
-                        create_missing_branch=options.create_missing_branches)
+                        create_missing_branch=options.create_missing_branches,
+                        fast_import=True)
             else:
                 # Copy packaging files to the unpacked sources dir
                 try:
@@ -499,7 +501,8 @@ def main(argv):
                         other_parents=[src_commit],
                         author=author,
                         committer=committer,
-                        create_missing_branch=options.create_missing_branches)
+                        create_missing_branch=options.create_missing_branches,
+                        fast_import=True)
                 # Import patches on top of the source tree
                 # (only for non-native packages with non-orphan packaging)
                 force_to_branch_head(repo, options.packaging_branch)
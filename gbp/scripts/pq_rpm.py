@@ -39,6 +39,7 @@ from gbp.patch_series import PatchSeries, Patch
 from gbp.pkg import parse_archive_filename
 from gbp.rpm import (SpecFile, NoSpecError, guess_spec, guess_spec_repo,
                      spec_from_repo, string_to_int)
+from gbp.rpm.speccache import SpecCache
 from gbp.scripts.common.pq import (is_pq_branch, pq_branch_name, pq_branch_base,
             parse_gbp_commands, format_patch, format_diff,
             apply_and_commit_patch, drop_pq)
@@ -66,8 +67,9 @@ convert        [experimental] Convert package from single-branch development
 
 def is_ancestor(repo, parent, child):
     """Check if commit is ancestor of another"""
-    parent_sha1 = repo.rev_parse("%s^0" % parent)
-    child_sha1 = repo.rev_parse("%s^0" % child)
+    shas = repo.rev_parse_many(["%s^0" % parent, "%s^0" % child])
+    parent_sha1 = shas["%s^0" % parent]
+    child_sha1 = shas["%s^0" % child]
     try:
         merge_base = repo.get_merge_base(parent_sha1, child_sha1)
     except GitRepositoryError:
@@ -103,16 +105,15 @@ def generate_patches(repo, start, squash, end, outdir, options):
         if not repo.has_treeish(treeish):
             raise GbpError('Invalid treeish object %s' % treeish)
 
-    start_sha1 = repo.rev_parse("%s^0" % start)
     # In case of plain tree-ish objects, assume current branch head is the
     # last commit
     if repo.get_obj_type(end) == 'tree':
         end_commit = "HEAD"
     else:
         end_commit = end
-    end_commit_sha1 = repo.rev_parse("%s^0" % end_commit)
-
-    start_sha1 = repo.rev_parse("%s^0" % start)
+    shas = repo.rev_parse_many(["%s^0" % start, "%s^0" % end_commit])
+    start_sha1 = shas["%s^0" % start]
+    end_commit_sha1 = shas["%s^0" % end_commit]
 
     if not is_ancestor(repo, start_sha1, end_commit_sha1):
         raise GbpError("Start commit '%s' not an ancestor of end commit "
@@ -127,8 +128,9 @@ def generate_patches(repo, start, squash, end, outdir, options):
                 raise GbpError("Given squash point '%s' not in the history "
                                "of end commit '%s'" % (squash[0], end_commit))
             # Shorten SHA1s
-            squash_sha1 = repo.rev_parse(squash_sha1, short=7)
-            start_sha1 = repo.rev_parse(start_sha1, short=7)
+            shas = repo.rev_parse_many([squash_sha1, start_sha1], short=7)
+            squash_sha1 = shas[squash_sha1]
+            start_sha1 = shas[start_sha1]
             gbp.log.info("Squashing commits %s..%s into one monolithic diff" %
                          (start_sha1, squash_sha1))
             patch_fn = format_diff(outdir, squash[1], repo,
@@ -141,8 +143,9 @@ def generate_patches(repo, start, squash, end, outdir, options):
     merges = repo.get_commits(start, end_commit, options=['--merges'])
     if merges:
         # Shorten SHA1s
-        start_sha1 = repo.rev_parse(start, short=7)
-        merge_sha1 = repo.rev_parse(merges[0], short=7)
+        shas = repo.rev_parse_many([start, merges[0]], short=7)
+        start_sha1 = shas[start]
+        merge_sha1 = shas[merges[0]]
         patch_fn = format_diff(outdir, None, repo, start_sha1, merge_sha1,
                                options.patch_ignore_path)
         if patch_fn:
@@ -156,8 +159,9 @@ def generate_patches(repo, start, squash, end, outdir, options):
     merges = repo.get_commits(start, end_commit, options=['--merges'])
     if merges:
         # Shorten SHA1s
-        start_sha1 = repo.rev_parse(start, short=7)
-        merge_sha1 = repo.rev_parse(merges[0], short=7)
+        shas = repo.rev_parse_many([start, merges[0]], short=7)
+        start_sha1 = shas[start]
+        merge_sha1 = shas[merges[0]]
         patch_fn = format_diff(outdir, None, repo, start_sha1, merge_sha1)
         if patch_fn:
             gbp.log.info("Merge commits found! Diff between %s..%s written "
@@ -166,8 +170,7 @@ def generate_patches(repo, start, squash, end, outdir, options):
             start = merge_sha1
 
     # Generate patches
-    for commit in reversed(repo.get_commits(start, end_commit)):
-        info = repo.get_commit_info(commit)
+    for info in repo.iter_commit_info(start, end_commit, reverse=True):
         cmds = {}
         _cmds, info['body'] = parse_gbp_commands(info,
                                                  'gbp',
@@ -239,26 +242,28 @@ def update_patch_series(repo, spec, start, end, options):
     return patches
 
 
-def parse_spec(options, repo, treeish=None):
+def parse_spec(options, repo, treeish=None, light=False):
     """
     Find and parse spec file.
 
     If treeish is given, try to find the spec file from that. Otherwise, search
-    for the spec file in the working copy.
+    for the spec file in the working copy. With light, librpm is only used
+    if the spec file can't be read without it.
     """
     try:
         if options.spec_file:
             if not treeish:
-                spec = SpecFile(options.spec_file)
+                spec = SpecFile(options.spec_file, light=light)
             else:
-                spec = spec_from_repo(repo, treeish, options.spec_file)
+                spec = spec_from_repo(repo, treeish, options.spec_file, light)
         else:
             preferred_name = os.path.basename(repo.path) + '.spec'
             if not treeish:
-                spec = guess_spec(options.packaging_dir, True, preferred_name)
+                spec = guess_spec(options.packaging_dir, True, preferred_name,
+                                  light)
             else:
                 spec = guess_spec_repo(repo, treeish, options.packaging_dir,
-                                       True, preferred_name)
+                                       True, preferred_name, light)
     except NoSpecError as err:
         raise GbpError("Can't parse spec: %s" % err)
     relpath = spec.specpath if treeish else os.path.relpath(spec.specpath,
@@ -453,10 +458,10 @@ def rebase_pq(repo, options):
     current = repo.get_branch()
     if is_pq_branch(current, options):
         base = pq_branch_base(current, options)
-        spec = parse_spec(options, repo, base)
+        spec = parse_spec(options, repo, base, light=True)
     else:
         base = current
-        spec = parse_spec(options, repo)
+        spec = parse_spec(options, repo, light=True)
     upstream_commit = find_upstream_commit(repo, spec.upstreamversion,
                                            options.upstream_tag)
 
@@ -480,9 +485,9 @@ def drop_pq_rpm(repo, options):
     current = repo.get_branch()
     if is_pq_branch(current, options):
         base = pq_branch_base(current, options)
-        spec = parse_spec(options, repo, base)
+        spec = parse_spec(options, repo, base, light=True)
     else:
-        spec = parse_spec(options, repo)
+        spec = parse_spec(options, repo, light=True)
     drop_pq(repo, current, options, spec.version)
 
 
@@ -494,7 +499,7 @@ def switch_to_pq_branch(repo, branch, options):
     if is_pq_branch(branch, options):
         return
 
-    spec = parse_spec(options, repo, branch)
+    spec = parse_spec(options, repo, branch, light=True)
     pq_branch = pq_branch_name(branch, options, spec.version)
     if not repo.has_branch(pq_branch):
         raise GbpError("Branch '%s' does not exist" % pq_branch)
@@ -586,7 +591,9 @@ def convert_with_history(repo, upstream, commits, new_branch, spec_fn, options):
     tip_commit = repo.commit_tree(new_tree, msg, [])
 
     # Generate initial patches
-    spec = SpecFile(os.path.join(dump_packaging_dir, spec_fn))
+    spec_cache = SpecCache.for_repo(repo)
+    spec = SpecFile(os.path.join(dump_packaging_dir, spec_fn),
+                    cache=spec_cache)
     update_patch_series(repo, spec, upstream, commits[0], options)
     # Commit updated packaging files only if something was changed
     new_tree = repo.create_tree(packaging_tmp)
@@ -598,13 +605,15 @@ def convert_with_history(repo, upstream, commits, new_branch, spec_fn, options):
         tip_commit = repo.commit_tree(new_tree, msg, [tip_commit])
 
     # Import rest of the commits
-    for commit in commits[1:]:
+    for info in repo.iter_commit_info(commits=commits[1:]):
+        commit = info['id']
         shutil.rmtree(dump_packaging_dir)
         packaging_tree = '%s:%s' % (commit, options.packaging_dir)
         dump_tree(repo, dump_packaging_dir, packaging_tree,
                   with_submodules=False, recursive=False)
         try:
-            spec = SpecFile(os.path.join(dump_packaging_dir, spec_fn))
+            spec = SpecFile(os.path.join(dump_packaging_dir, spec_fn),
+                            cache=spec_cache)
             update_patch_series(repo, spec, upstream, commit, options)
         except (NoSpecError, GbpError):
             gbp.log.warn("Failed to generate patches from '%s'" % commit)
@@ -614,7 +623,6 @@ def convert_with_history(repo, upstream, commits, new_branch, spec_fn, options):
             gbp.log.info("Skipping commit '%s' which generated no change" %
                          commit)
         else:
-            info = repo.get_commit_info(commit)
             msg = "%s\n\n%sAuto-imported by gbp from '%s'" % (info['subject'],
                         info['body'], commit)
             tip_commit = repo.commit_tree(new_tree, msg, [tip_commit])
@@ -20,6 +20,7 @@
 
 import ConfigParser
 from datetime import datetime
+import itertools
 import os.path
 import pwd
 import re
@@ -36,9 +37,10 @@ from gbp.rpm import (guess_spec, NoSpecError, SpecFile, split_version_str,
 from gbp.rpm.changelog import Changelog, ChangelogParser, ChangelogError
 from gbp.rpm.git import GitRepositoryError, RpmGitRepository
 from gbp.rpm.policy import RpmPkgPolicy
+from gbp.rpm.revindex import RevisionIndex
 from gbp.scripts.buildpackage_rpm import (packaging_tag_data,
                                           create_packaging_tag)
-from gbp.tmpfile import init_tmpdir, del_tmpdir
+from gbp.tmpfile import init_tmpdir, del_tmpdir, replace_file
 
 
 ChangelogEntryFormatter = RpmPkgPolicy.ChangelogEntryFormatter
@@ -63,21 +65,37 @@ class ChangelogFile(object):
                 self.changelog = Changelog(RpmPkgPolicy)
             else:
                 gbp.log.debug("Using changelog file '%s'" % file_path)
-                self.changelog = parser.raw_parse_file(self._file)
+                # Only the topmost section is needed, the rest is copied
+                # as is when writing
+                self.changelog = parser.raw_parse_file(self._file,
+                                                       max_sections=1)
 
         # Parse topmost section and try to determine the start commit
         if self.changelog.sections:
-            self.changelog.sections[0] = parser.parse_section(
-                    self.changelog.sections[0])
+            try:
+                self.changelog.sections[0] = parser.parse_section(
+                        self.changelog.sections[0])
+            except Exception:
+                self.close()
+                raise
 
     def write(self):
-        """Write changelog file to disk"""
+        """
+        Write changelog file to disk. The changelog can't be used after
+        this as its unparsed tail is not available anymore.
+        """
         if isinstance(self._file, SpecFile):
             self._file.set_changelog(str(self.changelog))
             self._file.write_spec_file()
         else:
-            with open(self._file, 'w') as fobj:
-                fobj.write(str(self.changelog))
+            # Write to a new file as the unparsed tail of the changelog is
+            # read from the old one
+            replace_file(self._file, self.changelog.write)
+            self.close()
+
+    def close(self):
+        """Release the changelog file, it may be kept open for reading"""
+        self.changelog.close()
 
     @property
     def path(self):
@@ -189,6 +207,14 @@ def guess_commit(section, repo, options):
         return None
     header = section.header
 
+    # Revisions written by gbp rpm-ch --tag are found from the index
+    index = RevisionIndex(repo)
+    commit = index.lookup_revision(header['revision'])
+    if commit:
+        gbp.log.debug("Found revision %s in the revision index" %
+                      header['revision'])
+        return commit
+
     # Try to parse the fields from the header revision
     rev_re = '^%s$' % re.sub(r'%\((\S+?)\)s', r'(?P<\1>\S+)',
                              options.changelog_revision)
@@ -198,6 +224,9 @@ def guess_commit(section, repo, options):
     # First, try to find tag-name, if present
     if 'tagname' in fields:
         gbp.log.debug("Trying to find tagname %s" % fields['tagname'])
+        commit = index.lookup_tag(fields['tagname'])
+        if commit:
+            return commit
         try:
             return repo.rev_parse("%s^0" % fields['tagname'])
         except GitRepositoryError:
@@ -217,8 +246,13 @@ def guess_commit(section, repo, options):
         tag_str_fields['upstreamversion'] = fields['upstreamversion']
         if 'release' in fields:
             tag_str_fields['release'] = fields['release']
-    commit = repo.find_version(options.packaging_tag,
-                                   tag_str_fields)
+    try:
+        commit = index.lookup_tag(repo.version_to_tag(options.packaging_tag,
+                                                      tag_str_fields))
+    except GbpError:
+        commit = None
+    if not commit:
+        commit = repo.find_version(options.packaging_tag, tag_str_fields)
     if commit:
         return commit
     else:
@@ -278,11 +312,13 @@ def get_author(repo, use_git_config):
     return author, email
 
 
-def entries_from_commits(changelog, repo, commits, options):
-    """Generate a list of formatted changelog entries from a list of commits"""
+def entries_from_commits(changelog, commits, options):
+    """
+    Generate a list of formatted changelog entries from commit infos, as
+    returned by L{gbp.git.GitRepository.iter_commit_info}
+    """
     entries = []
-    for commit in commits:
-        info = repo.get_commit_info(commit)
+    for info in commits:
         entry_text = ChangelogEntryFormatter.compose(info, full=options.full,
                         ignore_re=options.ignore_regex, id_len=options.idlen,
                         meta_bts=options.meta_bts)
@@ -314,12 +350,18 @@ def generate_new_entries(changelog, repo, options, args):
         since = get_start_commit(changelog, repo, options)
         if args:
             gbp.log.info("Only looking for changes in '%s'" % ", ".join(args))
-        commits = repo.get_commits(since=since, until='HEAD', paths=args,
-                                   options=options.git_log.split(" "))
-        commits.reverse()
-        if not commits:
+        # Stream the commits from one git log, without the changed files
+        commits = repo.iter_commit_info(since=since, until='HEAD',
+                                        paths=args, reverse=True,
+                                        options=options.git_log.split(" "),
+                                        files=False)
+        first = next(commits, None)
+        if first is None:
             gbp.log.info("No changes detected from %s to %s." % (since, 'HEAD'))
-        entries = entries_from_commits(changelog, repo, commits, options)
+            return []
+        entries = entries_from_commits(changelog,
+                                       itertools.chain([first], commits),
+                                       options)
     return entries
 
 
@@ -505,6 +547,7 @@ def main(argv):
     if not options:
         return 1
 
+    ch_file = None
     try:
         init_tmpdir(options.tmp_dir, prefix='rpm-ch_')
 
@@ -542,12 +585,17 @@ def main(argv):
                     repo.delete_tag(tag)
                 repo.create_tag(tag, tag_msg, 'HEAD', options.sign_tags,
                                 options.keyid)
+                index = RevisionIndex(repo)
+                index.add(tag, ch_file.changelog.sections[0].header['revision'])
+                index.save()
 
     except (GbpError, GitRepositoryError, ChangelogError, NoSpecError) as err:
         if len(err.__str__()):
             gbp.log.err(err)
         return 1
     finally:
+        if ch_file:
+            ch_file.close()
         del_tmpdir()
 
     return 0
@@ -38,7 +38,7 @@ def sanitize(cmd):
 def usage():
     print("""
 Usage:
-    gbp <command> [<args>]
+    gbp [--profile[=<file>]] <command> [<args>]
 
 The most commonly used commands are:
 
@@ -48,6 +48,9 @@ The most commonly used commands are:
     import-dscs  - import multiple Debian source packages
 
 Use '--list-cmds' to list all available commands.
+Use '--profile' to print a summary of the external commands run or
+'--profile=<file>' to write a JSON trace of them to <file>. It can also be
+given after the command.
 """)
 
 def version(prog):
@@ -107,6 +110,14 @@ def list_available_commands():
 def supercommand(argv=None):
     argv = argv or sys.argv
 
+    # --profile is accepted before and after the command
+    profile = [arg for arg in argv[1:] if arg == '--profile' or
+                                          arg.startswith('--profile=')]
+    if profile:
+        import gbp.tracing
+        gbp.tracing.setup(profile[-1].partition('=')[2] or None)
+        argv = argv[0:1] + [arg for arg in argv[1:] if arg not in profile]
+
     if len(argv) < 2:
         usage()
         return 1
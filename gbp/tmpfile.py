@@ -15,7 +15,7 @@
 #    along with this program; if not, please see
 #    <http://www.gnu.org/licenses/>
 #
-"""Temporary directory handling"""
+"""Temporary directory and file handling"""
 
 import os
 import shutil
@@ -50,5 +50,50 @@ def del_tmpdir():
             shutil.rmtree(tempfile.tempdir)
         tempfile.tempdir = _old_tempdirs.pop()
 
+
+def replace_file(path, write):
+    """
+    Replace the content of a file via a temporary file in the same
+    directory, atomically unless the file has several hard links. Symbolic
+    links are followed and hard links are kept, the permissions of the
+    file are preserved.
+
+    @param path: the file to write
+    @type path: C{str}
+    @param write: function writing the new content into a file object
+    @type write: C{callable}
+    """
+    path = os.path.realpath(path)
+    try:
+        stat = os.stat(path)
+        mode = stat.st_mode & 0o7777
+    except OSError:
+        stat = None
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix='.%s.' % os.path.basename(path))
+    try:
+        try:
+            tmp_file = os.fdopen(fd, 'w')
+        except Exception:
+            os.close(fd)
+            raise
+        with tmp_file:
+            write(tmp_file)
+        if stat and stat.st_nlink > 1:
+            # Renaming would break the hard links, copy instead
+            with open(tmp) as src, open(path, 'w') as dst:
+                shutil.copyfileobj(src, dst)
+            os.unlink(tmp)
+        else:
+            os.chmod(tmp, mode)
+            os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
 # vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
 
@@ -0,0 +1,184 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2016 Intel Corporation <markus.lehtonen@linux.intel.com>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, please see
+#    <http://www.gnu.org/licenses/>
+"""
+Opt-in tracing of the external commands run by gbp
+
+Tracing is enabled by setting the I{GBP_PROFILE} environment variable or by
+giving I{--profile} to the I{gbp} command, before or after the name of
+the subcommand. With a value of I{1} (or
+I{summary}) a summary table is printed on stderr at exit, any other value
+is taken as the name of a file to write a JSON trace of all the commands
+to.
+"""
+
+from __future__ import print_function
+
+import atexit
+import json
+import os
+import sys
+import time
+
+_records = None
+_output = None
+_started = None
+_registered = False
+
+# Code in these files is plumbing, not the interesting caller
+_plumbing_files = ('tracing.py', 'command_wrappers.py', 'catfile.py',
+                   'objectreader.py', 'fastimport.py')
+
+
+def setup(output=None):
+    """
+    Enable tracing
+
+    @param output: file to write a JSON trace to, a summary is printed
+        on stderr if not given
+    @type output: C{str}
+    """
+    global _records, _output, _started, _registered
+    if not _registered:
+        atexit.register(report)
+        _registered = True
+    _records = []
+    _output = output
+    _started = time.time()
+
+
+def setup_from_env():
+    """Enable tracing if requested in the environment"""
+    value = os.getenv('GBP_PROFILE')
+    if value:
+        setup(None if value in ('1', 'summary') else value)
+
+
+def disable():
+    """Disable tracing, dropping everything recorded so far"""
+    global _records
+    _records = None
+
+
+def enabled():
+    """Whether tracing is enabled"""
+    return _records is not None
+
+
+def _caller():
+    """Find the gbp function that caused the command to be run"""
+    frame = sys._getframe(1)
+    while frame:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename).replace('.pyc', '.py')
+        if not (filename in _plumbing_files or
+                code.co_name.startswith(('_git', '__git'))):
+            name = code.co_name
+            obj = frame.f_locals.get('self')
+            if obj is not None:
+                name = '%s.%s' % (type(obj).__name__, name)
+            return '%s.%s:%d' % (frame.f_globals.get('__name__'), name,
+                                 frame.f_lineno)
+        frame = frame.f_back
+    return None
+
+
+def record(cmd, start, bytes_in=0, bytes_out=0, returncode=None):
+    """
+    Record one external command run
+
+    @param cmd: the command and its arguments
+    @type cmd: C{list} of C{str}
+    @param start: time when the command was started
+    @type start: C{float}
+    @param bytes_in: number of bytes fed to the command
+    @type bytes_in: C{int}
+    @param bytes_out: number of bytes read from the command
+    @type bytes_out: C{int}
+    @param returncode: exit code of the command
+    @type returncode: C{int}
+    """
+    if _records is None:
+        return
+    _records.append({'cmd': cmd,
+                     'start': start - _started,
+                     'wall': time.time() - start,
+                     'bytes_in': bytes_in,
+                     'bytes_out': bytes_out,
+                     'returncode': returncode,
+                     'caller': _caller()})
+
+
+def _cmd_name(cmd):
+    """Name of the command to group by, e.g. 'git rev-parse'"""
+    if isinstance(cmd, str):
+        cmd = cmd.split()
+    name = os.path.basename(cmd[0]) if cmd else ''
+    if name == 'git' and len(cmd) > 1:
+        name = 'git %s' % cmd[1]
+    return name
+
+
+def _table(title, groups, out):
+    """Print one summary table, sorted by total time"""
+    print("%s:" % title, file=out)
+    print("%7s %9s %9s %11s %11s  %s" % ('calls', 'total[s]', 'max[s]',
+                                         'in[B]', 'out[B]', 'name'), file=out)
+    for name, recs in sorted(groups.items(),
+                             key=lambda item: -sum(r['wall'] for r in item[1])):
+        print("%7d %9.3f %9.3f %11d %11d  %s" %
+              (len(recs), sum(r['wall'] for r in recs),
+               max(r['wall'] for r in recs),
+               sum(r['bytes_in'] for r in recs),
+               sum(r['bytes_out'] for r in recs), name), file=out)
+
+
+def summary(out=None):
+    """
+    Print a summary of the recorded commands, grouped by command and by
+    calling function
+
+    @param out: stream to print to, stderr by default
+    @type out: C{file}
+    """
+    out = out or sys.stderr
+    by_cmd = {}
+    by_caller = {}
+    for rec in _records:
+        by_cmd.setdefault(_cmd_name(rec['cmd']), []).append(rec)
+        by_caller.setdefault(rec['caller'], []).append(rec)
+    print("gbp profile: %d commands in %.3fs, total run time %.3fs" %
+          (len(_records), sum(r['wall'] for r in _records),
+           time.time() - _started), file=out)
+    _table("By command", by_cmd, out)
+    _table("By caller", by_caller, out)
+
+
+def report():
+    """Output the summary or write the JSON trace, whichever was requested"""
+    if not _records:
+        return
+    if _output:
+        with open(_output, 'w') as trace:
+            json.dump({'total': time.time() - _started,
+                       'commands': _records}, trace, indent=1)
+    else:
+        summary()
+
+
+setup_from_env()
+
+# vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
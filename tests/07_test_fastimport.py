@@ -11,11 +11,13 @@ import gbp.git
 
 repo = None
 fastimport = None
+tmpdir = None
+marks = []
 tf_name = 'testfile'
 tl_name = 'a_testlink'
 
 def setup():
-    global repo
+    global repo, tmpdir
 
     tmpdir = context.new_tmpdir(__name__)
     repo = gbp.git.GitRepository.create(tmpdir.join('test_repo'))
@@ -32,7 +34,7 @@ def test_init_fastimport():
 def test_add_file():
     """Add a file via fastimport"""
     author = repo.get_author_info()
-    fastimport.start_commit('master', author, "a commit")
+    marks.append(fastimport.start_commit('master', author, "a commit"))
     fastimport.deleteall()
     testfile = os.path.join(repo.path, '.git', 'description')
     fastimport.add_file('./testfile',
@@ -42,11 +44,25 @@ def test_add_file():
 def test_add_symlink():
     """Add a symbolic link via fastimport"""
     author = repo.get_author_info()
-    fastimport.start_commit('master', author, "a 2nd commit")
+    marks.append(fastimport.start_commit('master', author, "a 2nd commit"))
     fastimport.add_symlink(tl_name, tf_name)
 
+def test_commit_dir():
+    """Commit a directory on top of an earlier commit of the session"""
+    author = repo.get_author_info()
+    fastimport.checkpoint()
+    fastimport.progress("committing a directory")
+    content = tmpdir.join('content')
+    os.makedirs(os.path.join(content, 'subdir'))
+    with open(os.path.join(content, 'subdir', 'file'), 'w') as f:
+        f.write("content\n")
+    marks.append(fastimport.commit_dir(content, 'other', author,
+                                       "a 3rd commit", parents=[marks[0]]))
+    assert len(set(marks)) == 3, "Marks not unique: %s" % marks
+
 def test_close():
     fastimport.close()
+    assert sorted(fastimport.marks.keys()) == sorted(marks)
 
 def test_result():
     repo.force_head('master', hard=True)
@@ -58,3 +74,11 @@ def test_result():
     assert os.path.lexists(testlink), "%s doesn't exist" % testlink
     assert os.readlink(testlink) == tf_name
 
+def test_marks():
+    """Check the commits the marks point to"""
+    assert fastimport.marks[marks[1]] == repo.rev_parse('master')
+    assert fastimport.marks[marks[2]] == repo.rev_parse('other')
+    assert repo.rev_parse('other^') == fastimport.marks[marks[0]]
+    assert repo.rev_parse('master^') == fastimport.marks[marks[0]]
+    assert [obj[3] for obj in repo.list_tree('other', recurse=True)] == \
+           ['subdir/file']
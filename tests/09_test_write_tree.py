@@ -7,6 +7,7 @@ from __future__ import print_function
 from . import context
 from . import testutils
 
+import fcntl
 import os
 
 import gbp.log
@@ -69,4 +70,62 @@ class TestWriteTree(testutils.DebianGitTestRepo):
                           "failed commit",
                           ['doesnotexist'])
 
+    def test_create_tree(self):
+        """Create trees repeatedly out of a changing directory"""
+        tree_dir = self.tmpdir.join('tree')
+        os.mkdir(tree_dir)
+        for i in range(4):
+            with open(os.path.join(tree_dir, 'file%d' % i), 'w') as f:
+                print("data %d" % i, file=f)
+        tree1 = self.repo.create_tree(tree_dir)
+        self.assertEqual(sorted(obj[3] for obj in self.repo.list_tree(tree1)),
+                         ['file0', 'file1', 'file2', 'file3'])
+        self.assertEqual(self.repo.create_tree(tree_dir), tree1)
+
+        # Changed, removed and added files are picked up
+        with open(os.path.join(tree_dir, 'file0'), 'w') as f:
+            print("changed data", file=f)
+        os.unlink(os.path.join(tree_dir, 'file1'))
+        os.mkdir(os.path.join(tree_dir, 'subdir'))
+        with open(os.path.join(tree_dir, 'subdir', 'file4'), 'w') as f:
+            print("data 4", file=f)
+        tree2 = self.repo.create_tree(tree_dir)
+        self.assertNotEqual(tree2, tree1)
+        self.assertEqual(sorted(obj[3] for obj in self.repo.list_tree(tree2)),
+                         ['file0', 'file2', 'file3', 'subdir'])
+        self.assertEqual(self.repo.show('%s:file0' % tree2), 'changed data\n')
+
+        # Other directories start from their own content only
+        other_dir = self.tmpdir.join('other')
+        os.mkdir(other_dir)
+        with open(os.path.join(other_dir, 'file2'), 'w') as f:
+            print("data 2", file=f)
+        tree3 = self.repo.create_tree(other_dir)
+        self.assertEqual([obj[3] for obj in self.repo.list_tree(tree3)],
+                         ['file2'])
+
+    def test_create_tree_locked(self):
+        """Create a tree while the scratch index is in use"""
+        tree_dir = self.tmpdir.join('tree')
+        os.mkdir(tree_dir)
+        with open(os.path.join(tree_dir, 'file0'), 'w') as f:
+            print("data 0", file=f)
+        tree1 = self.repo.create_tree(tree_dir)
+        cache_dir = os.path.join(self.repo.git_dir, 'gbp-cache')
+        index = os.path.join(cache_dir, 'tree-index')
+        mtime = os.stat(index).st_mtime
+
+        with open(os.path.join(tree_dir, 'file1'), 'w') as f:
+            print("data 1", file=f)
+        with open(index + '.flock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            tree2 = self.repo.create_tree(tree_dir)
+        self.assertNotEqual(tree2, tree1)
+        self.assertEqual(sorted(obj[3] for obj in self.repo.list_tree(tree2)),
+                         ['file0', 'file1'])
+        # The scratch index is left alone and the temporary one removed
+        self.assertEqual(os.stat(index).st_mtime, mtime)
+        self.assertEqual(sorted(os.listdir(cache_dir)),
+                         ['tree-index', 'tree-index.flock'])
+
 # vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
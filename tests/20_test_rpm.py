@@ -17,17 +17,23 @@
 """Test the classes under L{gbp.rpm}"""
 
 import filecmp
+import mock
 import os
 import shutil
 import tempfile
+import unittest
 from nose.tools import assert_raises, eq_, ok_ # pylint: disable=E0611
 
 import six
 
 from gbp.errors import GbpError
-from gbp.rpm import (SpecFile, SrcRpmFile, NoSpecError, guess_spec,
-                     guess_spec_repo, spec_from_repo)
+from gbp.rpm import (SpecFile, SrcRpmFile, NoSpecError, MacroExpandError,
+                     GbpTagLine, guess_spec, guess_spec_repo, spec_from_repo)
 from gbp.git.repository import GitRepository
+from gbp.rpm.lib_rpm import librpm
+from gbp.rpm.speccache import SpecCache
+from gbp.rpm.batch import parse_specs, _parse_one
+from gbp.rpm.revindex import RevisionIndex
 
 # Disable "Method could be a function"
 #   pylint: disable=R0201
@@ -217,6 +223,57 @@ class TestSpecFile(RpmTestBase):
         spec.write_spec_file()
         eq_(filecmp.cmp(tmp_spec, reference_spec), True)
 
+    def test_write_unmodified(self):
+        """Test that unmodified spec is not rewritten"""
+        tmp_spec = os.path.join(self.tmpdir, 'gbp-test.spec')
+        shutil.copy2(os.path.join(SPEC_DIR, 'gbp-test.spec'), tmp_spec)
+        os.chmod(tmp_spec, 0o640)
+        os.utime(tmp_spec, (1000000000, 1000000000))
+
+        spec = SpecFile(tmp_spec)
+        eq_(spec.modified, False)
+        eq_(spec.diff(), [])
+        eq_(spec.write_spec_file(), False)
+        # Changes that were reverted don't cause a rewrite either
+        spec.set_tag('VCS', None, 'myvcstag')
+        spec.set_tag('VCS', None, '')
+        eq_(spec.write_spec_file(), False)
+        eq_(os.stat(tmp_spec).st_mtime, 1000000000)
+
+        spec.set_tag('VCS', None, 'myvcstag')
+        eq_(spec.modified, True)
+        eq_([line for line in spec.diff(0) if line[0] in '+-'],
+            ['--- a/gbp-test.spec\n', '+++ b/gbp-test.spec\n',
+             '+VCS:        myvcstag\n'])
+        eq_(spec.write_spec_file(), True)
+        eq_(os.stat(tmp_spec).st_mode & 0o777, 0o640)
+        eq_(spec.diff(), [])
+        eq_(os.listdir(self.tmpdir), ['gbp-test.spec'])
+
+        # Spec is always written to a new location
+        spec.specdir = os.path.join(self.tmpdir, 'new')
+        os.mkdir(spec.specdir)
+        eq_(spec.write_spec_file(), True)
+        ok_(filecmp.cmp(tmp_spec, os.path.join(spec.specdir, spec.specfile)))
+
+    def test_write_links(self):
+        """Test writing spec files through symbolic and hard links"""
+        real_spec = os.path.join(self.tmpdir, 'real.spec')
+        shutil.copy2(os.path.join(SPEC_DIR, 'gbp-test.spec'), real_spec)
+        os.symlink('real.spec', os.path.join(self.tmpdir, 'symlink.spec'))
+        os.link(real_spec, os.path.join(self.tmpdir, 'hardlink.spec'))
+
+        for name in ('symlink.spec', 'hardlink.spec'):
+            spec = SpecFile(os.path.join(self.tmpdir, name))
+            spec.set_tag('VCS', None, name)
+            eq_(spec.write_spec_file(), True)
+            eq_(SpecFileTester(real_spec).protected('_tags')['vcs'].value,
+                name)
+        ok_(os.path.islink(os.path.join(self.tmpdir, 'symlink.spec')))
+        eq_(os.stat(real_spec).st_nlink, 2)
+        eq_(sorted(os.listdir(self.tmpdir)),
+            ['hardlink.spec', 'real.spec', 'symlink.spec'])
+
     def test_modifying(self):
         """Test updating/deleting of tags and macros"""
         tmp_spec = os.path.join(self.tmpdir, 'gbp-test.spec')
@@ -291,6 +348,111 @@ class TestSpecFile(RpmTestBase):
         # Check that we quess orig source and prefix correctly
         eq_(spec.orig_src['prefix'], 'foobar/')
 
+    def test_cache(self):
+        """Test re-creating spec file info from the cache"""
+        spec_filepath = os.path.join(SPEC_DIR, 'gbp-test2.spec')
+        cache = SpecCache(os.path.join(self.tmpdir, 'cache'))
+        spec = SpecFileTester(spec_filepath, cache=cache)
+        eq_(len(os.listdir(cache.path)), 1)
+
+        # librpm must not be needed when the key matches
+        with mock.patch.object(SpecFile, '_parse_filtered_spec') as parse:
+            cached = SpecFileTester(spec_filepath, cache=cache)
+            eq_(parse.call_count, 0)
+        eq_(cached.version, spec.version)
+        eq_(cached.packager, spec.packager)
+        eq_(cached.sources(), spec.sources())
+        eq_(cached.protected('_tags')['patch']['lines'][0]['linevalue'],
+            spec.protected('_tags')['patch']['lines'][0]['linevalue'])
+
+        # Macros coming from the build environment are part of the key
+        with mock.patch.object(librpm, 'expandMacro', return_value='other'):
+            SpecFile(spec_filepath, cache=cache)
+        eq_(len(os.listdir(cache.path)), 2)
+
+        # Non-ASCII strings survive the cache, invalid UTF-8 isn't cached
+        cache.put('utf8', {'summary': 'M\xc3\xbcller'})
+        eq_(cache.get('utf8'), {'summary': 'M\xc3\xbcller'})
+        cache.put('latin1', {'summary': 'M\xfcller'})
+        eq_(cache.get('latin1'), None)
+        eq_(len(os.listdir(cache.path)), 3)
+
+        # Old entries are evicted when the cache grows too big
+        cache.max_size = 1
+        SpecFile(os.path.join(SPEC_DIR, 'gbp-test.spec'), cache=cache)
+        eq_(os.listdir(cache.path), [])
+
+    def test_light(self):
+        """Test reading the preamble without librpm"""
+        for name in ('gbp-test.spec', 'gbp-test2.spec'):
+            spec_filepath = os.path.join(SPEC_DIR, name)
+            spec = SpecFileTester(spec_filepath)
+            with mock.patch.object(SpecFile, '_parse_filtered_spec') as parse:
+                light = SpecFileTester(spec_filepath, light=True)
+                eq_(parse.call_count, 0)
+            for attr in ('name', 'version', 'release', 'epoch', 'packager'):
+                eq_(getattr(light, attr), getattr(spec, attr))
+            eq_(light.sources(), spec.sources())
+            for tag, val in six.iteritems(spec.protected('_tags')):
+                light_val = light.protected('_tags')[tag]
+                eq_(light_val['value'], val['value'])
+                eq_([(line['num'], line['linevalue']) for
+                     line in light_val['lines']],
+                    [(line['num'], line['linevalue']) for
+                     line in val['lines']])
+
+        # Conditionals with %elif
+        for conds, version in [(('0', '1', '0'), '2'), (('1', '1', '0'), '1'),
+                               (('0', '0', '0'), '3')]:
+            spec = SpecFile(filedata="Name: foo\nRelease: 1\n"
+                                     "%%if %s\nVersion: 1\n"
+                                     "%%elif %s\nVersion: 2\n"
+                                     "%%elif %s\nVersion: 2\n"
+                                     "%%else\nVersion: 3\n%%endif\n" % conds,
+                            light=True)
+            eq_(spec._read_rpminfo()['header']['version'], version)
+        spec = SpecFile(filedata="Name: foo\nVersion: 1\nRelease: 1\n"
+                                 "%if 0\n%elifarch x86_64\n%endif\n",
+                        light=True)
+        eq_(spec._read_rpminfo(), None)
+
+        # Fall back to librpm with constructs that need the real rpm
+        spec_filepath = os.path.join(SPEC_DIR, 'gbp-test-tags.spec')
+        spec = SpecFile(spec_filepath, light=True)
+        eq_(spec._read_rpminfo(), None)
+        eq_(spec.name, 'my_name')
+
+    def test_macro_expand(self):
+        """Test expanding the macros defined in spec file"""
+        spec = SpecFile(filedata="Name: foo\nVersion: 1.0\nRelease: 1\n"
+                                 "%define srcname foo-src\n"
+                                 "%global longname %{srcname}-%{version}\n"
+                                 "%define twice a\n"
+                                 "%undefine gone\n"
+                                 "Source: %{longname}.tar.gz\n"
+                                 "%if 0\n%define twice b\n%endif\n"
+                                 "%description\nFoo\n"
+                                 "%prep\n%setup -q -n %{longname}\n")
+        eq_(spec.orig_src['prefix'], 'foo-src-1.0/')
+        eq_(spec.macro_expand('%name-%{?srcname:yes}%{!?srcname:no}'),
+            'foo-yes')
+        for text in ('%{twice}', '%{?gone}', '%{_datadir}'):
+            with assert_raises(MacroExpandError):
+                spec.macro_expand(text)
+
+    def test_forward_macro_refs(self):
+        """Test detection of macros used before their definition"""
+        check = SpecFile._has_forward_macro_refs
+        ok_(not check(['Name: foo\n', 'Source: %{name}.tar.gz\n']))
+        ok_(not check(['%define x 1\n', 'Release: %x\n']))
+        ok_(not check(['Summary: %{?dist}\n', 'Requires: %{_bindir}/sh\n']))
+        ok_(check(['Source: %{name}.tar.gz\n', 'Name: foo\n']))
+        ok_(check(['Release: 1%{?rel}\n', '%global rel .1\n']))
+        ok_(check(['%{!?x:%define y 1}\n', '%define x 0\n']))
+        ok_(check(['%{!?x: %global x 1}\n', 'Release: %x\n']))
+        ok_(check(['Release: 1\n', '%{?x:%{define y 1}}\n']))
+        ok_(not check(['  %global x 1\n', 'Release: %{x}\n']))
+
     def test_tags(self):
         """Test parsing of all the different tags of spec file"""
         spec_filepath = os.path.join(SPEC_DIR, 'gbp-test-tags.spec')
@@ -324,7 +486,8 @@ class TestSpecFile(RpmTestBase):
         eq_(len(spec.patchseries()), 0)
         spec.update_patches(['1.patch', '2.patch', '3.patch'], {})
         eq_(len(spec.patchseries()), 3)
-        spec.protected('_gbp_tags')['ignore-patches'].append({'args': "0"})
+        spec.protected('_gbp_tags')['ignore-patches'].append(
+                GbpTagLine(None, "0"))
         spec.update_patches(['4.patch'], {})
         eq_(len(spec.patchseries()), 1)
         eq_(len(spec.patchseries(ignored=True)), 2)
@@ -407,4 +570,94 @@ class TestUtilityFunctions(RpmTestBase):
         spec = spec_from_repo(repo, 'HEAD', 'packaging/gbp-test.spec')
         eq_(spec.specfile, 'gbp-test.spec')
 
+    def test_parse_specs(self):
+        """Test parsing spec files in worker processes"""
+        repo = GitRepository.create(self.tmpdir)
+        shutil.copy(os.path.join(SPEC_DIR, 'gbp-test.spec'), repo.path)
+        repo.add_files('gbp-test.spec')
+        repo.commit_all('Add spec file')
+
+        items = [os.path.join(SPEC_DIR, 'gbp-test2.spec'),
+                 os.path.join(SPEC_DIR, 'nonexistent.spec'),
+                 (repo, 'HEAD'),
+                 (repo.path, 'HEAD', 'broken'),
+                 os.path.join(SPEC_DIR, 'gbp-test-native.spec')]
+        summaries = list(parse_specs(items, processes=2, max_pending=1))
+        eq_([summary.name for summary in summaries],
+            ['gbp-test2', None, 'gbp-test', None, 'gbp-test-native'])
+        ok_(summaries[1].error.startswith('Unable to read spec file'))
+        ok_(summaries[3].error.startswith('ValueError: '))
+        eq_(summaries[0].version, {'release': '0', 'upstreamversion': '3.0',
+                                   'epoch': '2'})
+        eq_(summaries[2].item, (repo.path, 'HEAD'))
+        eq_(summaries[2].patches, {0: 'my.patch', 10: 'my2.patch',
+                                   20: 'my3.patch'})
+        eq_(summaries[2].orig_src['filename'], 'gbp-test-1.0.tar.bz2')
+
+    @staticmethod
+    def _cat_file_children():
+        """Running git cat-file child processes of this process"""
+        children = []
+        for pid in os.listdir('/proc'):
+            try:
+                with open('/proc/%s/stat' % pid) as stat_file:
+                    ppid = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+                with open('/proc/%s/cmdline' % pid) as cmdline_file:
+                    cmdline = cmdline_file.read().split('\0')
+            except (IOError, OSError, ValueError, IndexError):
+                continue
+            if ppid == os.getpid() and 'cat-file' in cmdline:
+                children.append(pid)
+        return children
+
+    def test_parse_specs_repos(self):
+        """Test that workers don't keep git processes of the repos running"""
+        if not os.path.isdir('/proc/self'):
+            raise unittest.SkipTest("No /proc filesystem")
+        items = []
+        for num in range(3):
+            repo = GitRepository.create(os.path.join(self.tmpdir, str(num)))
+            shutil.copy(os.path.join(SPEC_DIR, 'gbp-test.spec'), repo.path)
+            repo.add_files('gbp-test.spec')
+            repo.commit_all('Add spec file')
+            items.append((repo.path, 'HEAD'))
+        eq_(self._cat_file_children(), [])
+        for item in items + items:
+            eq_(_parse_one(item, False).name, 'gbp-test')
+            eq_(self._cat_file_children(), [])
+
+    def test_revision_index(self):
+        """Test the index of tags and changelog revisions"""
+        repo = GitRepository.create(self.tmpdir)
+        for num in range(2):
+            shutil.copy(os.path.join(SPEC_DIR, 'gbp-test.spec'),
+                        os.path.join(repo.path, 'file%d' % num))
+            repo.add_files('file%d' % num)
+            repo.commit_all('Add file %d' % num)
+        commits = repo.get_commits()
+        repo.create_tag('v1', msg='Release 1')
+        index = RevisionIndex(repo)
+        index.add('v1', '1.0-1')
+        index.add('nonexistent', '0.1')
+        index.save()
+
+        # Tags have not changed, git is not needed even right after saving
+        # and after new commits on branches
+        shutil.copy(os.path.join(SPEC_DIR, 'gbp-test2.spec'),
+                    os.path.join(repo.path, 'file0'))
+        repo.commit_all('Change file 0')
+        repo.create_branch('other')
+        index = RevisionIndex(repo)
+        with mock.patch.object(repo, '_ref_commit', side_effect=AssertionError):
+            eq_(index.lookup_revision('1.0-1'), commits[0])
+            eq_(index.lookup_tag('v1'), commits[0])
+            eq_(index.lookup_revision('0.1'), None)
+
+        # Entries are validated against the refs if they changed
+        repo.delete_tag('v1')
+        repo.create_tag('v1', commit=commits[1])
+        eq_(RevisionIndex(repo).lookup_revision('1.0-1'), commits[1])
+        repo.delete_tag('v1')
+        eq_(RevisionIndex(repo).lookup_tag('v1'), None)
+
 # vim:et:ts=4:sw=4:et:sts=4:ai:set list listchars=tab\:»·,trail\:·:
@@ -0,0 +1,119 @@
+# vim: set fileencoding=utf-8 :
+"""Test L{gbp.tracing}"""
+
+from . import context
+from . import testutils
+
+import json
+import os
+
+import gbp.tracing
+import gbp.scripts.supercommand
+from gbp.command_wrappers import Command
+from gbp.git.catfile import GitCatFile
+from gbp.git.objectreader import GitObjectReader
+
+
+class TestTracing(testutils.DebianGitTestRepo):
+    """Test tracing of external commands"""
+
+    def setUp(self):
+        testutils.DebianGitTestRepo.setUp(self)
+        self.trace = self.tmpdir.join('trace.json')
+        gbp.tracing.setup(self.trace)
+
+    def tearDown(self):
+        gbp.tracing.disable()
+        testutils.DebianGitTestRepo.tearDown(self)
+
+    def _commands(self):
+        """Write the JSON trace and get the commands recorded in it"""
+        gbp.tracing.report()
+        with open(self.trace) as trace:
+            return json.load(trace)['commands']
+
+    def test_record_git(self):
+        """Git commands are recorded with their caller"""
+        self.repo.get_config('core.bare')
+        self.repo.list_files()
+        recs = self._commands()
+        self.assertEqual([rec['cmd'][0:2] for rec in recs],
+                         [['git', 'config'], ['git', 'ls-files']])
+        self.assertTrue(recs[0]['caller'].startswith(
+                            'gbp.git.repository.DebianGitRepository.get_config:'),
+                        recs[0]['caller'])
+        self.assertEqual(recs[0]['bytes_out'], len('false\n'))
+        self.assertEqual(recs[0]['returncode'], 0)
+        self.assertTrue(recs[1]['wall'] >= 0)
+
+    def test_record_closed_early(self):
+        """Commands whose output is not read to the end are recorded"""
+        self.add_file('foo', 'bar')
+        self.add_file('bar', 'foo')
+        gbp.tracing.setup(self.trace)
+        infos = self.repo.iter_commit_info()
+        next(infos)
+        infos.close()
+        self.assertEqual([rec['cmd'][0:2] for rec in self._commands()],
+                         [['git', 'log']])
+
+    def test_record_command(self):
+        """Commands run through L{Command} are recorded"""
+        Command('true')()
+        recs = self._commands()
+        self.assertEqual(recs[0]['cmd'], ['true'])
+        self.assertEqual(recs[0]['returncode'], 0)
+
+    def test_record_fast_import(self):
+        """Git fast-import runs are recorded when they are closed"""
+        tree_dir = self.tmpdir.join('tree')
+        os.mkdir(tree_dir)
+        with open(os.path.join(tree_dir, 'foo'), 'w') as fobj:
+            fobj.write('bar\n')
+        gbp.tracing.setup(self.trace)
+        self.repo.commit_dir(tree_dir, 'Import', 'imported',
+                             create_missing_branch=True, fast_import=True)
+        recs = [rec for rec in self._commands()
+                if rec['cmd'][0:2] == ['git', 'fast-import']]
+        self.assertEqual(len(recs), 1)
+        self.assertTrue(recs[0]['bytes_in'] > len('bar\n'))
+        self.assertEqual(recs[0]['returncode'], 0)
+        self.assertTrue(recs[0]['caller'].startswith(
+                            'gbp.git.repository.DebianGitRepository.'),
+                        recs[0]['caller'])
+
+    def test_record_object_reader_fallback(self):
+        """Lookups the object reader leaves to git cat-file are recorded"""
+        self.add_file('foo', 'bar')
+        self.repo._cat_file_reader = GitObjectReader(
+                self.repo.git_dir, fallback=GitCatFile(self.repo.path))
+        gbp.tracing.setup(self.trace)
+        self.repo.rev_parse('HEAD@{0}')
+        recs = self._commands()
+        self.assertEqual([rec['cmd'] for rec in recs],
+                         [['git', 'cat-file', '--batch-check']])
+        self.assertTrue(recs[0]['caller'].startswith(
+                            'gbp.git.repository.DebianGitRepository.rev_parse:'),
+                        recs[0]['caller'])
+
+    def test_summary(self):
+        """The summary groups by command and by caller"""
+        gbp.tracing.setup()
+        self.repo.get_config('core.bare')
+        self.repo.get_config('core.bare')
+        with testutils.capture_stderr() as stderr:
+            gbp.tracing.report()
+        output = stderr.output()
+        self.assertIn("gbp profile: 2 commands", output)
+        self.assertIn("      2", output)
+        self.assertIn("git config", output)
+        self.assertIn("By caller:", output)
+
+    def test_supercommand_option(self):
+        """--profile enables tracing before running the command"""
+        for argv in (['argv0', '--profile', '--help'],
+                     ['argv0', '--help', '--profile']):
+            gbp.tracing.disable()
+            with testutils.capture_stderr():
+                gbp.scripts.supercommand.supercommand(argv)
+            self.assertTrue(gbp.tracing.enabled())
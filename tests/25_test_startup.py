@@ -0,0 +1,92 @@
+# vim: set fileencoding=utf-8 :
+"""
+Test and benchmark the start-up cost of the gbp commands
+
+Run as a script (C{python -m tests.25_test_startup}) to print how long
+importing the command modules takes in a fresh interpreter.
+"""
+
+from . import context
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+from gbp.rpm.policy import RpmPkgPolicy
+
+# Modules loaded when running the (rpm) commands
+STARTUP_MODULES = ['gbp.scripts.supercommand',
+                   'gbp.rpm',
+                   'gbp.scripts.pq_rpm',
+                   'gbp.scripts.buildpackage_rpm',
+                   'gbp.scripts.import_srpm',
+                   'gbp.scripts.rpm_ch']
+
+
+def _run_import(module):
+    """
+    Import a module in a new python interpreter
+
+    @return: names of all the modules loaded by the import
+    @rtype: C{list} of C{str}
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([context.projectdir] +
+                                        env.get('PYTHONPATH', '').split(os.pathsep))
+    script = ('import sys\n'
+              'import %s\n'
+              'sys.stdout.write(" ".join(sys.modules))\n' % module
+              if module else 'pass')
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    return output.decode().split()
+
+
+def import_time(module, repeat=5):
+    """
+    Best wall clock time of starting an interpreter and importing a module
+
+    @param module: the module, C{None} for measuring just the interpreter
+    @type module: C{str}
+    @param repeat: number of measurements
+    @type repeat: C{int}
+    @rtype: C{float}
+    """
+    best = None
+    for _i in range(repeat):
+        start = time.time()
+        _run_import(module)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class TestStartup(unittest.TestCase):
+    """Test that importing the commands stays cheap"""
+
+    def test_librpm_not_imported(self):
+        """librpm is only loaded when it is actually used"""
+        rpm_modules = set(['rpm', RpmPkgPolicy.python_rpmlib_module_name])
+        for module in STARTUP_MODULES:
+            loaded = rpm_modules.intersection(_run_import(module))
+            self.assertEqual(loaded, set(), "%s imports %s" % (module, loaded))
+
+    def test_librpm_lazy(self):
+        """The librpm proxy imports the module on first use"""
+        from gbp.rpm.lib_rpm import _LibRpm
+        proxy = _LibRpm()
+        self.assertFalse(proxy.loaded)
+        self.assertEqual(proxy.get_log(), [])
+        try:
+            proxy.RPMTAG_NAME
+        except ImportError:
+            raise unittest.SkipTest("librpm not available")
+        self.assertTrue(proxy.loaded)
+
+
+if __name__ == '__main__':
+    base = import_time(None)
+    print("%-32s %7.1f ms" % ('(interpreter)', base * 1000))
+    for name in STARTUP_MODULES:
+        print("%-32s %7.1f ms" % (name, (import_time(name) - base) * 1000))
@@ -452,3 +452,8 @@ class TestRpmCh(RpmRepoTestBase):
         eq_(mock_ch([]), 1)
         self._check_log(-1, "gbp:error: Couldn't determine starting point")
 
+        # The changelog file is not left open after the failure
+        path = os.path.realpath('packaging/gbp-test-native.changes')
+        eq_([fd for fd in os.listdir('/proc/self/fd') if
+             os.path.realpath(os.path.join('/proc/self/fd', fd)) == path], [])
+
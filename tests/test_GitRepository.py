@@ -265,6 +265,36 @@ def test_tag():
     ['tag', 'tag2']
     """
 
+def test_refs_snapshot():
+    """
+    Refs changed outside of the repository object are noticed
+
+    Methods tested:
+         - L{gbp.git.GitRepository.has_tag}
+         - L{gbp.git.GitRepository.get_tags}
+         - L{gbp.git.GitRepository.delete_tag}
+
+    >>> import gbp.git, subprocess
+    >>> repo = gbp.git.GitRepository(repo_dir)
+    >>> repo.has_tag("external")
+    False
+    >>> subprocess.check_call(["git", "tag", "-m", "foo", "external"],
+    ...                       cwd=repo.path)
+    0
+    >>> repo.has_tag("external")
+    True
+    >>> repo.has_tag("ext*")
+    True
+    >>> repo.get_tags("ext*")
+    ['external']
+    >>> repo._ref_commit("refs/tags/external") == repo.rev_parse("HEAD")
+    True
+    >>> repo.delete_tag("external")
+    >>> repo.has_tag("external")
+    False
+    >>> repo._ref_commit("refs/tags/external")
+    """
+
 def test_describe():
     """
     Describe commit-ish
@@ -387,6 +417,130 @@ def test_get_obj_type():
     >>> repo.delete_tag("tag3")
     """
 
+def test_show():
+    """
+    Look up objects through the long running git cat-file processes
+
+    Methods tested:
+         - L{gbp.git.GitRepository.show}
+         - L{gbp.git.GitRepository.rev_parse}
+
+    >>> import gbp.git
+    >>> repo = gbp.git.GitRepository(repo_dir)
+    >>> repo.show("HEAD:testfile")
+    'ref: refs/heads/master\\n'
+    >>> repo.show("HEAD").startswith("commit %s" % repo.head)
+    True
+
+    Only the content of blobs is read through cat-file
+
+    >>> reads = []
+    >>> repo._cat_file.read = reads.append
+    >>> repo.show("HEAD^{tree}").startswith("tree ")
+    True
+    >>> reads
+    []
+    >>> del repo._cat_file.read
+    >>> repo.rev_parse("HEAD") == repo.rev_parse("HEAD", short=40)
+    True
+    >>> repo.rev_parse("HEAD:testfile") == repo.list_tree("HEAD")[0][2]
+    True
+    """
+
+
+def test_object_reader():
+    """
+    Read objects and refs without git
+
+    Classes tested:
+         - L{gbp.git.objectreader.GitObjectReader}
+
+    Methods tested:
+         - L{gbp.git.GitRepository.list_tree}
+
+    >>> import gbp.git, subprocess
+    >>> from gbp.git.catfile import GitCatFile
+    >>> from gbp.git.objectreader import GitObjectReader
+    >>> repo = gbp.git.GitRepository(repo_dir)
+    >>> catfile = GitCatFile(repo.path)
+    >>> reader = GitObjectReader(repo.git_dir)
+    >>> names = ['HEAD', 'HEAD~0^{tree}', 'HEAD:testfile', 'HEAD:',
+    ...          'master', 'refs/heads/master', 'master^0', repo.head]
+    >>> names += [tag + '^{}' for tag in repo.get_tags()] + repo.get_tags()
+    >>> [name for name in names if reader.info(name) != catfile.info(name)]
+    []
+    >>> [name for name in names if reader.read(name) != catfile.read(name)]
+    []
+    >>> subprocess.call(['git', 'gc', '--quiet'], cwd=repo.path)
+    0
+    >>> [name for name in names if reader.read(name) != catfile.read(name)]
+    []
+    >>> reader.info('HEAD@{0}')
+    Traceback (most recent call last):
+    ...
+    GitObjectReaderError: Unsupported revision 'HEAD@{0}'
+    >>> reader = GitObjectReader(repo.git_dir, fallback=catfile)
+    >>> reader.info('HEAD@{0}') == catfile.info('HEAD')
+    True
+    >>> reader.close()
+    >>> subprocess.call(['git', 'config', 'gbp.objectReader', 'python'],
+    ...                 cwd=repo.path)
+    0
+    >>> repo = gbp.git.GitRepository(repo_dir)
+    >>> isinstance(repo._cat_file, GitObjectReader)
+    True
+    >>> out = repo._git_inout('ls-tree', ['-r', '-z', 'HEAD'])[0]
+    >>> repo.list_tree('HEAD', recurse=True) == [line.split(None, 3) for line in out.split('\\0') if line]
+    True
+    >>> repo._cat_file_reader = GitObjectReader(repo.git_dir)
+    >>> repo._list_tree_objects('HEAD:', False) == repo.list_tree('HEAD')
+    True
+    >>> subprocess.call(['git', 'config', '--unset', 'gbp.objectReader'],
+    ...                 cwd=repo.path)
+    0
+
+    Replace refs are not supported, even if they are only in packed-refs
+
+    >>> import os, shutil, tempfile
+    >>> replace_dir = tempfile.mkdtemp(dir=os.path.dirname(repo_dir))
+    >>> replace_repo = gbp.git.GitRepository.clone(replace_dir, repo.path, auto_name=False)
+    >>> other = replace_repo.commit_tree(replace_repo.rev_parse('HEAD^{tree}'), 'other', [])
+    >>> replace_repo._git_command('replace', ['HEAD', other])
+    >>> GitObjectReader(replace_repo.git_dir)._supported
+    False
+    >>> replace_repo._git_command('pack-refs', ['--all'])
+    >>> os.rmdir(os.path.join(replace_repo.git_dir, 'refs', 'replace'))
+    >>> GitObjectReader(replace_repo.git_dir)._supported
+    False
+    >>> shutil.rmtree(replace_dir)
+    """
+
+
+def test_rev_parse_many():
+    """
+    Resolve several revisions at once
+
+    Methods tested:
+         - L{gbp.git.GitRepository.rev_parse_many}
+
+    >>> import gbp.git
+    >>> repo = gbp.git.GitRepository(repo_dir)
+    >>> shas = repo.rev_parse_many(['HEAD', 'master^0', 'HEAD'])
+    >>> sorted(shas.keys())
+    ['HEAD', 'master^0']
+    >>> shas['HEAD'] == shas['master^0'] == repo.head
+    True
+    >>> shas = repo.rev_parse_many(['HEAD', 'HEAD^{tree}'], short=7)
+    >>> shas['HEAD'] == repo.rev_parse('HEAD', short=7)
+    True
+    >>> shas['HEAD^{tree}'] == repo.rev_parse('HEAD^{tree}', short=7)
+    True
+    >>> repo.rev_parse_many(['HEAD', 'doesnotexist'])
+    Traceback (most recent call last):
+    ...
+    GitRepositoryError: revision 'doesnotexist' not found
+    """
+
 def test_list_files():
     """
     List files in the index
@@ -497,6 +651,61 @@ def test_get_commit_info():
     'foo'
     """
 
+def test_iter_commit_info():
+    """
+    Test inspecting a range of commits
+
+    Methods tested:
+         - L{gbp.git.GitRepository.iter_commit_info}
+
+    >>> import gbp.git
+    >>> repo = gbp.git.GitRepository(repo_dir)
+    >>> infos = list(repo.iter_commit_info())
+    >>> [info['id'] for info in infos] == repo.get_commits()
+    True
+    >>> info = repo.get_commit_info('HEAD')
+    >>> infos[0]['id'] == repo.head
+    True
+    >>> [infos[0][key] == info[key] for key in ('subject', 'body', 'patchname', 'files')]
+    [True, True, True, True]
+    >>> infos[0]['author'].get_author_env() == info['author'].get_author_env()
+    True
+    >>> [info['subject'] for info in repo.iter_commit_info('HEAD~1', reverse=True)]
+    ['foo']
+    >>> [(i['id'], i['subject'], i['body']) for i in repo.iter_commit_info(files=False)] == [(i['id'], i['subject'], i['body']) for i in infos]
+    True
+    >>> [dict(info['files']) for info in repo.iter_commit_info('HEAD~1', files=False)]
+    [{}]
+    >>> commits = repo.get_commits(num=2)
+    >>> [info['id'] for info in repo.iter_commit_info(commits=commits[::-1])] == commits[::-1]
+    True
+    >>> list(repo.iter_commit_info(paths=['doesnotexist']))
+    []
+
+    Merges with conflicts resolved have files in their combined diff
+
+    >>> import os, tempfile
+    >>> merge_dir = tempfile.mkdtemp(dir=os.path.dirname(repo_dir))
+    >>> merge_repo = gbp.git.GitRepository.create(merge_dir)
+    >>> def commit(content, parents):
+    ...     with open(os.path.join(merge_dir, 'file'), 'w') as fobj:
+    ...         _ = fobj.write(content)
+    ...     blob = merge_repo.write_file(os.path.join(merge_dir, 'file'))
+    ...     tree = merge_repo.make_tree([('100644', 'blob', blob, 'file')])
+    ...     return merge_repo.commit_tree(tree, content, parents)
+    >>> base = commit('base', [])
+    >>> merge = commit('merged', [commit('one', [base]), commit('two', [base])])
+    >>> after = commit('after', [merge])
+    >>> [(info['subject'], dict(info['files'])) for info in merge_repo.iter_commit_info(until=after, num=2)]
+    [('after', {'M': ['file']}), ('merged', {'MM': ['file']})]
+    >>> [dict(info['files']) for info in merge_repo.iter_commit_info(commits=[merge])]
+    [{'MM': ['file']}]
+    >>> list(repo.iter_commit_info(since='doesnotexist'))
+    Traceback (most recent call last):
+    ...
+    GitRepositoryError: Error getting commits doesnotexist..None: fatal: bad revision 'doesnotexist..HEAD'
+    """
+
 def test_diff():
     """
     Test git-diff
@@ -874,6 +1083,58 @@ def test_make_tree():
     """
 
 
+def test_commit_dir():
+    """
+    Commit directory contents via an index and via git fast-import
+
+    Methods tested:
+        - L{gbp.git.GitRepository.commit_dir}
+
+    >>> import gbp.git, os, tempfile, shutil
+    >>> repo = gbp.git.GitRepository(repo_dir)
+    >>> unpack_dir = tempfile.mkdtemp(dir=os.path.dirname(repo_dir))
+    >>> os.makedirs(os.path.join(unpack_dir, 'sub', 'empty'))
+    >>> with open(os.path.join(unpack_dir, 'sub', 'file one'), 'w') as f:
+    ...     f.write('one\\n')
+    >>> with open(os.path.join(unpack_dir, 'script'), 'w') as f:
+    ...     f.write('#!/bin/sh\\n')
+    >>> os.chmod(os.path.join(unpack_dir, 'script'), 0o755)
+    >>> os.symlink('sub/file one', os.path.join(unpack_dir, 'link'))
+    >>> author = {'name': 'foo', 'email': 'foo@example.com',
+    ...           'date': '1300000000 +0200'}
+    >>> head = repo.head
+    >>> commit1 = repo.commit_dir(unpack_dir, 'via index', 'commit_dir1',
+    ...                           other_parents=[head], author=author,
+    ...                           create_missing_branch=True)
+    >>> commit2 = repo.commit_dir(unpack_dir, 'via fast-import', 'commit_dir2',
+    ...                           other_parents=[head], author=author,
+    ...                           create_missing_branch=True, fast_import=True)
+    >>> repo.get_branch() == 'commit_dir2'
+    False
+    >>> repo.rev_parse('commit_dir2') == commit2
+    True
+    >>> repo.rev_parse(commit1 + '^{tree}') == repo.rev_parse(commit2 + '^{tree}')
+    True
+    >>> repo.rev_parse(commit2 + '^') == head
+    True
+    >>> info = repo.get_commit_info(commit2)
+    >>> info['subject'], info['author'].name, info['author'].date
+    ('via fast-import', 'foo', '1300000000 +0200')
+    >>> commit3 = repo.commit_dir(unpack_dir, 'again', 'commit_dir2',
+    ...                           fast_import=True)
+    >>> repo.rev_parse('commit_dir2^') == commit2
+    True
+    >>> repo.commit_dir(unpack_dir, 'missing', 'doesnotexist',
+    ...                 fast_import=True)
+    Traceback (most recent call last):
+    ...
+    GitRepositoryError: revision 'doesnotexist' not found
+    >>> repo.delete_branch('commit_dir1')
+    >>> repo.delete_branch('commit_dir2')
+    >>> shutil.rmtree(unpack_dir)
+    """
+
+
 def test_update_submodules():
     """
     Updating submodules if we don't have any is a noop
@@ -929,6 +1190,32 @@ def test_status():
     [('R ', ['test_status\x00test_statusnew'])]
     """
 
+def test_git_inout():
+    """
+    Pipe big amounts of data through git
+
+    Methods tested:
+        - L{gbp.git.GitRepository._git_inout}
+
+    >>> import gbp.git
+    >>> repo = gbp.git.GitRepository(repo_dir)
+    >>> data = b'0123456789abcdef' * 65536
+    >>> out, err, ret = repo._git_inout('hash-object', ['-w', '--stdin'], data)
+    >>> ret
+    0
+    >>> sha1 = out.strip()
+    >>> out, err, ret = repo._git_inout('cat-file', ['blob', sha1])
+    >>> out == data
+    True
+    >>> out, err, ret = repo._git_inout('cat-file', ['--batch'],
+    ...                                 (sha1 + '\\n') * 4)
+    >>> out.count(data)
+    4
+    >>> repo._git_inout('commit-tree', ['doesnotexist'], data,
+    ...                 capture_stderr=True)[2]
+    128
+    """
+
 def test_cmd_has_feature():
     r"""
     Methods tested:
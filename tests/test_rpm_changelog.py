@@ -169,6 +169,22 @@ class TestChangelogParser(object):
         # Check that re-creating section doesn't mangle it
         eq_(str(section), changelog.sections[0])
 
+    def test_parse_lazy(self):
+        """Test that sections are kept intact until modified"""
+        text = "* Wed Jan 29 2014 Foo <foo@bar.com> 1\n- Fix\n  \n\n"
+        section = self.parser.parse_section(text)
+        eq_(str(section), text)
+        section.append_entry(_ChangelogEntry(RpmPkgPolicy, "Foo", "- New"))
+        eq_(str(section), "* Wed Jan 29 2014 Foo <foo@bar.com> 1\n- Fix\n"
+                          "- New\n\n")
+
+        # Long changelogs are split to raw sections as is
+        text = "".join("* Wed Jan 29 2014 Foo <foo@bar.com> %d\r\n- Fix\n\n" %
+                       num for num in range(20000))
+        changelog = self.parser.raw_parse_string(text)
+        eq_(len(changelog.sections), 20000)
+        eq_(str(changelog), text)
+
     def test_parse_authors(self):
         """Test parsing of authors from changelog entries"""
         section = self.parser.parse_section(self.cl_with_authors)
@@ -188,6 +204,62 @@ class TestChangelogParser(object):
         # Cleanup
         tmpfile.close()
 
+    def test_parse_changelog_file_partial(self):
+        """Test reading only the topmost sections of a file"""
+        tmpfile = NamedTemporaryFile()
+        tmpfile.write(self.cl_default_style)
+        tmpfile.file.flush()
+        changelog = self.parser.raw_parse_file(tmpfile.name, max_sections=1)
+        eq_(len(changelog.sections), 1)
+        ok_(str(changelog.tail).startswith("* Tue Jan 28 2014"))
+        eq_(str(changelog), self.cl_default_style)
+
+        # Modify the top section, the tail is copied as is
+        section = self.parser.parse_section(changelog.sections[0])
+        section.append_entry(_ChangelogEntry(RpmPkgPolicy, "", "- Fix"))
+        changelog.sections[0] = section
+        changelog.add_section(time=datetime(2014, 1, 30), name="J",
+                              email="j@d", revision="0.4")
+        outfile = NamedTemporaryFile()
+        changelog.write(outfile)
+        outfile.file.flush()
+        with open(outfile.name) as fobj:
+            eq_(fobj.read(), str(changelog))
+        eq_(str(changelog), "* Thu Jan 30 2014 J <j@d> 0.4\n\n" +
+            self.cl_default_style.replace("foo.patch\n",
+                                          "foo.patch\n- Fix\n", 1))
+
+        # The tail is not available after closing
+        changelog.close()
+        with assert_raises(ValueError):
+            str(changelog)
+
+        # More sections than there are in the file
+        changelog = self.parser.raw_parse_file(tmpfile.name, max_sections=5)
+        eq_(len(changelog.sections), 3)
+        eq_(changelog.tail, None)
+        tmpfile.close()
+        outfile.close()
+
+    def test_iter_sections(self):
+        """Test splitting sections from a stream"""
+        lines = iter(self.cl_default_style.splitlines(True))
+        sections = self.parser.iter_sections(lines)
+        ok_(next(sections).startswith("* Wed Jan 29 2014"))
+        # Only the header of the next section has been consumed
+        eq_(next(lines), "- Update to 0.2\n")
+
+        with assert_raises(ChangelogError):
+            next(self.parser.iter_sections(["garbage\n"]))
+
+    def test_parse_header_time(self):
+        """Test parsing of the header timestamps"""
+        section = self.parser.parse_section(
+            "* Sat Feb  1 2014 Foo <foo@bar.com> 1\n- Fix\n")
+        eq_(section.header['time'], datetime(2014, 2, 1))
+        # Regexps are compiled only once per policy
+        ok_(ChangelogParser(RpmPkgPolicy)._regexps is self.parser._regexps)
+
     def test_parse_section_fail(self):
         """Basic tests for failures of changelog section parsing"""
         with assert_raises(ChangelogError):